@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+"""
+For a list of VMs this script backs up every one of their VDIs in one go,
+with a single XenAPI session, instead of running the per-VDI scripts of
+execute_cbt.sh one after another.
+
+All the VDIs are snapshotted in a batch of asynchronous XenAPI tasks. Each
+snapshot is then exported: the first time a VDI is seen CBT is enabled and the
+whole snapshot is exported as its base, and after that only the blocks changed
+since its previous snapshot are exported over NBD. Exports run concurrently,
+limited per host and per SR, and the VM metadata exports and data_destroy
+calls happen while other VDIs are still transferring. With --rate-limit the
+bandwidth and request rates of every transfer are also limited per host and
+per SR, as set in a control file that can be changed while the backup runs
+(see cbt_rate_limit.py).
+
+example: python cbt_backup_fleet.py -ip <host address> -u <host username>
+-p <host password> -v <vm uuid> -v <vm uuid> ... -o <backup directory>
+
+The backup directory holds a directory per VDI with the base VDI and the
+bitmap and changed blocks files of every increment, named after the snapshot
+they came from, the VM metadata, and a state.json recording the snapshots of
+each VDI oldest first, which is what a restore needs to rebuild the chain.
+The metadata of all the VMs is exported in one batch into the metadata
+directory, which only gains a new version of a VM's metadata when it has
+changed (see cbt_vm_metadata_export.py).
+"""
+
+import XenAPI
+import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import os
+import re
+import sys
+import time
+
+import cbt_export_async
+import cbt_metrics
+import cbt_rate_limit
+from cbt_enable_and_snapshot import enable_nbd_on_all_networks, export_vdi
+from cbt_vm_metadata_export import export_vms
+from nbd_client import new_nbd_client
+
+state_file_name = "state.json"
+
+
+class fleet_backup(object):
+
+    def __init__(self, session, host, backup_dir, budget, per_host=2,
+                 per_sr=2, queue_depth=new_nbd_client.DEFAULT_QUEUE_DEPTH,
+                 rate_limits=None):
+        self.session = session
+        self.host = host
+        self.backup_dir = backup_dir
+        self.budget = budget
+        self.per_host = per_host
+        self.per_sr = per_sr
+        self.queue_depth = queue_depth
+        self.rate_limits = rate_limits or cbt_rate_limit.rate_limits()
+        # XenAPI sessions are not safe to use from several threads at once,
+        # so every call goes through the same single thread
+        self._api_thread = concurrent.futures.ThreadPoolExecutor(1)
+        self._host_slots = {}
+        self._sr_slots = {}
+        self._cleanups = []
+        self.state = self._load_state()
+
+    def _state_path(self):
+        return os.path.join(self.backup_dir, state_file_name)
+
+    def _load_state(self):
+        try:
+            with open(self._state_path()) as state_file:
+                return json.load(state_file)
+        except FileNotFoundError:
+            return {}
+
+    def _save_state(self):
+        temporary_path = self._state_path() + ".tmp"
+        with open(temporary_path, 'w') as state_file:
+            json.dump(self.state, state_file, indent=2, sort_keys=True)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(temporary_path, self._state_path())
+
+    async def api(self, name, *args):
+        """Make the XenAPI call name, such as 'VDI.snapshot', with args"""
+        method = self.session.xenapi
+        for part in name.split('.'):
+            method = getattr(method, part)
+        return await asyncio.get_running_loop().run_in_executor(
+            self._api_thread, method, *args)
+
+    @contextlib.asynccontextmanager
+    async def _slot(self, host, sr):
+        host_slots = self._host_slots.setdefault(
+            host, asyncio.Semaphore(self.per_host))
+        sr_slots = self._sr_slots.setdefault(sr,
+                                             asyncio.Semaphore(self.per_sr))
+        # always taken in the same order, so no two exports wait on each other
+        async with host_slots:
+            async with sr_slots:
+                yield
+
+    async def _wait_for_task(self, task):
+        try:
+            while True:
+                status = await self.api('task.get_status', task)
+                if status != 'pending':
+                    break
+                await asyncio.sleep(0.5)
+            if status != 'success':
+                raise XenAPI.Failure(await self.api('task.get_error_info',
+                                                    task))
+            result = await self.api('task.get_result', task)
+            return re.search(r'OpaqueRef:[^<]*', result).group(0)
+        finally:
+            await self.api('task.destroy', task)
+
+    async def _vm_vdis(self, vm):
+        vdis = []
+        for vbd in await self.api('VM.get_VBDs', vm):
+            if await self.api('VBD.get_type', vbd) != 'Disk':
+                continue
+            vdi = await self.api('VBD.get_VDI', vbd)
+            if vdi != 'OpaqueRef:NULL':
+                vdis.append(vdi)
+        return vdis
+
+    async def _snapshot(self, vdi):
+        if not await self.api('VDI.get_cbt_enabled', vdi):
+            await self.api('VDI.enable_cbt', vdi)
+        return await self._wait_for_task(
+            await self.api('Async.VDI.snapshot', vdi))
+
+    async def _snapshot_all(self, vdis):
+        """
+        Snapshot every one of vdis, returning a list with the snapshot of
+        each, or the exception snapshotting it failed with, so the snapshots
+        that were taken are still backed up and cleaned up
+        """
+        with cbt_metrics.phase('snapshot'):
+            # every snapshot is started before any of them is waited for
+            return await asyncio.gather(*[self._snapshot(vdi)
+                                          for vdi in vdis],
+                                        return_exceptions=True)
+
+    async def _export_metadata(self, vm_uuids):
+        return await asyncio.to_thread(export_vms, self.host,
+                                       self.session._session, vm_uuids,
+                                       os.path.join(self.backup_dir,
+                                                    "metadata"))
+
+    async def _limiter(self, host, sr):
+        return self.rate_limits.limiter(host, await self.api('SR.get_uuid',
+                                                             sr))
+
+    async def _nbd_address(self, snapshot):
+        # The address of the host serving the VDI, which every export of it
+        # is limited by, whether it goes over NBD or not
+        nbd_infos = await self.api('VDI.get_nbd_info', snapshot)
+        return nbd_infos[0]['address'] if nbd_infos else self.host
+
+    async def _export_base(self, vdi_uuid, snapshot, snapshot_uuid, sr,
+                           directory):
+        address = await self._nbd_address(snapshot)
+        rate_limit = await self._limiter(address, sr)
+        async with self._slot(address, sr):
+            print("exporting base of VDI %s" % vdi_uuid)
+            with cbt_metrics.phase('transfer') as record:
+                record.bytes = await asyncio.to_thread(
+                    export_vdi, self.host, self.session._session,
+                    snapshot_uuid, 'raw', os.path.join(directory, "base.raw"),
+                    rate_limit=rate_limit)
+        return {'base': snapshot_uuid, 'increments': []}
+
+    async def _export_changes(self, vdi_uuid, state, snapshot, snapshot_uuid,
+                              sr, directory):
+        previous = await self.api('VDI.get_by_uuid', state['last'])
+        with cbt_metrics.phase('list_changed_blocks'):
+            bitmap = await self.api('VDI.list_changed_blocks', previous,
+                                    snapshot)
+        nbd_infos = await self.api('VDI.get_nbd_info', snapshot)
+        if not nbd_infos:
+            raise Exception("VDI %s cannot be reached over NBD; is NBD "
+                            "enabled on any network?" % vdi_uuid)
+        vdi_size = int(await self.api('VDI.get_virtual_size', snapshot))
+        rate_limit = await self._limiter(nbd_infos[0]['address'], sr)
+        async with self._slot(nbd_infos[0]['address'], sr):
+            print("exporting changed blocks of VDI %s" % vdi_uuid)
+            with cbt_metrics.phase('transfer') as record:
+                written = await cbt_export_async.download_changed_blocks(
+                    self.budget, bitmap, nbd_infos[0], vdi_size,
+                    os.path.join(directory, snapshot_uuid + ".changed"),
+                    os.path.join(directory, snapshot_uuid + ".bitmap"),
+                    self.queue_depth, rate_limit=rate_limit)
+                record.bytes = sum(extent.length for extent in written)
+        state['increments'].append(snapshot_uuid)
+        return state
+
+    async def _backup_vdi(self, vdi, snapshot):
+        try:
+            vdi_uuid = await self.api('VDI.get_uuid', vdi)
+            snapshot_uuid = await self.api('VDI.get_uuid', snapshot)
+            sr = await self.api('VDI.get_SR', vdi)
+            directory = os.path.join(self.backup_dir, vdi_uuid)
+            os.makedirs(directory, exist_ok=True)
+            state = self.state.get(vdi_uuid)
+            if state is None:
+                state = await self._export_base(vdi_uuid, snapshot,
+                                                snapshot_uuid, sr, directory)
+            else:
+                state = await self._export_changes(vdi_uuid, state, snapshot,
+                                                   snapshot_uuid, sr,
+                                                   directory)
+            state['last'] = snapshot_uuid
+            self.state[vdi_uuid] = state
+            self._save_state()
+            return snapshot_uuid
+        finally:
+            # Once the blocks are copied, or the copy has failed, the
+            # snapshot data is deleted without holding up other transfers
+            self._cleanups.append(asyncio.ensure_future(
+                self.api('VDI.data_destroy', snapshot)))
+
+    async def run(self, vm_uuids):
+        """
+        Back up every VDI of the VMs with the given uuids, returning a dict
+        from VDI uuid to the new snapshot uuid, or to the exception its
+        backup failed with.
+        """
+        start = time.monotonic()
+        vms = [await self.api('VM.get_by_uuid', uuid) for uuid in vm_uuids]
+        vdis = []
+        for vm in vms:
+            vdis.extend(await self._vm_vdis(vm))
+        vdi_uuids = [await self.api('VDI.get_uuid', vdi) for vdi in vdis]
+        if any(uuid not in self.state for uuid in vdi_uuids):
+            await asyncio.get_running_loop().run_in_executor(
+                self._api_thread, enable_nbd_on_all_networks, self.session)
+        snapshots = await self._snapshot_all(vdis)
+        print("snapshotted %d VDIs of %d VMs in %.2fs"
+              % (len(vdis), len(vms), time.monotonic() - start))
+
+        transfers = {}
+        for (vdi, vdi_uuid, snapshot) in zip(vdis, vdi_uuids, snapshots):
+            if isinstance(snapshot, BaseException):
+                print("snapshot of VDI %s failed: %s" % (vdi_uuid, snapshot))
+            else:
+                transfers[vdi_uuid] = self._backup_vdi(vdi, snapshot)
+        results = await asyncio.gather(*(list(transfers.values()) +
+                                         [self._export_metadata(vm_uuids)]),
+                                       return_exceptions=True)
+        await asyncio.gather(*self._cleanups, return_exceptions=True)
+        self._api_thread.shutdown()
+        metadata = results[-1]
+        if isinstance(metadata, BaseException):
+            metadata = dict((vm_uuid, metadata) for vm_uuid in vm_uuids)
+        for (vm_uuid, result) in sorted(metadata.items()):
+            if isinstance(result, BaseException):
+                print("metadata export of VM %s failed: %s"
+                      % (vm_uuid, result))
+        print("backed up %d VDIs in %.2fs"
+              % (len(vdis), time.monotonic() - start))
+        # the VDIs whose snapshot failed keep the exception it failed with
+        outcome = dict(zip(vdi_uuids, snapshots))
+        outcome.update(zip(transfers, results[:len(transfers)]))
+        return outcome
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-ip', '--host-ip', dest='host')
+    parser.add_argument('-u', '--username', dest='username')
+    parser.add_argument('-p', '--password', dest='password')
+    parser.add_argument('-v', '--vm-uuid', dest='vm_uuids', action='append',
+                        default=[], help='VM to back up, can be repeated')
+    parser.add_argument('-o', '--output-dir', dest='output_dir')
+    parser.add_argument('--per-host', dest='per_host', type=int, default=2,
+                        help='Number of exports to run at once from each '
+                             'host')
+    parser.add_argument('--per-sr', dest='per_sr', type=int, default=2,
+                        help='Number of exports to run at once from each SR')
+    parser.add_argument('--max-exports', dest='max_exports', type=int,
+                        default=8,
+                        help='Number of NBD exports to run at once in total')
+    parser.add_argument('--max-requests', dest='max_requests', type=int,
+                        default=64,
+                        help='Number of NBD requests to keep in flight in '
+                             'total')
+    parser.add_argument('--bandwidth', dest='bandwidth', type=int,
+                        default=None,
+                        help='Total NBD bandwidth to use, in MiB/s')
+    parser.add_argument('-q', '--queue-depth', dest='queue_depth', type=int,
+                        default=new_nbd_client.DEFAULT_QUEUE_DEPTH,
+                        help='Number of NBD requests to keep in flight on '
+                             'each connection')
+    parser.add_argument('--rate-limit', dest='rate_limit',
+                        help='JSON file of bandwidth and request rate limits '
+                             'per host and per SR, see cbt_rate_limit.py')
+    cbt_metrics.add_arguments(parser)
+    args = parser.parse_args()
+    cbt_metrics.configure_from_args(args)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    session = XenAPI.Session("https://" + args.host, ignore_ssl=True)
+    session.login_with_password(args.username, args.password, "0.1",
+                                "CBT example")
+
+    try:
+        bandwidth = args.bandwidth * 1024 * 1024 if args.bandwidth else None
+        budget = cbt_export_async.transfer_budget(args.max_exports,
+                                                  args.max_requests,
+                                                  bandwidth)
+        rate_limits = None
+        if args.rate_limit:
+            rate_limits = cbt_rate_limit.from_control_file(args.rate_limit)
+        backup = fleet_backup(session, args.host, args.output_dir, budget,
+                              args.per_host, args.per_sr, args.queue_depth,
+                              rate_limits)
+        results = asyncio.run(backup.run(args.vm_uuids))
+        failed = False
+        for (vdi_uuid, result) in sorted(results.items()):
+            if isinstance(result, BaseException):
+                failed = True
+                print("%s failed: %s" % (vdi_uuid, result))
+            else:
+                print("%s %s" % (vdi_uuid, result))
+    finally:
+        session.xenapi.session.logout()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,510 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks of the NBD client, the changed blocks export and restores, which
+need no XenServer host: VDIs are served by a local NBD server, and the
+XenAPI calls of an export are answered by fake_session, whose
+VDI.list_changed_blocks returns synthetic bitmaps.
+
+example: python cbt_benchmark.py -d <scratch directory> --sizes 256 1024
+--density 0.1 --run-length 16 --tls
+
+For each VDI size, in MiB, a VDI image of random data is written to the
+scratch directory, a temporary directory if -d is not given, and served,
+and
+
+    nbd_read       the whole VDI is read with new_nbd_client.read_pipelined
+    export         --increments sets of changed blocks are exported with
+                   cbt_export_changes.get_changed_blocks
+    merge          the first of them is applied to the VDI with
+                   write_changed_blocks_to_base_VDI
+    restore_chain  all of them are applied with cbt_restore_chain
+
+are timed, and the throughput and CPU seconds per GiB of each are printed.
+The bytes counted are those of the whole VDI for nbd_read, and those of the
+changed blocks for the others: every increment exported or restored, or the
+one increment merged. The merge and restore still read the rest of the VDI
+from the base, but their throughput is that of applying increments, in the
+same terms as that of the export.
+The bitmaps have --density of their blocks set, in runs of --run-length
+blocks on average. With --tls the server requires TLS, with a certificate
+signed by a CA generated for the run.
+
+The server is nbd_server.py, running in this process, or qemu-nbd or nbdkit
+if installed and chosen with --server. It listens on the standard NBD port,
+which the export scripts connect to. CPU time is that of this process, so
+with nbd_server.py it includes the server's.
+
+--json writes the results to a file, and --baseline compares them with the
+results of an earlier run, exiting with status 1 if any throughput has
+fallen by more than --tolerance percent.
+"""
+
+import argparse
+import base64
+import contextlib
+import datetime
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import uuid
+
+import cbt_bitmap
+import cbt_export_changes
+import cbt_nbd_pool
+import nbd_server
+from cbt_restore_chain import restore_chain
+from cbt_write_changed_blocks_to_base_VDI import \
+    write_changed_blocks_to_base_VDI
+from nbd_client import new_nbd_client, buffer_pool
+
+# The name the VDI is served under, and the host name its certificate is for
+export_name = 'vdi'
+server_address = '127.0.0.1'
+server_hostname = 'localhost'
+server_port = 10809
+# The whole VDI is read in requests of this size
+read_size = 4 * 1024 * 1024
+# How long to wait for an external server to start listening, in seconds
+server_start_timeout = 10
+
+servers = ['python', 'qemu-nbd', 'nbdkit']
+
+
+def make_certificates(directory, hostname=server_hostname):
+    """
+    Generate a CA and a certificate for hostname signed by it, and write
+    them to directory under the names qemu-nbd and nbdkit look for:
+    ca-cert.pem, server-cert.pem and server-key.pem
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    def certificate(name, key, issuer, issuer_key, ca):
+        builder = x509.CertificateBuilder().subject_name(
+            x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+        ).issuer_name(
+            x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, issuer)])
+        ).public_key(key.public_key()).serial_number(
+            x509.random_serial_number()
+        ).not_valid_before(
+            now - datetime.timedelta(days=1)
+        ).not_valid_after(
+            now + datetime.timedelta(days=1)
+        ).add_extension(
+            x509.BasicConstraints(ca=ca, path_length=None), critical=True
+        ).add_extension(
+            x509.SubjectKeyIdentifier.from_public_key(key.public_key()),
+            critical=False
+        ).add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(
+                issuer_key.public_key()), critical=False)
+        if ca:
+            builder = builder.add_extension(x509.KeyUsage(
+                digital_signature=False, content_commitment=False,
+                key_encipherment=False, data_encipherment=False,
+                key_agreement=False, key_cert_sign=True, crl_sign=True,
+                encipher_only=False, decipher_only=False), critical=True)
+        else:
+            builder = builder.add_extension(
+                x509.SubjectAlternativeName([x509.DNSName(name)]),
+                critical=False)
+        return builder.sign(issuer_key, hashes.SHA256())
+
+    ca_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    ca_cert = certificate("CBT benchmark CA", ca_key, "CBT benchmark CA",
+                          ca_key, True)
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    cert = certificate(hostname, key, "CBT benchmark CA", ca_key, False)
+    for (name, data) in (
+            ('ca-cert.pem', ca_cert.public_bytes(serialization.Encoding.PEM)),
+            ('server-cert.pem', cert.public_bytes(serialization.Encoding.PEM)),
+            ('server-key.pem', key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.TraditionalOpenSSL,
+                serialization.NoEncryption()))):
+        with open(os.path.join(directory, name), 'wb') as pem:
+            pem.write(data)
+
+
+def synthetic_bitmap(blocks, density, run_length, rng):
+    """
+    Return a base64 encoded bitmap of blocks bits, as returned by
+    VDI.list_changed_blocks, with about density of them set in runs of
+    run_length bits on average
+    """
+    bits = bytearray(-(-blocks // 8))
+    target = min(blocks, int(blocks * density))
+    changed = 0
+    while changed < target:
+        length = max(1, int(rng.expovariate(1.0 / run_length)))
+        start = rng.randrange(blocks)
+        for block in range(start, min(start + length, blocks)):
+            if not bits[block // 8] & (0x80 >> block % 8):
+                bits[block // 8] |= 0x80 >> block % 8
+                changed += 1
+                if changed == target:
+                    break
+    return base64.b64encode(bytes(bits)).decode()
+
+
+class fake_session(object):
+    """
+    Answers the XenAPI calls of an export, for VDIs of vdi_size bytes all
+    served as export_name. Every call to VDI.list_changed_blocks returns a
+    new synthetic_bitmap, and VDI.get_nbd_info gives the certificate cert.
+    """
+
+    def __init__(self, vdi_size, density, run_length, cert="", seed=0):
+        self.vdi_size = vdi_size
+        self.density = density
+        self.run_length = run_length
+        self.cert = cert
+        self._random = random.Random(seed)
+        self._session = 'OpaqueRef:%s' % uuid.uuid4()
+        self.xenapi = types.SimpleNamespace(
+            VDI=types.SimpleNamespace(
+                get_by_uuid=lambda vdi_uuid: 'OpaqueRef:' + vdi_uuid,
+                get_uuid=lambda vdi_ref: vdi_ref.split(':', 1)[1],
+                get_SR=lambda vdi_ref: 'OpaqueRef:benchmark',
+                get_virtual_size=lambda vdi_ref: str(self.vdi_size),
+                snapshot=lambda vdi_ref: 'OpaqueRef:%s' % uuid.uuid4(),
+                list_changed_blocks=self._list_changed_blocks,
+                get_nbd_info=self._get_nbd_info,
+                data_destroy=lambda vdi_ref: ''),
+            SR=types.SimpleNamespace(
+                get_uuid=lambda sr_ref: sr_ref.split(':', 1)[1]),
+            session=types.SimpleNamespace(logout=lambda *args: None))
+
+    def _list_changed_blocks(self, vdi_from, vdi_to):
+        return synthetic_bitmap(
+            -(-self.vdi_size // cbt_export_changes.changed_block_size),
+            self.density, self.run_length, self._random)
+
+    def _get_nbd_info(self, vdi_ref):
+        return [{'address': server_address, 'exportname': export_name,
+                 'cert': self.cert}]
+
+
+class local_server(object):
+    """
+    Serve the VDI image path as export_name on server_port with the server
+    kind, one of servers, requiring TLS if certificates is the directory
+    written by make_certificates
+    """
+
+    def __init__(self, kind, path, certificates=None):
+        self.kind = kind
+        self.path = path
+        self.certificates = certificates
+        self._server = None
+        self._backend = None
+        self._process = None
+
+    def __enter__(self):
+        if self.kind == 'python':
+            ssl_context = None
+            if self.certificates:
+                ssl_context = nbd_server.server_ssl_context(
+                    os.path.join(self.certificates, 'server-cert.pem'),
+                    os.path.join(self.certificates, 'server-key.pem'))
+            self._backend = nbd_server.file_backend(self.path)
+            self._server = nbd_server.nbd_server(
+                {export_name: self._backend}, (server_address, server_port),
+                ssl_context).start()
+            return self
+        if shutil.which(self.kind) is None:
+            raise Exception("%s is not installed" % self.kind)
+        if self.kind == 'qemu-nbd':
+            command = ['qemu-nbd', '--format=raw', '--persistent',
+                       '--shared=0', '--export-name=' + export_name,
+                       '--bind=' + server_address,
+                       '--port=%d' % server_port]
+            if self.certificates:
+                command += ['--object', 'tls-creds-x509,id=tls0,'
+                            'endpoint=server,dir=' + self.certificates,
+                            '--tls-creds=tls0']
+            command.append(self.path)
+        else:
+            command = ['nbdkit', '--foreground',
+                       '--ipaddr=' + server_address,
+                       '--port=%d' % server_port]
+            if self.certificates:
+                command += ['--tls=require',
+                            '--tls-certificates=' + self.certificates]
+            command += ['file', 'file=' + self.path]
+        self._process = subprocess.Popen(command)
+        self._wait_until_listening()
+        return self
+
+    def _wait_until_listening(self):
+        deadline = time.monotonic() + server_start_timeout
+        while True:
+            if self._process.poll() is not None:
+                raise Exception("%s exited with status %d"
+                                % (self.kind, self._process.returncode))
+            try:
+                socket.create_connection((server_address, server_port)).close()
+                return
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def __exit__(self, *exc_info):
+        if self._server is not None:
+            self._server.close()
+            self._backend.close()
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait()
+
+
+def write_random_vdi(path, size):
+    with open(path, 'wb') as vdi:
+        for offset in range(0, size, read_size):
+            vdi.write(os.urandom(min(read_size, size - offset)))
+
+
+def read_vdi(ca_cert, queue_depth):
+    """Read the whole served VDI and return its size"""
+    client = new_nbd_client(server_address, export_name, ca_cert,
+                            server_hostname, queue_depth=queue_depth)
+    try:
+        size = client.size()
+        extents = ((offset, min(read_size, size - offset))
+                   for offset in range(0, size, read_size))
+        for _ in client.read_pipelined(extents, pool=buffer_pool()):
+            pass
+    finally:
+        client.close()
+    return size
+
+
+def export_increments(session, directory, count, queue_depth, increments):
+    """
+    Export count sets of changed blocks as cbt_export_changes.main does,
+    adding their (bitmap path, changed blocks path) pairs to increments.
+    Returns the number of bytes exported.
+    """
+    vdi_ref = session.xenapi.VDI.get_by_uuid(str(uuid.uuid4()))
+    last_snapshot_ref = session.xenapi.VDI.snapshot(vdi_ref)
+    exported = 0
+    for i in range(count):
+        snapshot_ref = session.xenapi.VDI.snapshot(vdi_ref)
+        bitmap = session.xenapi.VDI.list_changed_blocks(last_snapshot_ref,
+                                                        snapshot_ref)
+        nbd_info = session.xenapi.VDI.get_nbd_info(snapshot_ref)[0]
+        vdi_size = int(session.xenapi.VDI.get_virtual_size(snapshot_ref))
+        (bits, extents) = cbt_export_changes.get_changed_extents(bitmap)
+        blocks = cbt_export_changes.get_changed_blocks(nbd_info, extents,
+                                                       queue_depth)
+        paths = (os.path.join(directory, "%d.bitmap" % i),
+                 os.path.join(directory, "%d.changed" % i))
+        written = cbt_export_changes.save_changed_blocks(blocks, paths[1])
+        cbt_bitmap.write_bitmap_file(paths[0], bits,
+                                     cbt_export_changes.changed_block_size,
+                                     vdi_size, sorted(written))
+        # every snapshot has an export of its own, so its connection is of
+        # no use to the next one, though its TLS session is
+        cbt_nbd_pool.get().discard(nbd_info)
+        exported += sum(extent.length for extent in extents)
+        increments.append(paths)
+        last_snapshot_ref = snapshot_ref
+    return exported
+
+
+def changed_bytes(increments):
+    """
+    Return the number of bytes of changed blocks in the (bitmap path,
+    changed blocks path) pairs of increments
+    """
+    return sum(extent.length for (bitmap_path, _) in increments
+               for extent in cbt_bitmap.read_bitmap_file(bitmap_path).extents)
+
+
+def measure(name, vdi_size, function, *args):
+    """Time function(*args), which returns the number of bytes it moved"""
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            moved = function(*args)
+    seconds = time.perf_counter() - start
+    cpu_seconds = time.process_time() - cpu_start
+    gib = moved / (1024 * 1024 * 1024)
+    return {'benchmark': name, 'vdi_size': vdi_size, 'bytes': moved,
+            'seconds': seconds, 'cpu_seconds': cpu_seconds,
+            'mib_per_second': moved / (1024 * 1024) / seconds
+            if seconds else 0,
+            'cpu_seconds_per_gib': cpu_seconds / gib if gib else 0}
+
+
+def run_benchmarks(directory, sizes, density, run_length, increments=2,
+                   queue_depth=new_nbd_client.DEFAULT_QUEUE_DEPTH,
+                   server='python', tls=False, seed=0):
+    """
+    Run every benchmark for VDIs of each of sizes bytes in directory, and
+    return their results
+    """
+    results = []
+    certificates = None
+    ca_cert = None
+    cert = ""
+    if tls:
+        certificates = os.path.join(directory, "certificates")
+        os.makedirs(certificates, exist_ok=True)
+        make_certificates(certificates)
+        ca_cert = os.path.join(certificates, 'ca-cert.pem')
+        # the host certificate followed by the CA that signed it, so that
+        # trusting it as get_nbd_info's certificate verifies the server
+        for name in ('server-cert.pem', 'ca-cert.pem'):
+            with open(os.path.join(certificates, name)) as pem:
+                cert += pem.read()
+    for size in sizes:
+        work = os.path.join(directory, "%d" % size)
+        os.makedirs(work, exist_ok=True)
+        base = os.path.join(work, "base.raw")
+        output = os.path.join(work, "output.raw")
+        write_random_vdi(base, size)
+        session = fake_session(size, density, run_length, cert, seed)
+        chain = []
+        with local_server(server, base, certificates):
+            results.append(measure('nbd_read', size, read_vdi, ca_cert,
+                                   queue_depth))
+            results.append(measure('export', size, export_increments,
+                                   session, work, increments, queue_depth,
+                                   chain))
+
+        def merge():
+            write_changed_blocks_to_base_VDI(base, chain[0][1], chain[0][0],
+                                             output)
+            return changed_bytes(chain[:1])
+
+        def restore():
+            restore_chain(base, chain, output)
+            return changed_bytes(chain)
+
+        results.append(measure('merge', size, merge))
+        results.append(measure('restore_chain', size, restore))
+        shutil.rmtree(work)
+    for result in results:
+        result.update(server=server, tls=tls, density=density,
+                      run_length=run_length)
+    return results
+
+
+def print_results(results):
+    print("%-14s %9s %11s %9s %10s"
+          % ("benchmark", "VDI MiB", "MiB moved", "MiB/s", "CPU s/GiB"))
+    for result in results:
+        print("%-14s %9d %11.1f %9.1f %10.2f"
+              % (result['benchmark'], result['vdi_size'] // (1024 * 1024),
+                 result['bytes'] / (1024 * 1024), result['mib_per_second'],
+                 result['cpu_seconds_per_gib']))
+
+
+def _result_key(result):
+    return (result['benchmark'], result['vdi_size'], result['server'],
+            result['tls'], result['density'], result['run_length'])
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Print how the throughput of results has changed since those of
+    baseline, and return whether any has fallen by more than tolerance
+    percent
+    """
+    previous = dict((_result_key(result), result) for result in baseline)
+    regressed = False
+    for result in results:
+        before = previous.get(_result_key(result))
+        if before is None or not before['mib_per_second']:
+            continue
+        change = (result['mib_per_second'] / before['mib_per_second'] - 1) \
+            * 100
+        flag = ""
+        if change < -tolerance:
+            regressed = True
+            flag = "  REGRESSION"
+        print("%-14s %9d %+8.1f%%%s"
+              % (result['benchmark'], result['vdi_size'] // (1024 * 1024),
+                 change, flag))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--directory', dest='directory',
+                        help='Scratch directory for the VDIs and changed '
+                             'blocks, by default a temporary one')
+    parser.add_argument('--sizes', dest='sizes', type=int, nargs='+',
+                        default=[256, 1024], help='VDI sizes, in MiB')
+    parser.add_argument('--density', dest='density', type=float,
+                        default=0.1,
+                        help='Fraction of blocks changed in each increment')
+    parser.add_argument('--run-length', dest='run_length', type=float,
+                        default=16,
+                        help='Average number of changed blocks in a row')
+    parser.add_argument('--increments', dest='increments', type=int,
+                        default=2, help='Number of increments to export')
+    parser.add_argument('-q', '--queue-depth', dest='queue_depth', type=int,
+                        default=new_nbd_client.DEFAULT_QUEUE_DEPTH,
+                        help='Number of NBD requests to keep in flight')
+    parser.add_argument('--server', dest='server', choices=servers,
+                        default='python', help='NBD server to benchmark '
+                                               'against')
+    parser.add_argument('--tls', dest='tls', action='store_const',
+                        const=True, default=False,
+                        help='Require TLS, with a generated CA')
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='Seed of the synthetic bitmaps')
+    parser.add_argument('--json', dest='json_path',
+                        help='Write the results to this file')
+    parser.add_argument('--baseline', dest='baseline',
+                        help='Results of an earlier run to compare with')
+    parser.add_argument('--tolerance', dest='tolerance', type=float,
+                        default=10,
+                        help='Percentage fall in throughput from the '
+                             'baseline counted as a regression')
+    args = parser.parse_args()
+    if args.increments < 1:
+        parser.error("--increments must be at least 1")
+
+    directory = args.directory
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix="cbt_benchmark.")
+    else:
+        os.makedirs(directory, exist_ok=True)
+    try:
+        results = run_benchmarks(directory,
+                                 [size * 1024 * 1024 for size in args.sizes],
+                                 args.density, args.run_length,
+                                 args.increments, args.queue_depth,
+                                 args.server, args.tls, args.seed)
+    finally:
+        if args.directory is None:
+            shutil.rmtree(directory)
+    print_results(results)
+    if args.json_path:
+        with open(args.json_path, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            if compare_results(results, json.load(baseline), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+"""
+Decoding of the changed block bitmaps returned by VDI.list_changed_blocks.
+
+The bitmap is base64 encoded and holds one bit per 64KB block, most
+significant bit first. Rather than walking it a bit at a time, it is decoded
+straight from the packed bytes: runs of 0x00 and 0xff bytes, unchanged and
+changed blocks, are skipped with a regular expression searching the bytes
+in C, and the runs of changed blocks within the other bytes are looked up in
+a table of the runs of set bits in each of the 256 byte values. No Python
+code runs per block, and only the bytes where a run starts or ends are
+looked at in Python.
+
+The bitmap files written next to each set of changed blocks use a small
+versioned binary format:
+
+    header   magic b"CBTBITMP", format version, flags, block size, VDI size,
+             number of bits, number of extents and a CRC32 of everything
+             after the header (struct ">8sHHIQQQI"); the low byte of the
+             flags identifies the compression used (see cbt_compress.py)
+    bits     the packed bitmap, (number of bits + 7) // 8 bytes
+    extents  one ">QQQQI" entry per extent of changed blocks: offset and
+             length on the VDI, offset and length of its data in the changed
+             blocks file, and flags
+
+The extent index lets readers find the data of any changed block without
+scanning the bitmap. Extents flagged with EXTENT_ZERO contain nothing but
+zeros; none of their data is stored, and the space they would take up in
+an uncompressed changed blocks file is left as a hole. The data of extents
+flagged with EXTENT_COMPRESSED is compressed and only data_length bytes
+long; in a compressed file the data of the extents is packed back to back.
+"""
+
+import base64
+import collections
+import mmap
+import os
+import re
+import struct
+import zlib
+
+# CBT tracks 64KB blocks. Therefore each bit in the bitmap corresponds to a
+# 64KB block on the VDI.
+changed_block_size = 64 * 1024
+
+# Bytes other than 0x00, where a run of changed blocks may start, and other
+# than 0xff, where one may end
+_not_unchanged = re.compile(b'[^\x00]')
+_not_changed = re.compile(b'[^\xff]')
+
+
+def _set_bit_runs(value):
+    # (start, end) bit positions of the runs of set bits in a byte, most
+    # significant bit first
+    runs = []
+    for bit in range(8):
+        if value & (0x80 >> bit):
+            if runs and runs[-1][1] == bit:
+                runs[-1][1] = bit + 1
+            else:
+                runs.append([bit, bit + 1])
+    return tuple((start, end) for (start, end) in runs)
+
+
+_byte_runs = [_set_bit_runs(value) for value in range(256)]
+
+BITMAP_MAGIC = b'CBTBITMP'
+BITMAP_FORMAT_VERSION = 1
+_header = struct.Struct('>8sHHIQQQI')
+_extent = struct.Struct('>QQQQI')
+
+# An extent of changed blocks: where it is on the VDI and where its data is
+# in the changed blocks file
+Extent = collections.namedtuple(
+    'Extent', ['offset', 'length', 'data_offset', 'data_length', 'flags'])
+
+# Extent flags
+EXTENT_ZERO = 1 << 0
+EXTENT_COMPRESSED = 1 << 1
+
+BitmapFile = collections.namedtuple(
+    'BitmapFile', ['block_size', 'vdi_size', 'bit_count', 'bits', 'extents',
+                   'flags'])
+
+
+def decode_bitmap(encoded):
+    """Return the packed bits of a base64 encoded list_changed_blocks result"""
+    return base64.b64decode(encoded)
+
+
+def changed_block_runs(bits):
+    """
+    Yield (first_block, block_count) for every run of changed blocks in the
+    packed bits, in block order.
+    """
+    run_start = None
+    position = 0
+    while True:
+        if run_start is None:
+            match = _not_unchanged.search(bits, position)
+        else:
+            match = _not_changed.search(bits, position)
+        if match is None:
+            if run_start is not None:
+                yield (run_start, len(bits) * 8 - run_start)
+            return
+        position = match.start()
+        runs = _byte_runs[bits[position]]
+        if run_start is not None:
+            # the run carried over from the bytes before ends in this one
+            if runs and runs[0][0] == 0:
+                yield (run_start, position * 8 + runs[0][1] - run_start)
+                runs = runs[1:]
+            else:
+                yield (run_start, position * 8 - run_start)
+            run_start = None
+        for (start, end) in runs:
+            if end == 8:
+                run_start = position * 8 + start
+            else:
+                yield (position * 8 + start, end - start)
+        position += 1
+
+
+def changed_extents(bits, block_size=changed_block_size, max_length=None):
+    """
+    Return the runs of changed blocks in the packed bits as a list of
+    (offset, length) byte extents, in offset order. Runs longer than
+    max_length bytes are split into several extents.
+    """
+    blocks_per_extent = None
+    if max_length:
+        blocks_per_extent = max(1, max_length // block_size)
+    extents = []
+    for (first_block, block_count) in changed_block_runs(bits):
+        step = blocks_per_extent or block_count
+        end_block = first_block + block_count
+        for start in range(first_block, end_block, step):
+            count = min(step, end_block - start)
+            extents.append((start * block_size, count * block_size))
+    return extents
+
+
+def write_bitmap_file(path, bits, block_size, vdi_size, extents, flags=0):
+    """
+    Write the packed bits and Extent index of a set of changed blocks to
+    path. The file is written under a temporary name and renamed into place,
+    so an existing file is replaced rather than appended to and a reader
+    never sees a partial one.
+    """
+    payload = bytearray(bits)
+    for extent in extents:
+        payload += _extent.pack(*extent)
+    header = _header.pack(BITMAP_MAGIC, BITMAP_FORMAT_VERSION, flags,
+                          block_size, vdi_size, len(bits) * 8, len(extents),
+                          zlib.crc32(payload))
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as bitmap_out:
+        bitmap_out.write(header)
+        bitmap_out.write(payload)
+        bitmap_out.flush()
+        os.fsync(bitmap_out.fileno())
+    os.replace(temp_path, path)
+
+
+def read_bitmap_file(path):
+    """Map a bitmap file written by write_bitmap_file and return a BitmapFile"""
+    with open(path, 'rb') as bitmap_in:
+        if os.fstat(bitmap_in.fileno()).st_size < _header.size:
+            raise ValueError("%s is not a CBT bitmap file" % path)
+        bitmap_map = mmap.mmap(bitmap_in.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        (magic, version, flags, block_size, vdi_size, bit_count,
+         extent_count, checksum) = _header.unpack_from(bitmap_map)
+        if magic != BITMAP_MAGIC:
+            raise ValueError("%s is not a CBT bitmap file" % path)
+        if version != BITMAP_FORMAT_VERSION:
+            raise ValueError("%s has unsupported format version %d"
+                             % (path, version))
+        bits_end = _header.size + (bit_count + 7) // 8
+        extents_end = bits_end + extent_count * _extent.size
+        if len(bitmap_map) != extents_end:
+            raise ValueError("%s is truncated" % path)
+        if zlib.crc32(bitmap_map[_header.size:]) != checksum:
+            raise ValueError("%s is corrupt: checksum mismatch" % path)
+        bits = bitmap_map[_header.size:bits_end]
+        extents = [Extent(*entry) for entry
+                   in _extent.iter_unpack(bitmap_map[bits_end:extents_end])]
+    finally:
+        bitmap_map.close()
+    return BitmapFile(block_size, vdi_size, bit_count, bits, extents, flags)
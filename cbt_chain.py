@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+"""
+A base VDI image plus an ordered chain of increments, each one a bitmap file
+and changed blocks file written by cbt_export_changes.py.
+
+The chain is resolved into a last-writer-wins map recording, for every block
+of the VDI, which file holds its most recent contents. The map is a
+bytearray with one byte per block, filled in with slice assignments from
+each increment's extent index, so building it runs no Python code per block.
+Runs of blocks with the same owner are then turned into Pieces, so every
+block of the restored VDI is read exactly once, from whichever file owns it.
+
+Compressed extents (see cbt_compress.py) cannot be read in part, so a piece
+of one carries the whole extent, which is decompressed once and sliced for
+each of its pieces.
+
+stream yields the restored VDI in order without writing it anywhere, so it
+can be sent straight to the host as the body of an import, and
+changed_pieces picks out just the runs a VDI already holding the base needs
+rewritten.
+"""
+
+import bisect
+import collections
+import os
+import re
+
+import cbt_bitmap
+import cbt_compress
+import cbt_io
+
+# Owners are stored in one byte per block, 0 being the base VDI
+max_increments = 255
+
+# A run of the VDI and where its contents live: source is 0 for the base VDI,
+# n for the nth increment or None if the run is all zeros, and source_offset
+# is the position in that file. extent is the compressed Extent the run is
+# part of, or None if the data is stored as it is.
+Piece = collections.namedtuple(
+    'Piece', ['offset', 'length', 'source', 'source_offset', 'extent'],
+    defaults=(None,))
+
+_owner_run = re.compile(rb'(.)\1*', re.S)
+_changed_run = re.compile(rb'1+')
+# Maps an owner to b'1' if an increment changed the block, b'0' if not
+_owner_changed = bytes.maketrans(bytes(range(256)), b'0' + b'1' * 255)
+
+
+class IncrementChain(object):
+
+    def __init__(self, base_path, increments):
+        """
+        increments is a list of (bitmap path, changed blocks path) pairs,
+        oldest first. base_path may be None if only the pieces owned by
+        the increments are going to be read.
+        """
+        if len(increments) > max_increments:
+            raise ValueError("at most %d increments can be restored at once"
+                             % max_increments)
+        if base_path is None and not increments:
+            raise ValueError("no base VDI or increments to restore")
+        if base_path is not None and cbt_compress.is_framed(base_path):
+            raise ValueError("%s is compressed, decompress it with "
+                             "cbt_compress.py first" % base_path)
+        self.paths = [base_path]
+        self.bitmaps = []
+        for (bitmap_path, changed_blocks_path) in increments:
+            self.bitmaps.append(cbt_bitmap.read_bitmap_file(bitmap_path))
+            self.paths.append(changed_blocks_path)
+        block_sizes = set(bitmap.block_size for bitmap in self.bitmaps)
+        if len(block_sizes) > 1:
+            raise ValueError("increments have different block sizes")
+        self.block_size = block_sizes.pop() if block_sizes \
+            else cbt_bitmap.changed_block_size
+        if self.bitmaps:
+            self.vdi_size = self.bitmaps[-1].vdi_size
+        else:
+            self.vdi_size = os.path.getsize(base_path)
+        self.codecs = [None] + [cbt_compress.bitmap_codec(bitmap)
+                                for bitmap in self.bitmaps]
+        self._decompressed = (None, None)
+        self._extent_offsets = [[extent.offset for extent in bitmap.extents]
+                                for bitmap in self.bitmaps]
+        self.pieces = self._resolve()
+
+    def _owners(self):
+        block_count = -(-self.vdi_size // self.block_size)
+        owners = bytearray(block_count)
+        for (source, bitmap) in enumerate(self.bitmaps, 1):
+            for extent in bitmap.extents:
+                first = extent.offset // self.block_size
+                count = -(-extent.length // self.block_size)
+                owners[first:first + count] = bytes([source]) * count
+        return owners
+
+    def _increment_pieces(self, source, offset, end):
+        extents = self.bitmaps[source - 1].extents
+        i = bisect.bisect_right(self._extent_offsets[source - 1], offset) - 1
+        for j in range(max(i, 0), len(extents)):
+            extent = extents[j]
+            if extent.offset >= end:
+                break
+            start = max(offset, extent.offset)
+            stop = min(end, extent.offset + extent.length)
+            if start >= stop:
+                continue
+            if extent.flags & cbt_bitmap.EXTENT_ZERO:
+                yield Piece(start, stop - start, None, None)
+            elif extent.flags & cbt_bitmap.EXTENT_COMPRESSED:
+                yield Piece(start, stop - start, source, None, extent)
+            else:
+                yield Piece(start, stop - start, source,
+                            extent.data_offset + start - extent.offset)
+
+    def _resolve(self):
+        pieces = []
+        for run in _owner_run.finditer(self._owners()):
+            source = run.group(1)[0]
+            offset = run.start() * self.block_size
+            end = min(run.end() * self.block_size, self.vdi_size)
+            if source == 0:
+                pieces.append(Piece(offset, end - offset, 0, offset))
+            else:
+                pieces.extend(self._increment_pieces(source, offset, end))
+        return pieces
+
+    def changed_pieces(self, extra_bits=()):
+        """
+        Return the pieces covering the blocks changed by the increments and
+        the blocks set in any of extra_bits, packed bitmaps such as those
+        returned by VDI.list_changed_blocks. To bring a VDI holding the base
+        up to the last increment only the first are needed; to roll back a
+        VDI which has changed since the last increment was taken, the
+        blocks it has changed since then must be given as well.
+        """
+        changed = self._owners().translate(_owner_changed)
+        for bits in extra_bits:
+            for (first, count) in cbt_bitmap.changed_block_runs(bits):
+                count = min(count, len(changed) - first)
+                if count > 0:
+                    changed[first:first + count] = b'1' * count
+        offsets = [piece.offset for piece in self.pieces]
+        pieces = []
+        for run in _changed_run.finditer(changed):
+            offset = run.start() * self.block_size
+            end = min(run.end() * self.block_size, self.vdi_size)
+            i = bisect.bisect_right(offsets, offset) - 1
+            for piece in self.pieces[max(i, 0):]:
+                if piece.offset >= end:
+                    break
+                start = max(offset, piece.offset)
+                stop = min(end, piece.offset + piece.length)
+                if start >= stop:
+                    continue
+                if piece.source_offset is not None:
+                    piece = piece._replace(source_offset=piece.source_offset +
+                                           start - piece.offset)
+                pieces.append(piece._replace(offset=start,
+                                             length=stop - start))
+        return pieces
+
+    def _open_sources(self):
+        return [open(path, 'rb') if path is not None else None
+                for path in self.paths]
+
+    def _close_sources(self, sources):
+        for source in sources:
+            if source is not None:
+                source.close()
+
+    def _decompressed_piece(self, sources, piece):
+        # Pieces of the same extent come one after another, so only the
+        # last extent decompressed needs to be kept
+        if self._decompressed[0] != (piece.source, piece.extent):
+            self._decompressed = ((piece.source, piece.extent),
+                                  cbt_compress.read_extent(
+                                      sources[piece.source].fileno(),
+                                      piece.extent,
+                                      self.codecs[piece.source]))
+        start = piece.offset - piece.extent.offset
+        return memoryview(self._decompressed[1])[start:start + piece.length]
+
+    def _copy_piece(self, sources, piece, output_fd, sparse=False):
+        if piece.extent is None:
+            cbt_io.copy_range(sources[piece.source].fileno(),
+                              piece.source_offset, output_fd, piece.offset,
+                              piece.length, sparse)
+        else:
+            os.pwrite(output_fd, self._decompressed_piece(sources, piece),
+                      piece.offset)
+
+    def _write_zeros(self, output_fd, piece):
+        offset = piece.offset
+        for chunk in cbt_io.zero_chunks(piece.length):
+            os.pwrite(output_fd, chunk, offset)
+            offset += len(chunk)
+
+    def _read_piece(self, sources, piece, chunk_size):
+        # Yields (offset, length, data) for a piece in chunks, with data None
+        # for zeros, including where the base VDI is shorter than the VDI
+        # has grown to
+        if piece.extent is not None:
+            yield (piece.offset, piece.length,
+                   self._decompressed_piece(sources, piece))
+            return
+        done = 0
+        while done < piece.length:
+            data = os.pread(sources[piece.source].fileno(),
+                            min(piece.length - done, chunk_size),
+                            piece.source_offset + done)
+            if not data:
+                yield (piece.offset + done, piece.length - done, None)
+                return
+            yield (piece.offset + done, len(data), data)
+            done += len(data)
+
+    def read_pieces(self, pieces, chunk_size=cbt_io.copy_chunk_size):
+        """
+        Yield (offset, length, data) for the contents of pieces, in chunks
+        of at most chunk_size bytes. data is None for runs of zeros, which
+        are not split up.
+        """
+        sources = self._open_sources()
+        self._decompressed = (None, None)
+        try:
+            for piece in pieces:
+                if piece.source is None:
+                    yield (piece.offset, piece.length, None)
+                    continue
+                for chunk in self._read_piece(sources, piece, chunk_size):
+                    yield chunk
+        finally:
+            self._close_sources(sources)
+
+    def stream(self, chunk_size=cbt_io.copy_chunk_size):
+        """
+        Yield the contents of the VDI as of the last increment, start to
+        end, as chunks of bytes of at most chunk_size
+        """
+        for (_, length, data) in self.read_pieces(self.pieces, chunk_size):
+            if data is None:
+                for chunk in cbt_io.zero_chunks(length):
+                    yield chunk
+            else:
+                yield data
+
+    def write_to(self, output_path, sparse=True):
+        """
+        Write the VDI as of the last increment to output_path, leaving
+        all-zero runs as holes unless sparse is False
+        """
+        sources = self._open_sources()
+        try:
+            with open(output_path, 'wb') as output:
+                output.truncate(self.vdi_size)
+                for piece in self.pieces:
+                    if piece.source is None:
+                        if not sparse:
+                            self._write_zeros(output.fileno(), piece)
+                        continue
+                    self._copy_piece(sources, piece, output.fileno(),
+                                     sparse and piece.source == 0)
+                output.flush()
+                os.fsync(output.fileno())
+        finally:
+            self._close_sources(sources)
+
+    def write_in_place(self):
+        """Write the blocks owned by the increments over the base VDI"""
+        sources = self._open_sources()
+        try:
+            with open(self.paths[0], 'r+b') as vdi:
+                if os.fstat(vdi.fileno()).st_size < self.vdi_size:
+                    vdi.truncate(self.vdi_size)
+                for piece in self.pieces:
+                    if piece.source == 0:
+                        continue
+                    if piece.source is None:
+                        cbt_io.punch_hole(vdi.fileno(), piece.offset,
+                                          piece.length)
+                        continue
+                    self._copy_piece(sources, piece, vdi.fileno())
+                vdi.flush()
+                os.fsync(vdi.fileno())
+        finally:
+            self._close_sources(sources)
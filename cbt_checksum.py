@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+"""
+Per-block checksums of exported VDIs and changed blocks, so a backup can be
+checked without comparing it with a second copy.
+
+While an export runs, every 64KB block is hashed with 128 bit BLAKE2b in a
+thread pool as its data arrives, and the hashes are written next to the
+output, at the path given by checksum_path, before the bitmap file that
+marks the export as complete. hashlib releases the GIL while hashing, so the
+pool keeps up with the transfer without holding it up, and the blocks are
+hashed straight from the NBD client's receive buffers, without copying them.
+The checksum file is
+
+    header   magic b"CBTCHKSM", format version, flags, block size, VDI size
+             and number of entries (struct ">8sHHIQQ")
+    entries  one ">Q16s" entry per block: block number and hash, in block
+             order
+
+A full export has an entry for every block of the VDI and a set of changed
+blocks one for every changed block, including those stored as holes.
+
+verify_increment checks the changed blocks file of an increment against
+its checksums, and spot_check compares randomly chosen blocks of a backup
+with the snapshot it was taken from, read over NBD. cbt_verify.py uses them,
+and also checks the VDI a base and chain of increments restore to.
+"""
+
+import bisect
+import collections
+import hashlib
+import os
+import random
+import struct
+import threading
+
+import cbt_bitmap
+import cbt_compress
+from cbt_bitmap import changed_block_size
+
+CHECKSUM_MAGIC = b'CBTCHKSM'
+CHECKSUM_FORMAT_VERSION = 1
+_checksum_header = struct.Struct('>8sHHIQQ')
+_checksum_entry = struct.Struct('>Q16s')
+
+# Number of pieces of data waiting in the hashing pool at once
+default_window = 16
+
+Checksums = collections.namedtuple(
+    'Checksums', ['block_size', 'vdi_size', 'hashes'])
+
+
+def block_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def checksum_path(path):
+    """Return where the checksums of the export at path are kept"""
+    return path + ".sums"
+
+
+def _hash_blocks(offset, data, block_size):
+    view = memoryview(data)
+    first = offset // block_size
+    return [(first + i // block_size, block_hash(view[i:i + block_size]))
+            for i in range(0, len(view), block_size)]
+
+
+class block_hasher(object):
+    """
+    Hashes the blocks of the data it is given in executor, keeping up to
+    window pieces of data in the pool. Data must start on a block boundary.
+    """
+
+    def __init__(self, executor, block_size=changed_block_size,
+                 window=default_window):
+        self.block_size = block_size
+        self._executor = executor
+        self._slots = threading.BoundedSemaphore(window)
+        self._lock = threading.Lock()
+        self._futures = []
+        self._hashes = []
+        self._zero_hashes = {}
+
+    def add(self, offset, data):
+        """
+        Hash data, found at offset on the VDI. data must not change until
+        the returned future is done.
+        """
+        self._slots.acquire()
+        future = self._executor.submit(_hash_blocks, offset, data,
+                                       self.block_size)
+        future.add_done_callback(lambda _: self._slots.release())
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def _zero_hash(self, length):
+        if length not in self._zero_hashes:
+            self._zero_hashes[length] = block_hash(bytes(length))
+        return self._zero_hashes[length]
+
+    def add_zeros(self, offset, length):
+        """Record length bytes of zeros at offset, without hashing them"""
+        end = offset + length
+        hashes = [(start // self.block_size,
+                   self._zero_hash(min(self.block_size, end - start)))
+                  for start in range(offset, end, self.block_size)]
+        with self._lock:
+            self._hashes.extend(hashes)
+
+    def hash_pieces(self, pieces):
+        """
+        Hash the data of the (Extent, data) pairs of pieces, with data None
+        for zeros, as they go by. The data may be in a pooled buffer which
+        is reused once the next pair is read, so it is hashed while the
+        pair is being handled and the next pair is only read once it has
+        been.
+        """
+        for (extent, data) in pieces:
+            if data is None:
+                self.add_zeros(extent.offset, extent.length)
+                yield (extent, data)
+                continue
+            future = self.add(extent.offset, data)
+            yield (extent, data)
+            future.result()
+
+    def hashes(self):
+        """Wait for the hashing to finish and return the hashes, in order"""
+        with self._lock:
+            (futures, hashes) = (list(self._futures), list(self._hashes))
+        for future in futures:
+            hashes.extend(future.result())
+        return sorted(hashes)
+
+
+class hashing_reader(object):
+    """
+    A file-like object reading from file, the whole of a VDI from the start,
+    and adding everything read to hasher a block at a time
+    """
+
+    def __init__(self, file, hasher):
+        self._file = file
+        self._hasher = hasher
+        self._offset = 0
+        self._pending = bytearray()
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._pending += data
+        # reads may end part way through a block
+        whole = len(self._pending) if not data else \
+            len(self._pending) // self._hasher.block_size \
+            * self._hasher.block_size
+        if whole:
+            self._hasher.add(self._offset, self._pending[:whole])
+            del self._pending[:whole]
+            self._offset += whole
+        return data
+
+
+def write_checksum_file(path, hashes, vdi_size, block_size=changed_block_size):
+    """
+    Write the (block number, hash) pairs of hashes to path, under a temporary
+    name renamed into place
+    """
+    temporary_path = path + ".tmp"
+    with open(temporary_path, 'wb') as checksums:
+        checksums.write(_checksum_header.pack(
+            CHECKSUM_MAGIC, CHECKSUM_FORMAT_VERSION, 0, block_size, vdi_size,
+            len(hashes)))
+        checksums.write(b''.join(_checksum_entry.pack(block, hash_value)
+                                 for (block, hash_value) in hashes))
+        checksums.flush()
+        os.fsync(checksums.fileno())
+    os.replace(temporary_path, path)
+
+
+def read_checksum_file(path):
+    with open(path, 'rb') as checksums:
+        data = checksums.read()
+    if len(data) < _checksum_header.size:
+        raise ValueError("%s is not a checksum file" % path)
+    (magic, version, _, block_size, vdi_size, count) = \
+        _checksum_header.unpack_from(data)
+    if magic != CHECKSUM_MAGIC:
+        raise ValueError("%s is not a checksum file" % path)
+    if version != CHECKSUM_FORMAT_VERSION:
+        raise ValueError("%s has unsupported format version %d"
+                         % (path, version))
+    if len(data) != _checksum_header.size + count * _checksum_entry.size:
+        raise ValueError("%s is truncated" % path)
+    return Checksums(block_size, vdi_size, dict(_checksum_entry.iter_unpack(
+        memoryview(data)[_checksum_header.size:])))
+
+
+def hash_changed_blocks(hasher, changed_blocks_path, extents, codec=None):
+    """
+    Hash the extents of a changed blocks file that were saved already, such
+    as those of an export being resumed
+    """
+    if not extents:
+        return
+    with open(changed_blocks_path, 'rb') as changed_blocks:
+        for extent in extents:
+            if extent.flags & cbt_bitmap.EXTENT_ZERO:
+                hasher.add_zeros(extent.offset, extent.length)
+            else:
+                hasher.add(extent.offset, cbt_compress.read_extent(
+                    changed_blocks.fileno(), extent, codec))
+
+
+class increment_reader(object):
+    """Reads the blocks of the VDI held by one increment"""
+
+    def __init__(self, bitmap_path, changed_blocks_path):
+        self.bitmap = cbt_bitmap.read_bitmap_file(bitmap_path)
+        self.block_size = self.bitmap.block_size
+        self._codec = cbt_compress.bitmap_codec(self.bitmap)
+        self._offsets = [extent.offset for extent in self.bitmap.extents]
+        self._fd = os.open(changed_blocks_path, os.O_RDONLY)
+
+    def close(self):
+        os.close(self._fd)
+
+    def blocks(self):
+        """Return the numbers of the blocks the increment holds"""
+        return [block for extent in self.bitmap.extents
+                for block in range(extent.offset // self.block_size,
+                                   -(-(extent.offset + extent.length)
+                                     // self.block_size))]
+
+    def read_extent(self, extent):
+        if extent.flags & cbt_bitmap.EXTENT_ZERO:
+            return bytes(extent.length)
+        return cbt_compress.read_extent(self._fd, extent, self._codec)
+
+    def read_block(self, block):
+        offset = block * self.block_size
+        extent = self.bitmap.extents[
+            bisect.bisect_right(self._offsets, offset) - 1]
+        start = offset - extent.offset
+        length = min(self.block_size, extent.length - start)
+        if extent.flags & cbt_bitmap.EXTENT_ZERO:
+            return bytes(length)
+        if extent.flags & cbt_bitmap.EXTENT_COMPRESSED:
+            return self.read_extent(extent)[start:start + length]
+        return os.pread(self._fd, length, extent.data_offset + start)
+
+
+def _check(hashes, expected):
+    # Returns the blocks of hashes which differ from, or are missing from,
+    # the expected hashes
+    return [block for (block, hash_value) in hashes
+            if expected.get(block) != hash_value]
+
+
+def verify_increment(bitmap_path, changed_blocks_path, executor):
+    """
+    Check every block of an increment against its checksums, reading its
+    extents in parallel in executor. Returns the numbers of the blocks
+    which do not match.
+    """
+    checksums = read_checksum_file(checksum_path(changed_blocks_path))
+    reader = increment_reader(bitmap_path, changed_blocks_path)
+    try:
+        if checksums.block_size != reader.block_size:
+            raise ValueError("%s has a different block size"
+                             % checksum_path(changed_blocks_path))
+
+        def verify_extent(extent):
+            return _check(_hash_blocks(extent.offset,
+                                       reader.read_extent(extent),
+                                       reader.block_size), checksums.hashes)
+
+        bad = []
+        for blocks in executor.map(verify_extent, reader.bitmap.extents):
+            bad.extend(blocks)
+        return bad
+    finally:
+        reader.close()
+
+
+def chain_checksums(base_path, increments):
+    """
+    Return the expected hash of every block of the VDI a chain restores to,
+    as a dict, from the checksums of the increments and of the base VDI if
+    it has any
+    """
+    expected = {}
+    paths = [changed_blocks_path for (_, changed_blocks_path) in increments]
+    if base_path is not None and os.path.exists(checksum_path(base_path)):
+        paths.insert(0, base_path)
+    for path in paths:
+        expected.update(read_checksum_file(checksum_path(path)).hashes)
+    return expected
+
+
+def spot_check(client, read_block, blocks, count,
+               block_size=changed_block_size, rng=random):
+    """
+    Read count of blocks, a sequence such as a range, chosen at random, with
+    read_block and with the NBD client of the snapshot the backup was taken
+    from, and return the numbers of those that differ
+    """
+    size = client.size()
+    # sampled without building a list of every block of the VDI
+    chosen = rng.sample(blocks, min(count, len(blocks)))
+    bad = []
+    for block in sorted(chosen):
+        offset = block * block_size
+        length = min(block_size, size - offset)
+        if bytes(client.read(offset, length)) != bytes(read_block(block)):
+            bad.append(block)
+    return bad
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+
+"""
+Compression of changed blocks files and full VDI exports.
+
+Data is compressed an extent at a time, so any extent can still be read on
+its own during a merge or restore. In a compressed changed blocks file the
+data of the extents is stored back to back, in the order it was written,
+with each extent's data_offset pointing at it. A compressed extent is
+flagged EXTENT_COMPRESSED with its compressed size as data_length; extents
+that do not get any smaller are stored as they are, and all-zero extents
+take no space at all. The file is therefore only as big as the compressed
+data, even to tools that know nothing of sparse files. The codec is
+recorded in the flags of the bitmap file header.
+
+Full exports, which have no bitmap file, are written as a stream of frames
+instead:
+
+    header  magic b"CBTFRAME", format version, codec and size of the VDI
+            (struct ">8sHHQ")
+    frames  for every chunk of the VDI that is not all zeros, its offset,
+            length, stored length and flags (struct ">QIII") followed by
+            the stored data
+
+zlib is always available; zstd and lz4 need the zstandard and lz4 packages.
+Compression runs in a thread pool (all three codecs release the GIL) while
+the caller goes on receiving data.
+
+example: python cbt_compress.py -i <compressed VDI path> -o <VDI path>
+
+decompresses a full export written with --compress to a plain VDI image.
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import os
+import struct
+import threading
+import zlib
+
+import cbt_io
+from cbt_bitmap import Extent, EXTENT_COMPRESSED, EXTENT_ZERO
+
+FRAMED_MAGIC = b'CBTFRAME'
+FRAMED_FORMAT_VERSION = 1
+_framed_header = struct.Struct('>8sHHQ')
+_frame = struct.Struct('>QIII')
+
+# Number of extents being compressed at once by compress_pieces
+default_window = 16
+
+
+class _codec(object):
+
+    def __init__(self, codec_id, name, compress, decompress):
+        self.codec_id = codec_id
+        self.name = name
+        self.compress = compress
+        # decompress(data, length) where length is the uncompressed length
+        self.decompress = decompress
+
+
+def _zlib_codec():
+    return _codec(1, 'zlib', lambda data: zlib.compress(data, 6),
+                  lambda data, length: zlib.decompress(data, bufsize=length))
+
+
+def _zstd_codec():
+    import zstandard
+    # zstandard contexts must not be shared between threads
+    contexts = threading.local()
+
+    def compress(data):
+        if not hasattr(contexts, 'compressor'):
+            contexts.compressor = zstandard.ZstdCompressor(level=3)
+        return contexts.compressor.compress(data)
+
+    def decompress(data, length):
+        if not hasattr(contexts, 'decompressor'):
+            contexts.decompressor = zstandard.ZstdDecompressor()
+        return contexts.decompressor.decompress(data, max_output_size=length)
+
+    return _codec(2, 'zstd', compress, decompress)
+
+
+def _lz4_codec():
+    import lz4.frame
+    return _codec(3, 'lz4', lz4.frame.compress,
+                  lambda data, length: lz4.frame.decompress(data))
+
+
+_codecs = {'zlib': _zlib_codec, 'zstd': _zstd_codec, 'lz4': _lz4_codec}
+_codec_names = {1: 'zlib', 2: 'zstd', 3: 'lz4'}
+codec_names = sorted(_codecs)
+
+
+def get_codec(name):
+    """Return the codec called name, or None if name is None or 'none'"""
+    if name is None or name == 'none':
+        return None
+    if name not in _codecs:
+        raise ValueError("unknown compression '%s'" % name)
+    try:
+        return _codecs[name]()
+    except ImportError as e:
+        raise ImportError("%s compression needs the %s Python package"
+                          % (name, e.name))
+
+
+def codec_by_id(codec_id):
+    """Return the codec with the id stored in a file, None for id 0"""
+    if codec_id == 0:
+        return None
+    if codec_id not in _codec_names:
+        raise ValueError("unknown compression id %d" % codec_id)
+    return get_codec(_codec_names[codec_id])
+
+
+def bitmap_codec(bitmap):
+    """Return the codec the extents of a cbt_bitmap.BitmapFile use"""
+    return codec_by_id(bitmap.flags & 0xff)
+
+
+def new_executor(threads=None):
+    return concurrent.futures.ThreadPoolExecutor(threads or os.cpu_count())
+
+
+def _compress(codec, extent, data):
+    payload = codec.compress(data)
+    if len(payload) >= len(data):
+        return (extent, data)
+    return (extent._replace(data_length=len(payload),
+                            flags=extent.flags | EXTENT_COMPRESSED), payload)
+
+
+def compress_pieces(pieces, codec, executor, window=default_window):
+    """
+    Compress the data of (Extent, data) pairs in executor, with up to window
+    of them in flight, and yield them in the same order with their data
+    compressed and the Extents updated to match. Pairs with no data are
+    passed through. The data is copied before it is handed to the pool, so
+    it may be a buffer that is reused once the next pair has been taken.
+    """
+    pending = collections.deque()
+    for (extent, data) in pieces:
+        if data is None:
+            pending.append((extent, None))
+        else:
+            pending.append((None, executor.submit(_compress, codec, extent,
+                                                  bytes(data))))
+        while len(pending) > window:
+            yield _result(pending.popleft())
+    while pending:
+        yield _result(pending.popleft())
+
+
+def _result(entry):
+    (extent, future) = entry
+    if future is None:
+        return (extent, None)
+    return future.result()
+
+
+class packed_writer(object):
+    """
+    Writes the data of the extents of a compressed changed blocks file back
+    to back to fd, from start on. Safe to use from several threads.
+    """
+
+    def __init__(self, fd, start=0):
+        self.fd = fd
+        self.end = start
+        self._lock = threading.Lock()
+
+    def write(self, extent, data):
+        """
+        Write data at the end of what has been written so far, and return
+        extent with its data_offset pointing there
+        """
+        with self._lock:
+            offset = self.end
+            self.end += len(data)
+        os.pwrite(self.fd, data, offset)
+        return extent._replace(data_offset=offset)
+
+
+def packed_end(extents):
+    """
+    Return the end of the data of extents, those of a compressed changed
+    blocks file already written, where a packed_writer should carry on from
+    """
+    return max([extent.data_offset + extent.data_length
+                for extent in extents if not extent.flags & EXTENT_ZERO]
+               or [0])
+
+
+def read_extent(fd, extent, codec):
+    """Return the data of an extent of a changed blocks file"""
+    data = os.pread(fd, extent.data_length, extent.data_offset)
+    if extent.flags & EXTENT_COMPRESSED:
+        return codec.decompress(data, extent.length)
+    return data
+
+
+def copy_extent(fd, extent, codec, output_fd, output_offset=None):
+    """
+    Copy the data of an extent of a changed blocks file to output_offset
+    in output_fd, by default the extent's own offset on the VDI
+    """
+    if output_offset is None:
+        output_offset = extent.offset
+    if extent.flags & EXTENT_COMPRESSED:
+        os.pwrite(output_fd, read_extent(fd, extent, codec), output_offset)
+    else:
+        cbt_io.copy_range(fd, extent.data_offset, output_fd, output_offset,
+                          extent.length)
+
+
+def write_framed(source, destination, codec, executor,
+                 chunk_size=cbt_io.copy_chunk_size):
+    """
+    Compress the file-like object source into the file destination as a
+    stream of frames, leaving out all-zero chunks. Returns the number of
+    bytes read from source.
+    """
+    def chunks():
+        offset = 0
+        while True:
+            data = source.read(chunk_size)
+            if not data:
+                break
+            if not cbt_io.is_zero(data):
+                yield (Extent(offset, len(data), 0, len(data), 0), data)
+            offset += len(data)
+        size[0] = offset
+
+    size = [0]
+    destination.write(_framed_header.pack(FRAMED_MAGIC, FRAMED_FORMAT_VERSION,
+                                          codec.codec_id, 0))
+    for (extent, payload) in compress_pieces(chunks(), codec, executor):
+        destination.write(_frame.pack(extent.offset, extent.length,
+                                      len(payload), extent.flags))
+        destination.write(payload)
+    # the size is only known once the whole stream has been read
+    destination.seek(0)
+    destination.write(_framed_header.pack(FRAMED_MAGIC, FRAMED_FORMAT_VERSION,
+                                          codec.codec_id, size[0]))
+    destination.seek(0, os.SEEK_END)
+    return size[0]
+
+
+def is_framed(path):
+    with open(path, 'rb') as framed:
+        return framed.read(len(FRAMED_MAGIC)) == FRAMED_MAGIC
+
+
+def read_frames(path):
+    """
+    Yield the size of the VDI in a framed file, and then an (offset, data)
+    pair for each of its frames, decompressed
+    """
+    with open(path, 'rb') as framed:
+        header = framed.read(_framed_header.size)
+        if len(header) < _framed_header.size:
+            raise ValueError("%s is not a compressed VDI" % path)
+        (magic, version, codec_id, size) = _framed_header.unpack(header)
+        if magic != FRAMED_MAGIC:
+            raise ValueError("%s is not a compressed VDI" % path)
+        if version != FRAMED_FORMAT_VERSION:
+            raise ValueError("%s has unsupported format version %d"
+                             % (path, version))
+        codec = codec_by_id(codec_id)
+        yield size
+        while True:
+            frame = framed.read(_frame.size)
+            if not frame:
+                return
+            if len(frame) < _frame.size:
+                raise ValueError("%s is truncated" % path)
+            (offset, length, stored_length, flags) = _frame.unpack(frame)
+            data = framed.read(stored_length)
+            if len(data) < stored_length:
+                raise ValueError("%s is truncated" % path)
+            if flags & EXTENT_COMPRESSED:
+                data = codec.decompress(data, length)
+            yield (offset, data)
+
+
+def framed_size(path):
+    """Return the size of the VDI in a framed file"""
+    frames = read_frames(path)
+    try:
+        return next(frames)
+    finally:
+        frames.close()
+
+
+def iter_framed(path):
+    """
+    Yield the contents of the VDI in a framed file, start to end, as
+    chunks of bytes with the left out chunks filled in with zeros
+    """
+    frames = read_frames(path)
+    size = next(frames)
+    position = 0
+    for (offset, data) in frames:
+        for chunk in cbt_io.zero_chunks(offset - position):
+            yield chunk
+        yield data
+        position = offset + len(data)
+    for chunk in cbt_io.zero_chunks(size - position):
+        yield chunk
+
+
+def decompress_framed(path, output_path):
+    """Write the VDI in a framed file to output_path, leaving holes"""
+    frames = read_frames(path)
+    size = next(frames)
+    with open(output_path, 'wb') as output:
+        output.truncate(size)
+        for (offset, data) in frames:
+            os.pwrite(output.fileno(), data, offset)
+        output.flush()
+        os.fsync(output.fileno())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', dest='input')
+    parser.add_argument('-o', '--output', dest='output')
+    args = parser.parse_args()
+    decompress_framed(args.input, args.output)
+
+
+if __name__ == "__main__":
+    main()
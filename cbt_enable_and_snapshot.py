@@ -14,14 +14,40 @@ example: python cbt_enable_and_snapshot.py -ip <host address>
 -u <host username> -p <host password> -v <vdi uuid> -o <output path of VDI>
 
 Script will then print out the snapshot uuid before it returns. VDI is saved
-to the output path specified
+to the output path specified, with any all-zero regions left as holes.
+
+The snapshot is read over -n NBD connections at once, each reading its own
+ranges of the VDI and writing them straight to their place in the output
+file, with progress printed to stderr as it goes so that stdout only holds
+the snapshot uuid. With --http, or if the VDI cannot be reached over NBD, it
+is downloaded with a single export_raw_vdi HTTP request instead.
+
+With --compress zlib, zstd or lz4 the VDI is saved compressed instead (see
+cbt_compress.py); cbt_import_whole_vdi.py decompresses it as it uploads it.
+Compressed exports are always downloaded over HTTP.
+
+Either way, a hash of every 64KB block of the VDI is saved next to it, at
+<output path>.sums, for cbt_verify.py to check the backup against later
+(see cbt_checksum.py).
 """
 
 import XenAPI
-import shutil
 import urllib3
 import requests
 import argparse
+import sys
+import cbt_checksum
+import cbt_compress
+import cbt_io
+import cbt_metrics
+import cbt_nbd_pool
+import cbt_rate_limit
+import cbt_transfer
+from cbt_export_changes import default_max_request_size
+from nbd_client import new_nbd_client
+
+# Number of NBD connections a whole VDI is read over
+default_connections = 4
 
 
 def enable_nbd_on_all_networks(session):
@@ -31,7 +57,12 @@ def enable_nbd_on_all_networks(session):
         session.xenapi.network.add_purpose(network, connection_type)
 
 
-def export_vdi(host, session_id, vdi_uuid, file_format, export_path):
+def export_vdi(host, session_id, vdi_uuid, file_format, export_path,
+               compression=None, rate_limit=None):
+    """
+    Download the VDI to export_path, with the checksums of its blocks, and
+    return its size
+    """
     url = ('https://%s/export_raw_vdi?session_id=%s&vdi=%s&format=%s'
            % (host, session_id, vdi_uuid, file_format))
     with requests.Session() as session:
@@ -39,9 +70,59 @@ def export_vdi(host, session_id, vdi_uuid, file_format, export_path):
         # Depends on CP-23051.
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
         request = session.get(url, verify=False, stream=True)
-        with open(export_path, 'wb') as filehandle:
-            shutil.copyfileobj(request.raw, filehandle)
-        request.raise_for_status()
+        source = request.raw
+        if rate_limit is not None:
+            source = cbt_rate_limit.throttled_reader(source, rate_limit)
+        codec = cbt_compress.get_codec(compression)
+        with cbt_compress.new_executor() as executor:
+            hasher = cbt_checksum.block_hasher(executor)
+            source = cbt_checksum.hashing_reader(source, hasher)
+            with open(export_path, 'wb') as filehandle:
+                if codec is not None:
+                    size = cbt_compress.write_framed(source, filehandle,
+                                                     codec, executor)
+                else:
+                    # All-zero chunks become holes rather than being written
+                    # out
+                    size = cbt_io.copy_stream_sparse(source, filehandle)
+            request.raise_for_status()
+            cbt_checksum.write_checksum_file(
+                cbt_checksum.checksum_path(export_path), hasher.hashes(),
+                size)
+    return size
+
+
+def export_vdi_nbd(nbd_infos, vdi_size, export_path,
+                   connections=default_connections,
+                   queue_depth=new_nbd_client.DEFAULT_QUEUE_DEPTH,
+                   max_request_size=default_max_request_size,
+                   rate_limit=None):
+    """
+    Download the whole VDI described by nbd_infos, records returned by
+    VDI.get_nbd_info, to export_path over `connections` NBD connections
+    spread over their addresses, leaving all-zero blocks as holes, with the
+    checksums of its blocks. Returns the size of the VDI.
+    """
+    def connect(worker_index):
+        # the pool makes the first connection to an address before the
+        # others, which then resume its TLS session
+        return cbt_nbd_pool.get().connect(
+            nbd_infos[worker_index % len(nbd_infos)],
+            queue_depth=queue_depth, rate_limit=rate_limit,
+            metrics=cbt_metrics.get())
+
+    with cbt_compress.new_executor() as executor:
+        hasher = cbt_checksum.block_hasher(executor)
+        cbt_transfer.download_extents(
+            connect, cbt_transfer.whole_vdi_extents(vdi_size,
+                                                    max_request_size),
+            export_path, connections, detect_zeros=True, size=vdi_size,
+            progress=cbt_transfer.progress_reporter(vdi_size),
+            hasher=hasher)
+        cbt_checksum.write_checksum_file(
+            cbt_checksum.checksum_path(export_path), hasher.hashes(),
+            vdi_size)
+    return vdi_size
 
 
 def main():
@@ -51,7 +132,27 @@ def main():
     parser.add_argument('-p', '--password', dest='password')
     parser.add_argument('-v', '--vdi-uuid', dest='vdi_uuid')
     parser.add_argument('-o', '--output-path', dest='output_path')
+    parser.add_argument('--compress', dest='compression',
+                        choices=cbt_compress.codec_names, default=None,
+                        help='Save the VDI compressed, downloading it '
+                             'over HTTP')
+    parser.add_argument('-n', '--connections', dest='connections', type=int,
+                        default=default_connections,
+                        help='Number of NBD connections to export with')
+    parser.add_argument('-q', '--queue-depth', dest='queue_depth', type=int,
+                        default=new_nbd_client.DEFAULT_QUEUE_DEPTH,
+                        help='Number of NBD requests to keep in flight on '
+                             'each connection')
+    parser.add_argument('--http', dest='http', action='store_const',
+                        const=True, default=False,
+                        help='Download the VDI with a single HTTP request '
+                             'instead of over NBD')
+    parser.add_argument('--rate-limit', dest='rate_limit',
+                        help='JSON file of bandwidth and request rate limits, '
+                             'see cbt_rate_limit.py')
+    cbt_metrics.add_arguments(parser)
     args = parser.parse_args()
+    cbt_metrics.configure_from_args(args)
     session = XenAPI.Session("https://" + args.host, ignore_ssl=True)
     session.login_with_password(args.username, args.password, "0.1",
                                 "CBT example")
@@ -60,10 +161,34 @@ def main():
         enable_nbd_on_all_networks(session)
         vdi_ref = session.xenapi.VDI.get_by_uuid(args.vdi_uuid)
         session.xenapi.VDI.enable_cbt(vdi_ref)
-        snapshot_ref = session.xenapi.VDI.snapshot(vdi_ref)
-        export_vdi(args.host, session._session,
-                   session.xenapi.VDI.get_uuid(snapshot_ref), 'raw',
-                   args.output_path)
+        with cbt_metrics.phase('snapshot'):
+            snapshot_ref = session.xenapi.VDI.snapshot(vdi_ref)
+        nbd_infos = []
+        if not (args.http or args.compression):
+            nbd_infos = session.xenapi.VDI.get_nbd_info(snapshot_ref)
+            if not nbd_infos:
+                # stdout is kept for the snapshot uuid alone
+                print("VDI cannot be reached over NBD, exporting it over "
+                      "HTTP", file=sys.stderr)
+        if nbd_infos:
+            rate_limit = cbt_rate_limit.vdi_limiter(args.rate_limit, session,
+                                                    nbd_infos[0]['address'],
+                                                    vdi_ref)
+            vdi_size = int(session.xenapi.VDI.get_virtual_size(snapshot_ref))
+            with cbt_metrics.phase('export') as record:
+                record.bytes = export_vdi_nbd(nbd_infos, vdi_size,
+                                              args.output_path,
+                                              args.connections,
+                                              args.queue_depth,
+                                              rate_limit=rate_limit)
+        else:
+            rate_limit = cbt_rate_limit.vdi_limiter(args.rate_limit, session,
+                                                    args.host, vdi_ref)
+            with cbt_metrics.phase('export') as record:
+                record.bytes = export_vdi(
+                    args.host, session._session,
+                    session.xenapi.VDI.get_uuid(snapshot_ref), 'raw',
+                    args.output_path, args.compression, rate_limit)
         # Once you are done copying the blocks, delete the snapshot data
         session.xenapi.VDI.data_destroy(snapshot_ref)
         print(session.xenapi.VDI.get_uuid(snapshot_ref))
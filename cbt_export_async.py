@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+"""
+The changed blocks export of cbt_export_changes.py on asyncio, so a single
+process can export the changes of many VDIs at the same time.
+
+Every export shares one transfer_budget, which caps how many exports run at
+once, how many NBD reads are in flight across all of them, and how many
+bytes per second they read between them. The files written, checksums
+included, are the same as those written by cbt_export_changes.py.
+"""
+
+import asyncio
+import collections
+import os
+import time
+
+import cbt_bitmap
+import cbt_checksum
+import cbt_compress
+import cbt_metrics
+import cbt_nbd_pool
+import cbt_rate_limit
+import cbt_transfer
+from cbt_export_changes import (changed_block_size, default_max_request_size,
+                                get_changed_extents)
+from cbt_nbd_pool import get_cert_subject
+from nbd_client import new_nbd_client
+from nbd_client_async import open_nbd_client
+
+
+class transfer_budget(object):
+    """
+    Limits shared by every export in the process: at most max_exports
+    exports and max_requests NBD reads in flight at once, and at most
+    bandwidth bytes read per second, or no limit if bandwidth is None.
+    """
+
+    def __init__(self, max_exports=8, max_requests=64, bandwidth=None):
+        self.exports = asyncio.Semaphore(max_exports)
+        self.requests = asyncio.Semaphore(max_requests)
+        self.bandwidth = bandwidth
+        self._bucket = cbt_rate_limit.token_bucket(bandwidth)
+
+    async def consume(self, length):
+        """Wait until length more bytes can be read within the bandwidth"""
+        delay = self._bucket.reserve(length)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def split_unallocated_extents(client, extents):
+    """The asyncio version of cbt_transfer.split_unallocated_extents"""
+    if not extents or not client.can_block_status():
+        return extents
+    start = extents[0].offset
+    end = extents[-1].offset + extents[-1].length
+    runs = await client.block_status_extents(start, end - start)
+    return cbt_transfer.split_zero_ranges(
+        extents, list(cbt_transfer.zero_ranges(runs, changed_block_size)))
+
+
+async def get_changed_blocks(host, export_name, tls_subject, extents,
+                             ca_data, budget, queue_depth,
+                             skip_unallocated=False, rate_limit=None):
+    """
+    Yield (extent, data) for every one of extents in order, as
+    cbt_export_changes.get_changed_blocks does, keeping up to queue_depth
+    reads in flight. rate_limit is a cbt_rate_limit.limiter to read
+    within, on top of the budget.
+    """
+    print("connecting to NBD at %s" % host)
+    # the SSLContext of each host certificate is shared by every export
+    client = await open_nbd_client(host, export_name, tls_hostname=tls_subject,
+                                   queue_depth=queue_depth, ca_data=ca_data,
+                                   metrics=cbt_metrics.get(),
+                                   ssl_context=cbt_nbd_pool.get().ssl_context(
+                                       ca_data))
+    reads = collections.deque()
+    try:
+        if skip_unallocated:
+            extents = await split_unallocated_extents(client, extents)
+
+        async def read(extent):
+            async with budget.requests:
+                await budget.consume(extent.length)
+                if rate_limit is not None:
+                    await rate_limit.consume_async(extent.length)
+                return await client.read(extent.offset, extent.length)
+
+        extents = iter(extents)
+        while True:
+            while len(reads) < queue_depth:
+                extent = next(extents, None)
+                if extent is None:
+                    break
+                if extent.flags & cbt_bitmap.EXTENT_ZERO:
+                    reads.append((extent, None))
+                else:
+                    reads.append((extent,
+                                  asyncio.ensure_future(read(extent))))
+            if not reads:
+                break
+            (extent, task) = reads.popleft()
+            yield (extent, await task if task is not None else None)
+    finally:
+        for (_, task) in reads:
+            if task is not None:
+                task.cancel()
+        await client.close()
+
+
+async def download_changed_blocks(budget, bitmap, nbd_info, vdi_size,
+                                  changed_blocks_output_path,
+                                  bitmap_output_path,
+                                  queue_depth=new_nbd_client.
+                                  DEFAULT_QUEUE_DEPTH,
+                                  max_request_size=default_max_request_size,
+                                  detect_zeros=True, rate_limit=None):
+    """
+    Export the blocks changed in a base64 encoded bitmap from the NBD export
+    described by nbd_info, one of the records returned by
+    VDI.get_nbd_info, within budget, and write the changed blocks, checksum
+    and bitmap files. Returns the extents written.
+    """
+    async with budget.exports:
+        (bits, extents) = get_changed_extents(bitmap, max_request_size)
+        size = max([extent.data_offset + extent.length
+                    for extent in extents] or [0])
+        start = time.monotonic()
+        written = []
+        executor = cbt_compress.new_executor()
+        hasher = cbt_checksum.block_hasher(executor)
+        fd = os.open(changed_blocks_output_path,
+                     os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            blocks = get_changed_blocks(nbd_info['address'],
+                                        nbd_info['exportname'],
+                                        get_cert_subject(nbd_info['cert']),
+                                        extents, nbd_info['cert'], budget,
+                                        queue_depth, detect_zeros,
+                                        rate_limit)
+            async for (extent, data) in blocks:
+                if data is None:
+                    pieces = [(extent, None)]
+                elif detect_zeros:
+                    pieces = cbt_transfer.split_zero_extents(extent, data)
+                else:
+                    pieces = [(extent, data)]
+                for (piece, piece_data) in pieces:
+                    if piece_data is not None:
+                        # may wait for room in the hashing pool
+                        await asyncio.to_thread(hasher.add, piece.offset,
+                                                piece_data)
+                        await asyncio.to_thread(os.pwrite, fd, piece_data,
+                                                piece.data_offset)
+                    else:
+                        hasher.add_zeros(piece.offset, piece.length)
+                    written.append(piece)
+            await asyncio.to_thread(os.fsync, fd)
+            hashes = await asyncio.to_thread(hasher.hashes)
+        finally:
+            os.close(fd)
+            executor.shutdown(wait=False)
+        transferred = sum(extent.length for extent in extents)
+        cbt_transfer.report_throughput(transferred, time.monotonic() - start)
+        # The bitmap and its extent index are only written once all the
+        # changed blocks they describe, and their checksums, are on disk
+        await asyncio.to_thread(cbt_checksum.write_checksum_file,
+                                cbt_checksum.checksum_path(
+                                    changed_blocks_output_path),
+                                hashes, vdi_size)
+        await asyncio.to_thread(cbt_bitmap.write_bitmap_file,
+                                bitmap_output_path, bits, changed_block_size,
+                                vdi_size, written)
+    return written
+
+
+async def download_all(exports, budget):
+    """
+    Run download_changed_blocks for every tuple of arguments in exports,
+    the budget aside, all within the one budget. The tuples may go on past
+    the bitmap output path to any of the optional arguments. Returns a list
+    with the result of each export, or the exception it failed with, so one
+    VDI failing does not stop the others.
+    """
+    start = time.monotonic()
+    results = await asyncio.gather(
+        *[download_changed_blocks(budget, *export)
+          for export in exports],
+        return_exceptions=True)
+    transferred = sum(extent.length for result in results
+                      if not isinstance(result, BaseException)
+                      for extent in result)
+    cbt_transfer.report_throughput(transferred, time.monotonic() - start)
+    return results
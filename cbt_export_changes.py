@@ -16,91 +16,307 @@ example: python cbt_export_changes.py -ip <host address> -u <host username>
 
 Script will then print out the new snapshot uuid at the end. Changed blocks
 and bitmap are saved to the paths specified.
+
+If the export is interrupted, the snapshot data is kept and running the
+script again with the same arguments and --resume fetches only the changed
+blocks which had not been saved yet.
+
+With -r <repository path> the changed blocks are instead stored in a
+deduplicating repository (see cbt_repository.py), where blocks it already
+holds are not written again.
+
+With --compress zlib, zstd or lz4 the changed blocks are compressed an extent
+at a time as they are saved (see cbt_compress.py). The merge and restore
+scripts read the codec from the bitmap file and decompress as they go.
+
+A hash of every changed block is saved next to the changed blocks, at
+<changed blocks output path>.sums, for cbt_verify.py to check the increment
+against later (see cbt_checksum.py). With --spot-check N, N of the changed
+blocks chosen at random are read back from the new snapshot and compared
+with the ones saved before its data is destroyed.
+
+The host certificates returned by get_nbd_info are trusted from memory,
+and every connection is made through the pool of cbt_nbd_pool.py, which
+resumes the TLS session of the last connection to each host.
 """
 
 import XenAPI
-from nbd_client import new_nbd_client
-import base64
-from bitstring import BitStream
+from nbd_client import new_nbd_client, buffer_pool
+import cbt_bitmap
+import cbt_checksum
+import cbt_compress
+import cbt_journal
+import cbt_metrics
+import cbt_nbd_pool
+import cbt_rate_limit
+import cbt_repository
+import cbt_transfer
 import argparse
-import os
 import re
-import sys
+import time
+import zlib
 
 # CBT tracks 64KB blocks. Therefore each bit in the bitmap corresponds to a
 # 64KB block on the VDI.
 changed_block_size = 64 * 1024
-certfile = "cacert.pem"
+# Runs of adjacent changed blocks are read with a single NBD request of at
+# most this many bytes
+default_max_request_size = 4 * 1024 * 1024
 
 
-def get_cert_subject(cert_text):
-    from cryptography import x509
-    from cryptography.hazmat.backends import default_backend
-    cert = x509.load_pem_x509_certificate(cert_text.encode(), default_backend())
-    try:
-        value_types = [x509.DNSName, x509.GeneralName, x509.RFC822Name]
-        for value_type in value_types:
-            ext = cert.extensions.get_extension_for_oid(
-                          x509.ExtensionOID.SUBJECT_ALTERNATIVE_NAME)
-            cert_subject = ext.value.get_values_for_type(value_type)[0]
-            if cert_subject:
-                return cert_subject
-        raise Exception
-
-    except:
-        sub = cert.subject.get_attributes_for_oid(x509.NameOID.COMMON_NAME)
-        cert_subject = sub[0].value
-        if cert_subject:
-            return cert_subject
+def get_changed_extents(bitmap, max_request_size=default_max_request_size):
+    """
+    Return the Extents of changed blocks in a base64 encoded bitmap, laid out
+    back to back as they are in the changed blocks file, along with the
+    packed bits.
+    """
+    bits = cbt_bitmap.decode_bitmap(bitmap)
+    extents = cbt_bitmap.changed_extents(bits, changed_block_size,
+                                         max_request_size)
+    return (bits, cbt_transfer.layout_extents(extents))
+
+
+def get_changed_blocks(nbd_info, extents, queue_depth, skip_unallocated=False,
+                       rate_limit=None):
+    """
+    Yield (extent, data) for every one of extents in order, read from the
+    NBD export described by nbd_info, one of the records returned by
+    VDI.get_nbd_info, with data None for EXTENT_ZERO extents
+    """
+    print("connecting to NBD")
+    pool = cbt_nbd_pool.get()
+    client = pool.get(nbd_info, queue_depth=queue_depth,
+                      rate_limit=rate_limit, metrics=cbt_metrics.get())
+    print("size: %s" % client.size())
+    if skip_unallocated:
+        # Ranges the server reports as zeros are yielded without any data
+        extents = cbt_transfer.split_unallocated_extents(client, extents)
+    reads = [extent for extent in extents
+             if not extent.flags & cbt_bitmap.EXTENT_ZERO]
+
+    def dirty_extents():
+        for extent in reads:
+            yield (extent.offset, extent.length)
+
+    # Keep several reads in flight; the extents still come back in offset
+    # order. The changed blocks file is just the changed blocks back to back,
+    # so a coalesced extent can be written as it is without splitting it.
+    # The replies are received into pooled buffers, so each block's data is
+    # only valid until the next one is asked for.
+    replies = client.read_pipelined(dirty_extents(), pool=buffer_pool())
+    for extent in extents:
+        if extent.flags & cbt_bitmap.EXTENT_ZERO:
+            yield (extent, None)
         else:
-            print("Could not find the subject for the certificate. Exiting")
-            sys.exit(1)
+            (_, data) = next(replies)
+            yield (extent, data)
+    # kept open for whatever reads the export next
+    pool.put(nbd_info, client)
 
 
-def delete_host_certificates_file():
-    os.remove(certfile)
+def _changed_block_pieces(changed_blocks, detect_zeros):
+    for (extent, data) in changed_blocks:
+        if data is None:
+            yield (extent, None)
+        elif detect_zeros:
+            # All-zero blocks are left as holes and flagged in the index
+            for piece in cbt_transfer.split_zero_extents(extent, data):
+                yield piece
+        else:
+            yield (extent, data)
 
 
-def get_changed_blocks(host, export_name, tls_subject, bitmap, bitmap_output_path):
-    bitmap = BitStream(bytes=base64.b64decode(bitmap))
-    with open(bitmap_output_path, 'ab') as bit_out:
-        for bit in bitmap:
-            if int(bit) == 1 or int(bit) == 0:
-                # The bits are written in the form "0" and "1" to the file
-                bit_out.write(str(int(bit)).encode())
-    print("connecting to NBD")
-    client = new_nbd_client(host, export_name, certfile, tls_subject)
-    print("size: %s" % client.size())
-    for i in range(0, len(bitmap)):
-        if bitmap[i] == 1:
-            offset = i * changed_block_size
-            print("reading %d bytes from offset %d" % (changed_block_size,
-                                                       offset))
-            data = client.read(offset=offset, length=changed_block_size)
-            yield data
-    print("closing NBD")
-    client.close()
+def save_changed_blocks(changed_blocks, output_file, detect_zeros=True,
+                        journal=None, size=None, codec=None, hasher=None):
 
+    written = []
+    resume = journal is not None and journal.extents
+    # Unbuffered, so a checkpoint's fsync covers everything written so far
+    with open(output_file, 'r+b' if resume else 'wb', buffering=0) as out:
+        if journal is not None:
+            journal.data_fd = out.fileno()
+        try:
+            end = 0
+            pieces = _changed_block_pieces(changed_blocks, detect_zeros)
+            if hasher is not None:
+                pieces = hasher.hash_pieces(pieces)
+            writer = None
+            if codec is not None:
+                executor = cbt_compress.new_executor()
+                pieces = cbt_compress.compress_pieces(pieces, codec, executor)
+                # the compressed data is packed back to back
+                writer = cbt_compress.packed_writer(
+                    out.fileno(), cbt_compress.packed_end(
+                        journal.extents if resume else []))
+            for (piece, piece_data) in pieces:
+                if writer is not None and piece_data is not None:
+                    piece = writer.write(piece, piece_data)
+                elif piece_data is not None:
+                    out.seek(piece.data_offset)
+                    out.write(piece_data)
+                written.append(piece)
+                if journal is not None:
+                    journal.add([piece])
+                end = max(end, piece.data_offset + piece.length)
+            if writer is not None:
+                out.truncate(writer.end)
+            else:
+                out.truncate(end if size is None else size)
+        finally:
+            if codec is not None:
+                executor.shutdown()
+            if journal is not None:
+                # record what was saved, even if the export failed
+                journal.checkpoint()
+                journal.data_fd = None
+    return written
 
-def save_changed_blocks(changed_blocks, output_file):
 
-    with open(output_file, 'ab') as out:
-        for b in changed_blocks:
-            out.write(b)
+def download_changed_blocks_parallel(extents, nbd_infos,
+                                     changed_blocks_output_path, connections,
+                                     queue_depth, detect_zeros, journal=None,
+                                     size=None, codec=None, rate_limit=None,
+                                     hasher=None):
+    def connect(worker_index):
+        # Spread the connections over all the addresses we were given
+        nbd_info = nbd_infos[worker_index % len(nbd_infos)]
+        print("connecting to NBD at %s" % nbd_info['address'])
+        return cbt_nbd_pool.get().connect(nbd_info, queue_depth=queue_depth,
+                                          rate_limit=rate_limit,
+                                          metrics=cbt_metrics.get())
 
+    return cbt_transfer.download_extents(connect, extents,
+                                         changed_blocks_output_path,
+                                         connections,
+                                         detect_zeros=detect_zeros,
+                                         journal=journal, size=size,
+                                         codec=codec, hasher=hasher)
 
-def download_changed_blocks(bitmap, nbd_info, changed_blocks_output_path,
-                            bitmap_output_path):
+
+def fetch_changed_blocks(extents, nbd_infos, changed_blocks_output_path,
+                         queue_depth, connections, detect_zeros, journal,
+                         size, codec=None, rate_limit=None, hasher=None):
+    with cbt_metrics.phase('transfer') as record:
+        if connections > 1:
+            extents = download_changed_blocks_parallel(
+                extents, nbd_infos, changed_blocks_output_path, connections,
+                queue_depth, detect_zeros, journal, size, codec, rate_limit,
+                hasher)
+        else:
+            start = time.monotonic()
+            blocks = get_changed_blocks(nbd_infos[0], extents, queue_depth,
+                                        detect_zeros, rate_limit)
+            extents = save_changed_blocks(blocks, changed_blocks_output_path,
+                                          detect_zeros, journal, size, codec,
+                                          hasher)
+            transferred = sum(extent.length for extent in extents)
+            cbt_transfer.report_throughput(transferred,
+                                           time.monotonic() - start)
+        record.bytes = sum(extent.length for extent in extents)
+    return extents
+
+
+def download_changed_blocks(bitmap, nbd_infos, vdi_size,
+                            changed_blocks_output_path, bitmap_output_path,
+                            queue_depth=new_nbd_client.DEFAULT_QUEUE_DEPTH,
+                            max_request_size=default_max_request_size,
+                            connections=1, detect_zeros=True,
+                            snapshot_uuid=None, resume=False,
+                            compression=None, rate_limit=None):
 
     print("downloading changed blocks")
-    cert_text = nbd_info['cert']
-    with open(certfile, 'w') as cert_out:
-        cert_out.write(cert_text)
-    tls_subject = get_cert_subject(cert_text)
-    host = nbd_info['address']
-    uri = nbd_info['exportname']
-    blocks = get_changed_blocks(host, uri, tls_subject, bitmap, bitmap_output_path)
-    save_changed_blocks(blocks, changed_blocks_output_path)
+    (bits, extents) = get_changed_extents(bitmap, max_request_size)
+    size = max([extent.data_offset + extent.length
+                for extent in extents] or [0])
+    codec = cbt_compress.get_codec(compression)
+    # Completed extents are journalled as they are written, so that after an
+    # interruption the export can be resumed with only the rest to fetch
+    journal_path = cbt_journal.journal_path(changed_blocks_output_path)
+    journal_key = {'snapshot': snapshot_uuid, 'bitmap_crc': zlib.crc32(bits),
+                   'max_request_size': max_request_size,
+                   'detect_zeros': detect_zeros,
+                   'compression': codec.name if codec else None}
+    if resume:
+        journal = cbt_journal.ExportJournal.open(journal_path, journal_key)
+        done = journal.completed(extents)
+        remaining = journal.remaining(extents)
+        print("resuming export: %d of %d extents left to fetch"
+              % (len(remaining), len(extents)))
+        extents = remaining
+    else:
+        journal = cbt_journal.ExportJournal.create(journal_path, journal_key)
+        done = []
+    # Every block is hashed in a pool of threads as it arrives
+    executor = cbt_compress.new_executor()
+    hasher = cbt_checksum.block_hasher(executor)
+    try:
+        # the blocks saved before an interruption are hashed from the file
+        cbt_checksum.hash_changed_blocks(hasher, changed_blocks_output_path,
+                                         done, codec)
+        extents = done + fetch_changed_blocks(
+            extents, nbd_infos, changed_blocks_output_path, queue_depth,
+            connections, detect_zeros, journal, size, codec, rate_limit,
+            hasher)
+        hashes = hasher.hashes()
+    finally:
+        executor.shutdown()
+        journal.close()
+    # The bitmap and its extent index are only written once all the changed
+    # blocks they describe, and their checksums, are on disk
+    cbt_checksum.write_checksum_file(
+        cbt_checksum.checksum_path(changed_blocks_output_path), hashes,
+        vdi_size)
+    cbt_bitmap.write_bitmap_file(bitmap_output_path, bits, changed_block_size,
+                                 vdi_size, sorted(extents),
+                                 flags=codec.codec_id if codec else 0)
+    journal.remove()
+
+
+def download_changed_blocks_to_repository(bitmap, nbd_infos, vdi_size,
+                                          repository_path, name,
+                                          queue_depth=new_nbd_client.
+                                          DEFAULT_QUEUE_DEPTH,
+                                          max_request_size=
+                                          default_max_request_size,
+                                          rate_limit=None):
+    """
+    Store the changed blocks in the deduplicating repository at
+    repository_path under the manifest name, writing only the blocks it
+    does not already hold.
+    """
+    print("downloading changed blocks to repository")
+    (_, extents) = get_changed_extents(bitmap, max_request_size)
+    start = time.monotonic()
+    with cbt_metrics.phase('transfer') as record:
+        blocks = get_changed_blocks(nbd_infos[0], extents, queue_depth, True,
+                                    rate_limit)
+        with cbt_repository.Repository(repository_path) as repository:
+            repository.store_changed_blocks(blocks, name, vdi_size)
+        record.bytes = transferred = sum(extent.length for extent in extents)
+    cbt_transfer.report_throughput(transferred, time.monotonic() - start)
+
+
+def spot_check_changed_blocks(nbd_infos, changed_blocks_output_path,
+                              bitmap_output_path, count):
+    """
+    Compare count of the changed blocks saved, chosen at random, with the
+    snapshot they were read from, and raise an exception if any differ
+    """
+    reader = cbt_checksum.increment_reader(bitmap_output_path,
+                                           changed_blocks_output_path)
+    blocks = reader.blocks()
+    try:
+        # the connection the changed blocks were read with, if it is open
+        with cbt_nbd_pool.get().connection(nbd_infos[0]) as client:
+            bad = cbt_checksum.spot_check(client, reader.read_block, blocks,
+                                          count, reader.block_size)
+    finally:
+        reader.close()
+    if bad:
+        raise Exception("%d of the changed blocks checked differ from the "
+                        "snapshot, starting with block %d"
+                        % (len(bad), bad[0]))
+    print("spot check of %d changed blocks passed" % min(count, len(blocks)))
 
 
 def main():
@@ -114,7 +330,56 @@ def main():
                         dest='changed_blocks_output_path')
     parser.add_argument('-bo', '--bitmap-output-path',
                         dest='bitmap_output_path')
+    parser.add_argument('-q', '--queue-depth', dest='queue_depth', type=int,
+                        default=new_nbd_client.DEFAULT_QUEUE_DEPTH,
+                        help='Number of NBD requests to keep in flight')
+    parser.add_argument('-m', '--max-request-size', dest='max_request_size',
+                        type=int,
+                        default=default_max_request_size // (1024 * 1024),
+                        help='Largest NBD read to issue when coalescing '
+                             'adjacent changed blocks, in MiB')
+    parser.add_argument('-n', '--connections', dest='connections', type=int,
+                        default=1,
+                        help='Number of NBD connections to export with')
+    parser.add_argument('--all-addresses', dest='all_addresses',
+                        action='store_const', const=True, default=False,
+                        help='Spread the NBD connections over every address '
+                             'returned by get_nbd_info')
+    parser.add_argument('--no-sparse', dest='detect_zeros',
+                        action='store_const', const=False, default=True,
+                        help='Store all-zero blocks in the changed blocks file '
+                             'instead of leaving holes')
+    parser.add_argument('-r', '--repository', dest='repository',
+                        help='Store the changed blocks in this deduplicating '
+                             'repository, under a manifest named after the '
+                             'new snapshot, instead of in -co and -bo')
+    parser.add_argument('--resume', dest='resume', action='store_const',
+                        const=True, default=False,
+                        help='Finish an interrupted export to the same output '
+                             'paths, fetching only the blocks it had not '
+                             'saved yet')
+    parser.add_argument('--compress', dest='compression',
+                        choices=cbt_compress.codec_names, default=None,
+                        help='Compress the changed blocks file')
+    parser.add_argument('--rate-limit', dest='rate_limit',
+                        help='JSON file of bandwidth and request rate limits, '
+                             'see cbt_rate_limit.py')
+    parser.add_argument('--spot-check', dest='spot_check', type=int,
+                        default=0, metavar='N',
+                        help='Compare N changed blocks, chosen at random, '
+                             'with the new snapshot before destroying its '
+                             'data')
+    cbt_metrics.add_arguments(parser)
     args = parser.parse_args()
+    if args.resume and args.repository:
+        parser.error("--resume cannot be used with --repository, which "
+                     "already keeps every block stored before an "
+                     "interruption")
+    if args.compression and args.repository:
+        parser.error("--compress cannot be used with --repository")
+    if args.spot_check and args.repository:
+        parser.error("--spot-check cannot be used with --repository")
+    cbt_metrics.configure_from_args(args)
 
     session = XenAPI.Session("https://" + args.host, ignore_ssl=True)
     session.login_with_password(args.username, args.password, "0.1",
@@ -123,22 +388,62 @@ def main():
     try:
         vdi_ref = session.xenapi.VDI.get_by_uuid(args.vdi_uuid)
         last_snapshot_ref = session.xenapi.VDI.get_by_uuid(args.snapshot_uuid)
-        new_snapshot_ref = session.xenapi.VDI.snapshot(vdi_ref)
-        bitmap = session.xenapi.VDI.list_changed_blocks(last_snapshot_ref,
-                                                          new_snapshot_ref)
-        # get_nbd_info may return the details for multiple addresses, for this
-        # example we will just use the first one
-        nbd_info = session.xenapi.VDI.get_nbd_info(new_snapshot_ref)[0]
-        download_changed_blocks(bitmap, nbd_info,
-                        args.changed_blocks_output_path,
-                        args.bitmap_output_path)
+        if args.resume:
+            # carry on from the snapshot the interrupted export was taking
+            key = cbt_journal.read_journal_key(cbt_journal.journal_path(
+                args.changed_blocks_output_path))
+            new_snapshot_ref = session.xenapi.VDI.get_by_uuid(key['snapshot'])
+        else:
+            with cbt_metrics.phase('snapshot'):
+                new_snapshot_ref = session.xenapi.VDI.snapshot(vdi_ref)
+        new_snapshot_uuid = session.xenapi.VDI.get_uuid(new_snapshot_ref)
+        with cbt_metrics.phase('list_changed_blocks'):
+            bitmap = session.xenapi.VDI.list_changed_blocks(last_snapshot_ref,
+                                                              new_snapshot_ref)
+        # get_nbd_info may return the details for multiple addresses, unless
+        # asked to use all of them we will just use the first one
+        nbd_infos = session.xenapi.VDI.get_nbd_info(new_snapshot_ref)
+        if not args.all_addresses:
+            nbd_infos = nbd_infos[:1]
+        vdi_size = int(session.xenapi.VDI.get_virtual_size(new_snapshot_ref))
+        rate_limit = cbt_rate_limit.vdi_limiter(args.rate_limit, session,
+                                                nbd_infos[0]['address'],
+                                                vdi_ref)
+        if args.repository:
+            download_changed_blocks_to_repository(
+                bitmap, nbd_infos, vdi_size, args.repository,
+                new_snapshot_uuid, args.queue_depth,
+                args.max_request_size * 1024 * 1024, rate_limit)
+        else:
+            try:
+                download_changed_blocks(bitmap, nbd_infos, vdi_size,
+                                args.changed_blocks_output_path,
+                                args.bitmap_output_path, args.queue_depth,
+                                args.max_request_size * 1024 * 1024,
+                                args.connections, args.detect_zeros,
+                                new_snapshot_uuid, args.resume,
+                                args.compression, rate_limit)
+            except Exception:
+                # The snapshot data is kept so the export can be resumed
+                print("export of snapshot %s was interrupted, run again "
+                      "with --resume to finish it" % new_snapshot_uuid)
+                raise
+        if args.spot_check:
+            # raises, keeping the snapshot data, if the blocks saved are
+            # not those of the snapshot
+            spot_check_changed_blocks(nbd_infos,
+                                      args.changed_blocks_output_path,
+                                      args.bitmap_output_path,
+                                      args.spot_check)
         # Once you are done copying the blocks you want you can delete the
-        # snapshot data
+        # snapshot data, once nothing is connected to it
+        for nbd_info in nbd_infos:
+            cbt_nbd_pool.get().discard(nbd_info)
         session.xenapi.VDI.data_destroy(new_snapshot_ref)
-        print(session.xenapi.VDI.get_uuid(new_snapshot_ref))
+        print(new_snapshot_uuid)
     finally:
         session.xenapi.session.logout(session)
-        delete_host_certificates_file()
+        cbt_nbd_pool.get().close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+"""
+For a VDI which already holds the base VDI this script writes only the
+blocks changed by a chain of increments straight to the VDI over NBD, rather
+than uploading the whole VDI with cbt_import_whole_vdi.py, so a restore
+costs the size of the changes instead of the size of the disk.
+
+example: python cbt_import_changed_blocks.py -ip <host address>
+-u <host username> -p <host password> -v <vdi uuid>
+-i <bitmap path> <changed blocks path> -i <bitmap path> <changed blocks path>
+...
+
+The increments are given oldest first, and every block is written with its
+contents as of the last one.
+
+A VDI which has moved on since the last increment was taken, such as one
+being rolled back to the day before, also needs the blocks it has changed
+since then put back. Give the snapshot the last increment was taken from
+with -s and the base VDI with -f, and those blocks are written too, taken
+from the increments or from the base VDI.
+
+Writes are pipelined, and the VDI is flushed every --flush-interval MiB and
+at the end. The VDI must not be in use by a running VM while it is written.
+"""
+
+import XenAPI
+import argparse
+import time
+
+import cbt_bitmap
+import cbt_metrics
+import cbt_nbd_pool
+import cbt_rate_limit
+import cbt_transfer
+from cbt_chain import IncrementChain
+from nbd_client import new_nbd_client
+
+# Changed blocks are sent in NBD writes of at most this many bytes
+default_max_write_size = 4 * 1024 * 1024
+# The VDI is flushed after every this many bytes written
+default_flush_interval = 256 * 1024 * 1024
+
+
+def changed_block_writes(chain, pieces, max_write_size=default_max_write_size):
+    """
+    Yield the (offset, data) writes for pieces of chain, with data the
+    length of the run for runs of zeros
+    """
+    for (offset, length, data) in chain.read_pieces(pieces, max_write_size):
+        if data is not None:
+            yield (offset, data)
+            continue
+        end = offset + length
+        while offset < end:
+            count = min(end - offset, max_write_size)
+            yield (offset, count)
+            offset += count
+
+
+def _take(writes, byte_count):
+    # Yields writes until at least byte_count bytes have gone by
+    taken = 0
+    for (offset, data) in writes:
+        yield (offset, data)
+        taken += data if isinstance(data, int) else len(data)
+        if taken >= byte_count:
+            return
+
+
+def write_changed_blocks(client, writes, flush_interval=default_flush_interval):
+    """
+    Write every (offset, data) pair of writes with client, flushing every
+    flush_interval bytes and at the end. Returns the number of bytes
+    written.
+    """
+    writes = iter(writes)
+    written = 0
+    while True:
+        # the writes of a batch have all completed before its flush is sent
+        count = client.write_pipelined(_take(writes, flush_interval))
+        if not count:
+            return written
+        written += count
+        if not client.flush():
+            raise Exception("NBD flush failed")
+
+
+def import_changed_blocks(nbd_info, base_path, increments, extra_bits=(),
+                          queue_depth=new_nbd_client.DEFAULT_QUEUE_DEPTH,
+                          flush_interval=default_flush_interval,
+                          max_write_size=default_max_write_size,
+                          rate_limit=None):
+    """
+    Write the blocks changed by increments, and those set in extra_bits, to
+    the NBD export described by nbd_info, one of the records returned by
+    VDI.get_nbd_info. base_path is only needed with extra_bits.
+    """
+    if extra_bits and base_path is None:
+        raise ValueError("the base VDI is needed to put back blocks changed "
+                         "since the last increment")
+    chain = IncrementChain(base_path, increments)
+    pieces = chain.changed_pieces(extra_bits)
+    print("connecting to NBD at %s" % nbd_info['address'])
+    client = cbt_nbd_pool.get().connect(nbd_info, queue_depth=queue_depth,
+                                        rate_limit=rate_limit,
+                                        metrics=cbt_metrics.get())
+    try:
+        if client.size() < chain.vdi_size:
+            raise ValueError("VDI is %d bytes, smaller than the %d bytes "
+                             "being restored" % (client.size(),
+                                                 chain.vdi_size))
+        start = time.monotonic()
+        with cbt_metrics.phase('import') as record:
+            record.bytes = written = write_changed_blocks(
+                client, changed_block_writes(chain, pieces, max_write_size),
+                flush_interval)
+        cbt_transfer.report_throughput(written, time.monotonic() - start)
+    finally:
+        client.close()
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-ip', '--host-ip', dest='host')
+    parser.add_argument('-u', '--username', dest='username')
+    parser.add_argument('-p', '--password', dest='password')
+    parser.add_argument('-v', '--vdi-uuid', dest='vdi_uuid')
+    parser.add_argument('-i', '--increment', dest='increments',
+                        action='append', nargs=2, default=[],
+                        metavar=('BITMAP', 'CHANGED_BLOCKS'),
+                        help='Bitmap and changed blocks of an increment, '
+                             'repeated oldest first')
+    parser.add_argument('-s', '--snapshot-uuid', dest='snapshot_uuid',
+                        help='Snapshot the last increment was taken from; '
+                             'blocks the VDI has changed since are also '
+                             'written')
+    parser.add_argument('-f', '--filename', dest='base_path',
+                        help='Base VDI, needed with -s')
+    parser.add_argument('-q', '--queue-depth', dest='queue_depth', type=int,
+                        default=new_nbd_client.DEFAULT_QUEUE_DEPTH,
+                        help='Number of NBD writes to keep in flight')
+    parser.add_argument('--flush-interval', dest='flush_interval', type=int,
+                        default=default_flush_interval // (1024 * 1024),
+                        help='Flush the VDI after every this many MiB '
+                             'written')
+    parser.add_argument('--rate-limit', dest='rate_limit',
+                        help='JSON file of bandwidth and request rate limits, '
+                             'see cbt_rate_limit.py')
+    cbt_metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if args.snapshot_uuid and not args.base_path:
+        parser.error("-s needs the base VDI to be given with -f")
+    cbt_metrics.configure_from_args(args)
+
+    session = XenAPI.Session("https://" + args.host, ignore_ssl=True)
+    session.login_with_password(args.username, args.password, "0.1",
+                                "CBT example")
+
+    try:
+        vdi_ref = session.xenapi.VDI.get_by_uuid(args.vdi_uuid)
+        extra_bits = []
+        if args.snapshot_uuid:
+            snapshot_ref = session.xenapi.VDI.get_by_uuid(args.snapshot_uuid)
+            with cbt_metrics.phase('list_changed_blocks'):
+                extra_bits.append(cbt_bitmap.decode_bitmap(
+                    session.xenapi.VDI.list_changed_blocks(snapshot_ref,
+                                                           vdi_ref)))
+        nbd_infos = session.xenapi.VDI.get_nbd_info(vdi_ref)
+        if not nbd_infos:
+            raise Exception("VDI %s cannot be reached over NBD; is NBD "
+                            "enabled on any network?" % args.vdi_uuid)
+        rate_limit = cbt_rate_limit.vdi_limiter(args.rate_limit, session,
+                                                nbd_infos[0]['address'],
+                                                vdi_ref)
+        import_changed_blocks(nbd_infos[0], args.base_path, args.increments,
+                              extra_bits, args.queue_depth,
+                              args.flush_interval * 1024 * 1024,
+                              rate_limit=rate_limit)
+        print(args.vdi_uuid)
+    finally:
+        session.xenapi.session.logout(session)
+
+
+if __name__ == "__main__":
+    main()
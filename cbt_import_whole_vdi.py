@@ -7,12 +7,33 @@ version.
 
 example: python cbt_import_whole_vdi.py -ip <host address> -u <host username>
 -p <host password> -v <vdi uuid> -f <import VDI filename>
+
+A VDI exported with cbt_enable_and_snapshot.py --compress is decompressed on
+the fly while it is uploaded.
+
+Increments can be applied as the VDI is uploaded, instead of first writing
+the combined VDI with cbt_write_changed_blocks_to_base_VDI.py or
+cbt_restore_chain.py and then uploading that:
+
+example: python cbt_import_whole_vdi.py -ip <host address> -u <host username>
+-p <host password> -v <vdi uuid> -f <base VDI filename>
+-i <bitmap path> <changed blocks path> ...
+
+Each block is read from the latest increment that changed it, or otherwise
+from the base VDI, and sent straight to the host, so the combined VDI is
+never written to local disk.
 """
 
 import urllib3
 import requests
 import XenAPI
 import argparse
+import contextlib
+import os
+import cbt_compress
+import cbt_metrics
+import cbt_rate_limit
+from cbt_chain import IncrementChain
 
 def create_new_vdi(session, sr, size):
     vdi_record = {
@@ -29,16 +50,39 @@ def create_new_vdi(session, sr, size):
     return vdi_uuid
 
 
-def import_vdi(host, session_id, vdi_uuid, file_format, import_path):
+def import_vdi(host, session_id, vdi_uuid, file_format, import_path,
+               increments=None, rate_limit=None):
+    """
+    Upload the VDI at import_path, with the (bitmap path, changed blocks
+    path) pairs of increments, oldest first, applied on the way. Returns
+    the number of bytes sent.
+    """
     url = ('https://%s/import_raw_vdi?session_id=%s&vdi=%s&format=%s'
            % (host, session_id, vdi_uuid, file_format))
-    with open(import_path, 'rb') as filehandle:
+    if increments:
+        # Sent with chunked encoding, as the merged VDI is generated
+        chain = IncrementChain(import_path, increments)
+        size = chain.vdi_size
+        body = chain.stream()
+    elif cbt_compress.is_framed(import_path):
+        # Sent with chunked encoding, as the decompressed data is generated
+        size = cbt_compress.framed_size(import_path)
+        body = cbt_compress.iter_framed(import_path)
+    else:
+        size = os.path.getsize(import_path)
+        body = open(import_path, 'rb')
+    with contextlib.closing(body):
+        if rate_limit is not None and hasattr(body, 'read'):
+            body = cbt_rate_limit.throttled_reader(body, rate_limit)
+        elif rate_limit is not None:
+            body = cbt_rate_limit.throttled_chunks(body, rate_limit)
         # ToDo: Security - We need to verify the SSL certificate here.
         # Depends on CP-23051.
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
         with requests.Session() as session:
-            request = session.put(url, filehandle, verify=False)
+            request = session.put(url, body, verify=False)
             request.raise_for_status()
+    return size
 
 
 def main():
@@ -48,10 +92,21 @@ def main():
     parser.add_argument('-p', '--password', dest='password')
     parser.add_argument('-v', '--vdi-uuid', dest='vdi_uuid')
     parser.add_argument('-f', '--filename', dest='path')
+    parser.add_argument('-i', '--increment', dest='increments',
+                        action='append', nargs=2, default=[],
+                        metavar=('BITMAP', 'CHANGED_BLOCKS'),
+                        help='Bitmap and changed blocks of an increment to '
+                             'apply to the VDI as it is imported, repeated '
+                             'oldest first')
+    parser.add_argument('--rate-limit', dest='rate_limit',
+                        help='JSON file of bandwidth and request rate limits, '
+                             'see cbt_rate_limit.py')
     parser.add_argument('--as-new-vdi', dest='new_vdi', action='store_const',
                         const=True, default=False,
                         help='Create a new VDI for the import')
+    cbt_metrics.add_arguments(parser)
     args = parser.parse_args()
+    cbt_metrics.configure_from_args(args)
 
     session = XenAPI.Session("https://" + args.host, ignore_ssl=True)
     session.login_with_password(args.username, args.password, "0.1",
@@ -65,8 +120,13 @@ def main():
             sr_ref = session.xenapi.VDI.get_SR(vdi_ref)
             vdi_uuid = create_new_vdi(session, sr_ref, size)
 
-        import_vdi(args.host, session._session, vdi_uuid, 'raw',
-                   args.path)
+        rate_limit = cbt_rate_limit.vdi_limiter(
+            args.rate_limit, session, args.host,
+            session.xenapi.VDI.get_by_uuid(vdi_uuid))
+        with cbt_metrics.phase('import') as record:
+            record.bytes = import_vdi(args.host, session._session, vdi_uuid,
+                                      'raw', args.path, args.increments,
+                                      rate_limit)
         print(vdi_uuid)
     finally:
         session.xenapi.session.logout(session)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""
+File helpers shared by the merge and export scripts.
+
+Data is moved between files with os.copy_file_range where the kernel and
+filesystem support it, so it does not have to pass through Python, and
+whole images are cloned with the FICLONE ioctl on filesystems that support
+reflinks (btrfs, XFS). Both fall back to plain reads and writes.
+
+All-zero data is recognised by comparing it with a shared buffer of zeros
+using bytes.startswith, which is a memcmp and copies nothing, and is left
+out of the output as holes which read back as zeros (and show up with
+SEEK_HOLE) instead of being written.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import functools
+import os
+
+# ioctl request number of FICLONE from linux/fs.h
+FICLONE = 0x40049409
+
+# Largest piece copied with a single system call
+copy_chunk_size = 4 * 1024 * 1024
+
+# Every all-zero check compares against this buffer
+zero_buffer = bytes(copy_chunk_size)
+
+# fallocate modes from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+_copy_file_range_errors = (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                           errno.EOPNOTSUPP, errno.EBADF)
+
+
+def _pread_pwrite(source_fd, source_offset, destination_fd,
+                  destination_offset, length):
+    copied = 0
+    while copied < length:
+        data = os.pread(source_fd, min(length - copied, copy_chunk_size),
+                        source_offset + copied)
+        if not data:
+            break
+        os.pwrite(destination_fd, data, destination_offset + copied)
+        copied += len(data)
+    return copied
+
+
+def is_zero(data):
+    """Whether the bytes-like object data is all zeros"""
+    view = memoryview(data)
+    for start in range(0, len(view), len(zero_buffer)):
+        if not zero_buffer.startswith(view[start:start + len(zero_buffer)]):
+            return False
+    return True
+
+
+def zero_chunks(length):
+    """Yield length bytes of zeros as chunks of at most copy_chunk_size"""
+    while length > 0:
+        count = min(length, len(zero_buffer))
+        yield memoryview(zero_buffer)[:count]
+        length -= count
+
+
+def zero_runs(data, block_size):
+    """
+    Split data into pieces of block_size bytes and yield (start, end, zero)
+    for every run of pieces that are all zeros, or all not.
+    """
+    if is_zero(data):
+        yield (0, len(data), True)
+        return
+    view = memoryview(data)
+    run_start = 0
+    run_zero = None
+    for start in range(0, len(view), block_size):
+        zero = is_zero(view[start:start + block_size])
+        if run_zero is None:
+            run_zero = zero
+        elif zero != run_zero:
+            yield (run_start, start, run_zero)
+            (run_start, run_zero) = (start, zero)
+    if run_zero is not None:
+        yield (run_start, len(view), run_zero)
+
+
+@functools.lru_cache(maxsize=None)
+def _fallocate():
+    library = ctypes.util.find_library('c')
+    if library is None:
+        return None
+    fallocate = getattr(ctypes.CDLL(library, use_errno=True), 'fallocate',
+                        None)
+    if fallocate is not None:
+        fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                              ctypes.c_int64]
+    return fallocate
+
+
+def punch_hole(fd, offset, length):
+    """
+    Make a range of a file read back as zeros, deallocating it where the
+    filesystem supports punching holes and writing zeros otherwise.
+    """
+    fallocate = _fallocate()
+    if fallocate is not None and \
+            fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                      offset, length) == 0:
+        return
+    end = offset + length
+    while offset < end:
+        count = min(end - offset, len(zero_buffer))
+        os.pwrite(fd, memoryview(zero_buffer)[:count], offset)
+        offset += count
+
+
+def _copy_range_sparse(source_fd, source_offset, destination_fd,
+                       destination_offset, length):
+    end = min(source_offset + length, os.fstat(source_fd).st_size)
+    offset = source_offset
+    while offset < end:
+        try:
+            data_start = os.lseek(source_fd, offset, os.SEEK_DATA)
+            hole_start = os.lseek(source_fd, data_start, os.SEEK_HOLE)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # nothing but a hole up to the end of the file
+                break
+            if e.errno != errno.EINVAL:
+                raise
+            (data_start, hole_start) = (offset, end)
+        hole_start = min(hole_start, end)
+        while data_start < hole_start:
+            data = os.pread(source_fd, min(hole_start - data_start,
+                                           copy_chunk_size), data_start)
+            if not data:
+                break
+            if not is_zero(data):
+                os.pwrite(destination_fd, data,
+                          destination_offset + data_start - source_offset)
+            data_start += len(data)
+        offset = hole_start
+    return max(end - source_offset, 0)
+
+
+def copy_range(source_fd, source_offset, destination_fd, destination_offset,
+               length, sparse=False):
+    """
+    Copy length bytes between two file descriptors at the given offsets,
+    without moving either file position. Returns the number of bytes copied,
+    which is less than length only if the source ends first.
+
+    With sparse set, holes in the source and all-zero data are skipped
+    rather than written, so the destination must already read back as zeros
+    over the range (a freshly truncated file, for instance). Sparse copies
+    read the data through Python and move the source file position.
+    """
+    if sparse:
+        return _copy_range_sparse(source_fd, source_offset, destination_fd,
+                                  destination_offset, length)
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < length:
+                count = os.copy_file_range(
+                    source_fd, destination_fd,
+                    min(length - copied, copy_chunk_size),
+                    source_offset + copied, destination_offset + copied)
+                if not count:
+                    return copied
+                copied += count
+            return copied
+        except OSError as e:
+            if e.errno not in _copy_file_range_errors:
+                raise
+    return copied + _pread_pwrite(source_fd, source_offset + copied,
+                                  destination_fd, destination_offset + copied,
+                                  length - copied)
+
+
+def clone_file(source_path, destination_path):
+    """
+    Make destination_path a copy of source_path, sharing its blocks with a
+    reflink if the filesystem can. Returns True if the file was reflinked and
+    False if its data had to be copied.
+    """
+    with open(source_path, 'rb') as source, \
+            open(destination_path, 'wb') as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+            return True
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOTTY,
+                               errno.EOPNOTSUPP, errno.EBADF):
+                raise
+        size = os.fstat(source.fileno()).st_size
+        destination.truncate(size)
+        copy_range(source.fileno(), 0, destination.fileno(), 0, size,
+                   sparse=True)
+        return False
+
+
+def copy_stream_sparse(source, destination, chunk_size=copy_chunk_size):
+    """
+    Copy the file-like object source to the start of the file destination,
+    seeking over all-zero chunks instead of writing them so they become
+    holes. Returns the number of bytes copied.
+    """
+    position = 0
+    while True:
+        data = source.read(chunk_size)
+        if not data:
+            break
+        if is_zero(data):
+            destination.seek(len(data), os.SEEK_CUR)
+        else:
+            destination.write(data)
+        position += len(data)
+    destination.truncate(position)
+    return position
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+"""
+A journal of the extents of a changed blocks export that are safely on disk,
+so an interrupted export can be resumed rather than started again.
+
+The journal lives next to the changed blocks file and is made up of
+
+    header   magic b"CBTJRNL1", format version, length of the key, the key
+             and a CRC32 of the key (struct ">8sHI", the key, then ">I")
+    records  one ">QQQQI" Extent per completed piece of the export, each
+             followed by a CRC32 of the packed extent
+
+The key identifies the export (the new snapshot and the bitmap it was
+started from), so a journal is never applied to a different export. Records
+are appended at checkpoints: the changed blocks file is fsynced first and
+the journal after it, so every extent recorded in the journal is already on
+disk. A record cut short by a crash is recognised by its CRC and ignored.
+"""
+
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+from cbt_bitmap import Extent
+
+JOURNAL_MAGIC = b'CBTJRNL1'
+JOURNAL_FORMAT_VERSION = 1
+_header = struct.Struct('>8sHI')
+_crc = struct.Struct('>I')
+_record = struct.Struct('>QQQQII')
+
+# A checkpoint is taken once this many bytes or seconds have gone by since
+# the last one
+default_checkpoint_bytes = 256 * 1024 * 1024
+default_checkpoint_interval = 10
+
+
+def journal_path(changed_blocks_path):
+    return changed_blocks_path + ".journal"
+
+
+def _read_journal(path):
+    with open(path, 'rb') as journal:
+        data = journal.read()
+    (magic, version, key_length) = _header.unpack_from(data)
+    if magic != JOURNAL_MAGIC:
+        raise ValueError("%s is not an export journal" % path)
+    if version != JOURNAL_FORMAT_VERSION:
+        raise ValueError("%s has unsupported format version %d"
+                         % (path, version))
+    position = _header.size
+    key = data[position:position + key_length]
+    position += key_length
+    if len(key) != key_length or zlib.crc32(key) != \
+            _crc.unpack_from(data, position)[0]:
+        raise ValueError("%s has a corrupt header" % path)
+    position += _crc.size
+    extents = []
+    while position + _record.size <= len(data):
+        record = _record.unpack_from(data, position)
+        if zlib.crc32(data[position:position + _record.size - _crc.size]) \
+                != record[-1]:
+            # the tail of the last checkpoint never made it to disk
+            break
+        extents.append(Extent(*record[:-1]))
+        position += _record.size
+    return (json.loads(key.decode()), extents, position)
+
+
+def read_journal_key(path):
+    """Return the key a journal was created with"""
+    return _read_journal(path)[0]
+
+
+class ExportJournal(object):
+    """
+    Records the extents written to data_fd, the changed blocks file. Use
+    create to start a new export or open to resume one, add the pieces
+    written as they are written, and remove once the export is complete.
+    Safe to use from several worker threads.
+    """
+
+    def __init__(self, path, key, extents, journal, data_fd=None,
+                 checkpoint_bytes=default_checkpoint_bytes,
+                 checkpoint_interval=default_checkpoint_interval):
+        self.path = path
+        self.key = key
+        # the extents recorded so far, including those of earlier runs
+        self.extents = extents
+        self.data_fd = data_fd
+        self.checkpoint_bytes = checkpoint_bytes
+        self.checkpoint_interval = checkpoint_interval
+        self._journal = journal
+        self._pending = []
+        self._pending_bytes = 0
+        self._last_checkpoint = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, path, key, **kwargs):
+        key_data = json.dumps(key, sort_keys=True).encode()
+        journal = open(path, 'wb', buffering=0)
+        journal.write(_header.pack(JOURNAL_MAGIC, JOURNAL_FORMAT_VERSION,
+                                   len(key_data)) + key_data +
+                      _crc.pack(zlib.crc32(key_data)))
+        os.fsync(journal.fileno())
+        return cls(path, key, [], journal, **kwargs)
+
+    @classmethod
+    def open(cls, path, key, **kwargs):
+        """
+        Open the journal of an interrupted export to carry on with it,
+        raising ValueError if it was written for an export other than key.
+        """
+        (journal_key, extents, end) = _read_journal(path)
+        if journal_key != json.loads(json.dumps(key, sort_keys=True)):
+            raise ValueError("%s belongs to a different export" % path)
+        journal = open(path, 'r+b', buffering=0)
+        # drop any partly written record before appending after it
+        journal.truncate(end)
+        journal.seek(end)
+        return cls(path, key, extents, journal, **kwargs)
+
+    def _extent_pieces(self, extents):
+        # Yields the recorded pieces exactly covering each of extents, or
+        # None if it is not complete; a later record of an offset replaces
+        # an earlier one
+        pieces = {}
+        for piece in self.extents:
+            pieces[piece.offset] = piece
+        for extent in extents:
+            offset = extent.offset
+            end = extent.offset + extent.length
+            covering = []
+            while offset < end and offset in pieces:
+                covering.append(pieces[offset])
+                offset += pieces[offset].length
+            yield (extent, covering if offset >= end else None)
+
+    def remaining(self, extents):
+        """
+        Return the extents, as laid out for the export, which are not yet
+        completely covered by recorded pieces.
+        """
+        return [extent for (extent, covering) in self._extent_pieces(extents)
+                if covering is None]
+
+    def completed(self, extents):
+        """
+        Return the recorded pieces of the extents not in remaining. Call
+        this before resuming, as extents fetched again add pieces of their
+        own.
+        """
+        done = []
+        for (_, covering) in self._extent_pieces(extents):
+            if covering is not None:
+                done.extend(covering)
+        return done
+
+    def add(self, pieces):
+        """
+        Record pieces, Extents whose data has been written to data_fd,
+        taking a checkpoint if one is due. The pieces of an extent of the
+        layout may be added one at a time, even from different calls
+        between checkpoints; an extent whose pieces were not all recorded
+        before an interruption is fetched again in full on resume.
+        """
+        with self._lock:
+            self._pending.extend(pieces)
+            self._pending_bytes += sum(piece.data_length for piece in pieces)
+            if self._pending_bytes >= self.checkpoint_bytes or \
+                    time.monotonic() - self._last_checkpoint >= \
+                    self.checkpoint_interval:
+                self._checkpoint()
+
+    def checkpoint(self):
+        with self._lock:
+            self._checkpoint()
+
+    def _checkpoint(self):
+        if self._pending:
+            if self.data_fd is not None:
+                os.fsync(self.data_fd)
+            records = []
+            for piece in self._pending:
+                packed = _record.pack(*piece, 0)[:-_crc.size]
+                records.append(packed + _crc.pack(zlib.crc32(packed)))
+            self._journal.write(b''.join(records))
+            os.fsync(self._journal.fileno())
+            self.extents.extend(self._pending)
+            self._pending = []
+            self._pending_bytes = 0
+        self._last_checkpoint = time.monotonic()
+
+    def close(self):
+        """Take a final checkpoint and close the journal"""
+        if self._journal.closed:
+            return
+        self.checkpoint()
+        self._journal.close()
+
+    def remove(self):
+        """Close and delete the journal of an export that has completed"""
+        self._journal.close()
+        os.remove(self.path)
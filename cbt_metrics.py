@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+"""
+Timings and throughput of backups and restores, for when the progress the
+scripts print is not enough to see where the time goes.
+
+Recording is off unless a script is given --metrics-json or
+--metrics-prometheus, and costs nothing when it is. When on, it records
+
+    phases     how long each phase of the script took (XenAPI snapshot,
+               list_changed_blocks, transfer, merge, import and so on) and,
+               for the phases moving data over the network, how many bytes
+               they moved and so their throughput
+    histograms the latency of every NBD request by type, the time taken to
+               connect and negotiate TLS, and the number of NBD requests in
+               flight as each one is sent
+    counters   the bytes read and written over NBD
+
+--metrics-json appends a JSON object to a file as each phase ends, and a
+summary of all of the above when the script exits. --metrics-prometheus
+writes the same in the Prometheus text format to a file, replaced as each
+phase ends, for the node exporter's textfile collector to pick up.
+"""
+
+import atexit
+import bisect
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds for timings
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10)
+depth_buckets = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+_buckets = {'nbd_queue_depth': depth_buckets}
+
+_current = None
+
+
+class _histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(zip([str(bound) for bound in self.buckets] +
+                                    ['+Inf'], self.counts))}
+
+
+class _phase_record(object):
+    """Set bytes to the amount of data a phase moved"""
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+
+
+class metrics(object):
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+        # name -> [runs, seconds, bytes]
+        self.phases = {}
+        # (name, labels) -> _histogram or counter value
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = _histogram(
+                    _buckets.get(name, latency_buckets))
+            self.histograms[key].observe(value)
+
+    def add(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        record = _phase_record(name)
+        start = time.monotonic()
+        try:
+            yield record
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                totals = self.phases.setdefault(name, [0, 0, 0])
+                totals[0] += 1
+                totals[1] += elapsed
+                totals[2] += record.bytes
+            event = {'event': 'phase', 'phase': name, 'seconds': elapsed,
+                     'bytes': record.bytes,
+                     'bytes_per_second':
+                         record.bytes / elapsed if elapsed else 0}
+            for sink in self.sinks:
+                sink.phase_ended(self, event)
+
+    def summary(self):
+        with self._lock:
+            return {
+                'event': 'summary',
+                'phases': dict((name, {'runs': runs, 'seconds': seconds,
+                                       'bytes': count})
+                               for (name, (runs, seconds, count))
+                               in self.phases.items()),
+                'histograms': [dict(name=name, labels=dict(labels),
+                                    **histogram.summary())
+                               for ((name, labels), histogram)
+                               in self.histograms.items()],
+                'counters': [{'name': name, 'labels': dict(labels),
+                              'value': value}
+                             for ((name, labels), value)
+                             in self.counters.items()]}
+
+    def close(self):
+        (sinks, self.sinks) = (self.sinks, [])
+        for sink in sinks:
+            sink.close(self)
+
+
+class json_lines(object):
+    """Appends a JSON object per line to path"""
+
+    def __init__(self, path):
+        self._file = open(path, 'a')
+
+    def _write(self, event):
+        event = dict(event, time=time.time())
+        self._file.write(json.dumps(event, sort_keys=True) + "\n")
+        self._file.flush()
+
+    def phase_ended(self, metrics, event):
+        self._write(event)
+
+    def close(self, metrics):
+        self._write(metrics.summary())
+        self._file.close()
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % label for label in labels)
+
+
+class prometheus_textfile(object):
+    """Writes the Prometheus text format to path, replacing it each time"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _lines(self, metrics):
+        with metrics._lock:
+            phases = sorted(metrics.phases.items())
+            histograms = sorted(metrics.histograms.items())
+            counters = sorted(metrics.counters.items())
+        for (metric, index) in (('runs', 0), ('seconds', 1), ('bytes', 2)):
+            yield "# TYPE cbt_phase_%s_total counter" % metric
+            for (name, totals) in phases:
+                yield 'cbt_phase_%s_total{phase="%s"} %s' \
+                    % (metric, name, totals[index])
+        typed = set()
+        for ((name, labels), histogram) in histograms:
+            if name not in typed:
+                typed.add(name)
+                yield "# TYPE cbt_%s histogram" % name
+            cumulative = 0
+            bounds = [str(bound) for bound in histogram.buckets] + ['+Inf']
+            for (bound, count) in zip(bounds, histogram.counts):
+                cumulative += count
+                yield "cbt_%s_bucket%s %d" \
+                    % (name, _labels(labels + (('le', bound),)), cumulative)
+            yield "cbt_%s_sum%s %s" % (name, _labels(labels), histogram.sum)
+            yield "cbt_%s_count%s %d" % (name, _labels(labels),
+                                         histogram.count)
+        for ((name, labels), value) in counters:
+            if name not in typed:
+                typed.add(name)
+                yield "# TYPE cbt_%s counter" % name
+            yield "cbt_%s%s %s" % (name, _labels(labels), value)
+
+    def write(self, metrics):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'w') as textfile:
+            textfile.write("\n".join(self._lines(metrics)) + "\n")
+        os.replace(temporary_path, self.path)
+
+    def phase_ended(self, metrics, event):
+        self.write(metrics)
+
+    def close(self, metrics):
+        self.write(metrics)
+
+
+def configure(json_path=None, prometheus_path=None):
+    """
+    Start recording to the given files, and write out the summary when the
+    process exits. Nothing is recorded if neither is given.
+    """
+    global _current
+    sinks = []
+    if json_path:
+        sinks.append(json_lines(json_path))
+    if prometheus_path:
+        sinks.append(prometheus_textfile(prometheus_path))
+    if not sinks:
+        return None
+    _current = metrics(sinks)
+    atexit.register(_current.close)
+    return _current
+
+
+def add_arguments(parser):
+    parser.add_argument('--metrics-json', dest='metrics_json',
+                        help='Append timings and throughput to this file as '
+                             'JSON lines')
+    parser.add_argument('--metrics-prometheus', dest='metrics_prometheus',
+                        help='Write timings and throughput to this file in '
+                             'the Prometheus text format')
+
+
+def configure_from_args(args):
+    return configure(args.metrics_json, args.metrics_prometheus)
+
+
+def get():
+    """Return the metrics being recorded, or None if recording is off"""
+    return _current
+
+
+def phase(name):
+    """
+    A context manager timing the phase name of the script, giving a record
+    whose bytes can be set to the amount of data the phase moved
+    """
+    if _current is None:
+        return contextlib.nullcontext(_phase_record(name))
+    return _current.phase(name)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""
+NBD connections to the exports returned by VDI.get_nbd_info, shared by
+everything a process exports or imports.
+
+The host certificate of each record is trusted straight from memory, so no
+CA bundle is written to the working directory for concurrent runs to
+clobber. Each certificate is parsed for its TLS hostname and loaded into an
+SSLContext only once, however many connections are made with it, and the
+TLS session of the last connection to each address with that certificate is
+resumed by the next one, which then needs only an abbreviated handshake.
+Connections made at the same time wait for the first of them to finish its
+handshake, rather than all making a full one. With many small exports from
+the same hosts, as in a fleet backup, the full handshake would otherwise
+cost more than the transfer.
+
+Connections handed back with put are kept, up to max_idle for each
+(address, export name), and handed out again by get for the same export,
+once it has checked that the server has not closed them in the meantime.
+"""
+
+import collections
+import contextlib
+import functools
+import threading
+
+from nbd_client import new_nbd_client, tls_context
+
+# Idle connections kept for each export
+default_max_idle = 4
+
+_current = None
+_current_lock = threading.Lock()
+
+
+# Parsed once for each certificate
+@functools.lru_cache(maxsize=None)
+def get_cert_subject(cert_text):
+    """
+    Return the name the PEM certificate cert_text was issued to: its first
+    DNS subject alternative name, or else its common name. Raises
+    ValueError if it is not a certificate or names neither.
+    """
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    cert = x509.load_pem_x509_certificate(cert_text.encode(),
+                                          default_backend())
+    try:
+        ext = cert.extensions.get_extension_for_oid(
+            x509.ExtensionOID.SUBJECT_ALTERNATIVE_NAME)
+        names = ext.value.get_values_for_type(x509.DNSName)
+    except x509.ExtensionNotFound:
+        names = []
+    if names:
+        return names[0]
+    names = cert.subject.get_attributes_for_oid(x509.NameOID.COMMON_NAME)
+    if names and names[0].value:
+        return names[0].value
+    raise ValueError("could not find the subject of the host certificate")
+
+
+def _key(nbd_info):
+    return (nbd_info['address'], nbd_info['exportname'])
+
+
+def _session_key(nbd_info):
+    return (nbd_info['address'], nbd_info['cert'])
+
+
+class connection_pool(object):
+    """
+    Connections to the exports described by records of VDI.get_nbd_info.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, max_idle=default_max_idle):
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        # host certificate -> SSLContext
+        self._contexts = {}
+        # (address, host certificate) -> TLS session of the last connection
+        # to it, which can only be resumed with the SSLContext it was made
+        # with
+        self._sessions = {}
+        # (address, host certificate) -> lock held while the first
+        # connection to it makes a full TLS handshake
+        self._handshakes = {}
+        # (address, export name) -> idle connections
+        self._idle = collections.defaultdict(list)
+
+    def ssl_context(self, cert):
+        """Return the SSLContext trusting the certificate cert, or None"""
+        if not cert:
+            return None
+        with self._lock:
+            context = self._contexts.get(cert)
+            if context is None:
+                context = self._contexts[cert] = tls_context(ca_data=cert)
+            return context
+
+    def tls_hostname(self, nbd_info):
+        if not nbd_info['cert']:
+            return None
+        return get_cert_subject(nbd_info['cert'])
+
+    def connect(self, nbd_info, **kwargs):
+        """
+        Open a new connection to the export nbd_info describes, resuming
+        the last TLS session with its address and certificate. kwargs are
+        passed on to new_nbd_client.
+        """
+        key = _session_key(nbd_info)
+        with self._lock:
+            session = self._sessions.get(key)
+            handshake = None
+            if session is None and nbd_info['cert']:
+                handshake = self._handshakes.setdefault(key, threading.Lock())
+        if handshake is None:
+            return self._connect(nbd_info, session, kwargs)
+        # the connections waiting here resume the session of the first
+        with handshake:
+            with self._lock:
+                session = self._sessions.get(key)
+            return self._connect(nbd_info, session, kwargs)
+
+    def _connect(self, nbd_info, session, kwargs):
+        client = new_nbd_client(nbd_info['address'], nbd_info['exportname'],
+                                tls_hostname=self.tls_hostname(nbd_info),
+                                ssl_context=self.ssl_context(
+                                    nbd_info['cert']),
+                                tls_session=session, **kwargs)
+        self._remember_session(nbd_info, client)
+        return client
+
+    def _remember_session(self, nbd_info, client):
+        session = client.get_tls_session()
+        if session is not None:
+            with self._lock:
+                self._sessions[_session_key(nbd_info)] = session
+
+    def get(self, nbd_info, queue_depth=new_nbd_client.DEFAULT_QUEUE_DEPTH,
+            rate_limit=None, metrics=None):
+        """
+        Return an idle connection to the export nbd_info describes which
+        the server has not closed, or a new one if there is none
+        """
+        while True:
+            with self._lock:
+                idle = self._idle[_key(nbd_info)]
+                client = idle.pop() if idle else None
+            if client is None or client.is_connected():
+                break
+        if client is None:
+            return self.connect(nbd_info, queue_depth=queue_depth,
+                                rate_limit=rate_limit, metrics=metrics)
+        client.queue_depth = queue_depth
+        client.rate_limit = rate_limit
+        client.metrics = metrics
+        return client
+
+    def put(self, nbd_info, client):
+        """
+        Hand back a connection got from the pool which has no requests in
+        flight, to be kept for reuse or closed
+        """
+        # a session ticket may have arrived since the connection was made
+        self._remember_session(nbd_info, client)
+        with self._lock:
+            idle = self._idle[_key(nbd_info)]
+            if len(idle) < self.max_idle:
+                idle.append(client)
+                return
+        client.close()
+
+    @contextlib.contextmanager
+    def connection(self, nbd_info, **kwargs):
+        """
+        A context manager giving a connection from get, which is handed
+        back if the block using it succeeds and closed if it fails
+        """
+        client = self.get(nbd_info, **kwargs)
+        try:
+            yield client
+        except BaseException:
+            client.close()
+            raise
+        self.put(nbd_info, client)
+
+    def discard(self, nbd_info):
+        """Close the idle connections to the export nbd_info describes"""
+        with self._lock:
+            idle = self._idle.pop(_key(nbd_info), [])
+        for client in idle:
+            client.close()
+
+    def close(self):
+        """Close every idle connection"""
+        with self._lock:
+            (idle, self._idle) = (self._idle, collections.defaultdict(list))
+        for clients in idle.values():
+            for client in clients:
+                client.close()
+
+
+def get():
+    """Return the pool shared by the whole process"""
+    global _current
+    with _current_lock:
+        if _current is None:
+            _current = connection_pool()
+        return _current
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+"""
+Token bucket rate limits on the bytes and requests transferred over NBD and
+by the export_raw_vdi and import_raw_vdi HTTP calls, so backups can run
+without saturating the storage and management networks of the hosts.
+
+The limits are read from a JSON control file such as
+
+    {
+        "default": {"bandwidth": 200, "iops": 2000},
+        "hosts": {"10.0.0.1": {"bandwidth": 100}},
+        "srs": {"<SR uuid>": {"bandwidth": 50, "iops": 500}}
+    }
+
+where bandwidth is in MiB/s and iops in requests per second, and either may
+be left out for no limit. "default" is shared by every transfer in the
+process, each entry of "hosts" by the transfers to or from that address and
+each entry of "srs" by the transfers of VDIs on that SR, and a transfer waits
+for all the limits that apply to it. An HTTP transfer counts as a single
+request.
+
+The file is read again whenever it changes, checked at most once a second,
+or straight away on SIGHUP, and the new limits apply to transfers already
+under way.
+"""
+
+import asyncio
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+# How often, in seconds, the control file is checked for changes
+poll_interval = 1.0
+
+
+class token_bucket(object):
+    """
+    Allows rate units per second, with bursts of up to burst units, by
+    default a second's worth. A rate of None is no limit.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self._last = None
+        self._tokens = 0
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self._lock:
+            self.rate = rate
+            self.burst = burst if burst is not None else rate
+
+    def reserve(self, amount):
+        """
+        Take amount units and return how many seconds the caller should
+        wait before using them, which may be more than a burst
+        """
+        with self._lock:
+            if not self.rate:
+                return 0
+            now = time.monotonic()
+            if self._last is None:
+                self._tokens = self.burst
+            else:
+                self._tokens = min(self.burst, self._tokens +
+                                   (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0
+            # whoever comes next also waits for this debt to be paid off
+            return -self._tokens / self.rate
+
+
+class rate_limit(object):
+    """A byte budget and a request budget, in MiB/s and requests/s"""
+
+    def __init__(self, bandwidth=None, iops=None):
+        self.bytes = token_bucket()
+        self.requests = token_bucket()
+        self.set(bandwidth, iops)
+
+    def set(self, bandwidth=None, iops=None):
+        self.bytes.set_rate(bandwidth * 1024 * 1024 if bandwidth else None)
+        self.requests.set_rate(iops or None)
+
+    def reserve(self, length, requests=1):
+        return max(self.bytes.reserve(length),
+                   self.requests.reserve(requests))
+
+
+class limiter(object):
+    """The rate_limits one transfer has to keep within"""
+
+    def __init__(self, limits, registry=None):
+        self.limits = limits
+        self.registry = registry
+
+    def delay(self, length, requests=1):
+        """
+        Take length bytes and requests from every limit, and return how
+        many seconds to wait before transferring them
+        """
+        if self.registry is not None:
+            self.registry.poll()
+        return max([limit.reserve(length, requests)
+                    for limit in self.limits] or [0])
+
+    def consume(self, length, requests=1):
+        """Wait until length bytes and requests can be transferred"""
+        delay = self.delay(length, requests)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def consume_async(self, length, requests=1):
+        delay = self.delay(length, requests)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class rate_limits(object):
+    """
+    The limits of a control file, or none if path is None. limiter returns
+    the limiter for a transfer to or from a host on an SR.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.default = rate_limit()
+        self.hosts = {}
+        self.srs = {}
+        self._lock = threading.Lock()
+        # held by the one thread checking the control file at a time
+        self._poll_lock = threading.Lock()
+        self._mtime = None
+        self._next_poll = 0
+        self._reload = False
+        if path is not None:
+            self.load()
+
+    def _update(self, limits, config):
+        # Existing limits are changed in place, so transfers already holding
+        # them see the new rates
+        for (key, limit) in limits.items():
+            limit.set(**config.get(key, {}))
+        for (key, values) in config.items():
+            if key not in limits:
+                limits[key] = rate_limit(**values)
+
+    def load(self):
+        with open(self.path) as control_file:
+            config = json.load(control_file)
+        with self._lock:
+            self.default.set(**config.get('default', {}))
+            self._update(self.hosts, config.get('hosts', {}))
+            self._update(self.srs, config.get('srs', {}))
+            self._mtime = os.stat(self.path).st_mtime_ns
+        print("rate limits loaded from %s" % self.path, file=sys.stderr)
+
+    def poll(self):
+        """Reload the control file if it has changed or SIGHUP was received"""
+        if self.path is None:
+            return
+        if not self._reload and time.monotonic() < self._next_poll:
+            return
+        # a thread finding another one already checking carries on
+        if not self._poll_lock.acquire(blocking=False):
+            return
+        try:
+            now = time.monotonic()
+            if not self._reload and now < self._next_poll:
+                return
+            self._next_poll = now + poll_interval
+            changed = os.stat(self.path).st_mtime_ns != self._mtime
+            if changed or self._reload:
+                self._reload = False
+                self.load()
+        except (OSError, ValueError, TypeError) as e:
+            # keep the limits we have until the file is fixed
+            print("could not reload rate limits: %s" % e, file=sys.stderr)
+        finally:
+            self._poll_lock.release()
+
+    def install_signal_handler(self, signum=signal.SIGHUP):
+        """Reload the control file when signum is received"""
+        def reload(*_):
+            self._reload = True
+        signal.signal(signum, reload)
+
+    def limiter(self, host=None, sr=None):
+        with self._lock:
+            limits = [self.default]
+            if host is not None:
+                limits.append(self.hosts.setdefault(host, rate_limit()))
+            if sr is not None:
+                limits.append(self.srs.setdefault(sr, rate_limit()))
+        return limiter(limits, self)
+
+
+def from_control_file(path):
+    """Return the rate_limits of the control file path, reloaded on SIGHUP"""
+    limits = rate_limits(path)
+    limits.install_signal_handler()
+    return limits
+
+
+def vdi_limiter(path, session, host, vdi_ref):
+    """
+    Return the limiter from the control file path for transfers of a VDI
+    to or from host, or None if path is None
+    """
+    if path is None:
+        return None
+    sr_uuid = session.xenapi.SR.get_uuid(session.xenapi.VDI.get_SR(vdi_ref))
+    return from_control_file(path).limiter(host, sr_uuid)
+
+
+class throttled_reader(object):
+    """
+    A file-like object reading from file within limiter, for use as the
+    body of an HTTP request or the source of a download
+    """
+
+    def __init__(self, file, limiter, chunk_size=1024 * 1024):
+        self._file = file
+        self._limiter = limiter
+        self._chunk_size = chunk_size
+        # the whole transfer counts as one request
+        self._limiter.consume(0)
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._limiter.consume(len(data), 0)
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(self._chunk_size)
+            if not data:
+                return
+            yield data
+
+    def __len__(self):
+        return os.fstat(self._file.fileno()).st_size - self._file.tell()
+
+
+def throttled_chunks(chunks, limiter):
+    """Yield the chunks of bytes of chunks within limiter"""
+    limiter.consume(0)
+    for chunk in chunks:
+        limiter.consume(len(chunk), 0)
+        yield chunk
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+
+"""
+A deduplicating repository of VDI blocks.
+
+Rather than keeping a changed blocks file per increment, the 64KB blocks CBT
+tracks are stored once each, keyed by a 128 bit BLAKE2b hash of their
+contents, and every snapshot is described by a manifest listing the hash of
+each of its blocks. A block that is already in the repository, whether from
+an earlier increment of the same VDI or from another VM cloned from the same
+template, is not written again, and all-zero blocks are never stored at all.
+
+The repository is a directory holding
+
+    lock        flocked by the process adding blocks, from its first block
+                until it is closed
+    packs/      the blocks, appended to pack files of up to pack_size bytes
+    index       one ">16sIQI" record per stored block: hash, pack number,
+                offset in the pack and length
+    manifests/  one manifest per snapshot: a header (struct ">8sHHIQQ":
+                magic b"CBTMANIF", format version, flags, block size, VDI size
+                and number of entries) followed by a ">Q16s" entry for each
+                block, giving its block number and hash
+
+Pack data is fsynced before the index records pointing at it are written,
+and a manifest is only written once every block it refers to is in the
+index, so a repository interrupted part way through an export is still
+consistent; the blocks stored so far just do not have to be written again.
+Exports into the same repository take turns to add their blocks, each
+reloading the index once it holds the lock, and each block is recorded at
+the offset its write actually went to.
+
+A manifest flagged MANIFEST_FULL lists every non-zero block of the VDI, such
+as one made by this script from a whole VDI image, while the manifest of
+an increment only lists the blocks that changed. Restoring applies the
+increments' manifests on top of a full manifest or of a base VDI image.
+
+example: python cbt_repository.py -r <repository path> -v <VDI path>
+-n <manifest name>
+
+stores a whole VDI image in the repository as a full manifest.
+"""
+
+import argparse
+import collections
+import fcntl
+import hashlib
+import os
+import struct
+
+import cbt_io
+from cbt_bitmap import changed_block_size
+
+REPOSITORY_FORMAT_VERSION = 1
+MANIFEST_MAGIC = b'CBTMANIF'
+_manifest_header = struct.Struct('>8sHHIQQ')
+_manifest_entry = struct.Struct('>Q16s')
+_index_record = struct.Struct('>16sIQI')
+
+# Manifest flags
+MANIFEST_FULL = 1 << 0
+
+# A new pack file is started once the current one reaches this size
+pack_size = 1024 * 1024 * 1024
+# Newly stored blocks are made durable in batches of this many
+commit_blocks = 4096
+
+# The hash recorded for blocks that are all zeros, which are not stored
+zero_hash = bytes(16)
+
+Manifest = collections.namedtuple(
+    'Manifest', ['block_size', 'vdi_size', 'flags', 'entries'])
+
+
+def block_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class Repository(object):
+
+    def __init__(self, path, block_size=changed_block_size):
+        self.path = path
+        self.block_size = block_size
+        os.makedirs(os.path.join(path, "packs"), exist_ok=True)
+        os.makedirs(os.path.join(path, "manifests"), exist_ok=True)
+        # hash -> (pack number, offset, length) of every stored block
+        self._index = {}
+        self._load_index()
+        self._new_records = []
+        self._lock_fd = None
+        self._pack_fd = None
+        self._pack_number = None
+        self._pack_offset = None
+        self._read_fds = {}
+        self.stored = 0
+        self.deduplicated = 0
+        self.zeros = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.path, "index"), 'rb') as index:
+                data = index.read()
+        except FileNotFoundError:
+            return
+        # a record cut short by a crash is ignored
+        data = data[:len(data) - len(data) % _index_record.size]
+        for (hash_value, pack, offset, length) in \
+                _index_record.iter_unpack(data):
+            self._index[hash_value] = (pack, offset, length)
+
+    def _pack_path(self, pack):
+        return os.path.join(self.path, "packs", "%08d" % pack)
+
+    def _manifest_path(self, name):
+        return os.path.join(self.path, "manifests", name)
+
+    def _lock(self):
+        # Held until close, so no other process appends to the packs or the
+        # index in between; what they added before is reloaded
+        self._lock_fd = os.open(os.path.join(self.path, "lock"),
+                                os.O_WRONLY | os.O_CREAT, 0o644)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        self._load_index()
+        self._pack_number = max([int(pack) for pack in
+                                 os.listdir(os.path.join(self.path, "packs"))
+                                 if pack.isdigit()] or [0])
+
+    def _open_pack(self):
+        if self._lock_fd is None:
+            self._lock()
+        if self._pack_fd is not None and self._pack_offset < pack_size:
+            return
+        if self._pack_fd is not None:
+            self.commit()
+            os.close(self._pack_fd)
+            self._pack_number += 1
+        self._pack_fd = os.open(self._pack_path(self._pack_number),
+                                os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._pack_offset = os.lseek(self._pack_fd, 0, os.SEEK_END)
+
+    def close(self):
+        self.commit()
+        if self._pack_fd is not None:
+            os.close(self._pack_fd)
+            self._pack_fd = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        for fd in self._read_fds.values():
+            os.close(fd)
+        self._read_fds.clear()
+
+    def __contains__(self, hash_value):
+        return hash_value == zero_hash or hash_value in self._index
+
+    def add_block(self, data):
+        """Store a block unless it is already present, and return its hash"""
+        if cbt_io.is_zero(data):
+            self.zeros += 1
+            return zero_hash
+        hash_value = block_hash(data)
+        if hash_value in self._index:
+            self.deduplicated += 1
+            return hash_value
+        self._open_pack()
+        if hash_value in self._index:
+            # stored by another process before the lock was taken
+            self.deduplicated += 1
+            return hash_value
+        written = os.write(self._pack_fd, data)
+        if written != len(data):
+            raise OSError("short write of %d of %d bytes to pack %d"
+                          % (written, len(data), self._pack_number))
+        # where the append went, rather than where it was expected to go
+        self._pack_offset = os.lseek(self._pack_fd, 0, os.SEEK_CUR)
+        offset = self._pack_offset - written
+        self._index[hash_value] = (self._pack_number, offset, written)
+        self._new_records.append(_index_record.pack(
+            hash_value, self._pack_number, offset, written))
+        self.stored += 1
+        if len(self._new_records) >= commit_blocks:
+            self.commit()
+        return hash_value
+
+    def add_extent(self, offset, data):
+        """
+        Store data, which is at offset on the VDI, a block at a time and
+        return its (block number, hash) entries
+        """
+        view = memoryview(data)
+        first = offset // self.block_size
+        return [(first + i // self.block_size,
+                 self.add_block(view[i:i + self.block_size]))
+                for i in range(0, len(view), self.block_size)]
+
+    def commit(self):
+        """Make every block added so far durable"""
+        if not self._new_records:
+            return
+        os.fsync(self._pack_fd)
+        with open(os.path.join(self.path, "index"), 'ab') as index:
+            index.write(b''.join(self._new_records))
+            index.flush()
+            os.fsync(index.fileno())
+        self._new_records = []
+
+    def write_manifest(self, name, entries, vdi_size, flags=0):
+        """
+        Commit the blocks added and then write the manifest name, listing
+        the (block number, hash) entries in block order
+        """
+        self.commit()
+        entries = sorted(entries)
+        path = self._manifest_path(name)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, 'wb') as manifest:
+            manifest.write(_manifest_header.pack(
+                MANIFEST_MAGIC, REPOSITORY_FORMAT_VERSION, flags,
+                self.block_size, vdi_size, len(entries)))
+            manifest.write(b''.join(_manifest_entry.pack(block, hash_value)
+                                    for (block, hash_value) in entries))
+            manifest.flush()
+            os.fsync(manifest.fileno())
+        os.replace(temporary_path, path)
+
+    def read_manifest(self, name):
+        path = self._manifest_path(name)
+        with open(path, 'rb') as manifest:
+            data = manifest.read()
+        if len(data) < _manifest_header.size:
+            raise ValueError("%s is too short to be a manifest" % path)
+        (magic, version, flags, block_size, vdi_size, count) = \
+            _manifest_header.unpack_from(data)
+        if magic != MANIFEST_MAGIC:
+            raise ValueError("%s is not a manifest" % path)
+        if version != REPOSITORY_FORMAT_VERSION:
+            raise ValueError("%s has unsupported format version %d"
+                             % (path, version))
+        if len(data) != _manifest_header.size + count * _manifest_entry.size:
+            raise ValueError("%s is truncated" % path)
+        entries = list(_manifest_entry.iter_unpack(
+            memoryview(data)[_manifest_header.size:]))
+        for (_, hash_value) in entries:
+            if hash_value not in self:
+                raise ValueError("%s refers to a block missing from the "
+                                 "repository" % path)
+        return Manifest(block_size, vdi_size, flags, entries)
+
+    def _read_fd(self, pack):
+        if pack not in self._read_fds:
+            self._read_fds[pack] = os.open(self._pack_path(pack), os.O_RDONLY)
+        return self._read_fds[pack]
+
+    def read_block(self, hash_value):
+        if hash_value == zero_hash:
+            return bytes(self.block_size)
+        (pack, offset, length) = self._index[hash_value]
+        return os.pread(self._read_fd(pack), length, offset)
+
+    def store_changed_blocks(self, changed_blocks, name, vdi_size, flags=0):
+        """
+        Store the (extent, data) pairs of changed_blocks, as yielded by
+        cbt_export_changes.get_changed_blocks, and write their manifest.
+        data is None for extents known to be all zeros. Returns the number
+        of blocks listed in the manifest.
+        """
+        entries = []
+        for (extent, data) in changed_blocks:
+            if data is None:
+                first = extent.offset // self.block_size
+                count = -(-extent.length // self.block_size)
+                entries.extend((block, zero_hash)
+                               for block in range(first, first + count))
+            else:
+                entries.extend(self.add_extent(extent.offset, data))
+        self.write_manifest(name, entries, vdi_size, flags)
+        self.report()
+        return len(entries)
+
+    def store_image(self, vdi_path, name):
+        """Store a whole VDI image as the full manifest name"""
+        entries = []
+        with open(vdi_path, 'rb') as vdi:
+            vdi_size = os.fstat(vdi.fileno()).st_size
+            offset = 0
+            while True:
+                data = vdi.read(cbt_io.copy_chunk_size)
+                if not data:
+                    break
+                entries.extend(entry for entry in self.add_extent(offset, data)
+                               if entry[1] != zero_hash)
+                offset += len(data)
+        self.write_manifest(name, entries, vdi_size, MANIFEST_FULL)
+        self.report()
+        return len(entries)
+
+    def report(self):
+        print("%d blocks stored, %d already present, %d all zeros"
+              % (self.stored, self.deduplicated, self.zeros))
+
+    def _block_owners(self, manifests):
+        # Last writer wins: block number -> hash of its latest contents
+        owners = {}
+        for manifest in manifests:
+            if manifest.block_size != self.block_size:
+                raise ValueError("manifests have a different block size")
+            owners.update(manifest.entries)
+        return owners
+
+    def _runs(self, owners, vdi_size):
+        # Coalesce blocks which are next to each other both on the VDI and
+        # in a pack into (offset, length, pack, pack offset) runs, with pack
+        # None for runs of zeros
+        run = None
+        for block in sorted(owners):
+            offset = block * self.block_size
+            if offset >= vdi_size:
+                break
+            hash_value = owners[block]
+            if hash_value == zero_hash:
+                (pack, pack_offset) = (None, None)
+                length = min(self.block_size, vdi_size - offset)
+            else:
+                (pack, pack_offset, length) = self._index[hash_value]
+            if run is not None and run[0] + run[1] == offset and \
+                    run[2] == pack and \
+                    (pack is None or run[3] + run[1] == pack_offset):
+                run[1] += length
+                continue
+            if run is not None:
+                yield tuple(run)
+            run = [offset, length, pack, pack_offset]
+        if run is not None:
+            yield tuple(run)
+
+    def restore(self, names, output_path, base_path=None):
+        """
+        Write the VDI described by the manifests names, oldest first, to
+        output_path. Unless the first manifest is a full one the increments
+        are applied over a copy of the VDI image base_path, or over the
+        base image itself if output_path is base_path.
+        """
+        manifests = [self.read_manifest(name) for name in names]
+        if not manifests:
+            raise ValueError("no manifests to restore")
+        vdi_size = manifests[-1].vdi_size
+        full = manifests[0].flags & MANIFEST_FULL
+        if not full and base_path is None:
+            raise ValueError("%s is not a full manifest and no base VDI was "
+                             "given" % names[0])
+        if full:
+            base_path = None
+        elif base_path != output_path:
+            cbt_io.clone_file(base_path, output_path)
+        owners = self._block_owners(manifests)
+        with open(output_path, 'r+b' if base_path else 'wb') as output:
+            if os.fstat(output.fileno()).st_size != vdi_size:
+                output.truncate(vdi_size)
+            for (offset, length, pack, pack_offset) in \
+                    self._runs(owners, vdi_size):
+                if pack is None:
+                    if base_path:
+                        cbt_io.punch_hole(output.fileno(), offset, length)
+                    continue
+                cbt_io.copy_range(self._read_fd(pack), pack_offset,
+                                  output.fileno(), offset, length)
+            output.flush()
+            os.fsync(output.fileno())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--repository', dest='repository')
+    parser.add_argument('-v', '--vdi', dest='vdi_path')
+    parser.add_argument('-n', '--name', dest='name')
+    args = parser.parse_args()
+
+    with Repository(args.repository) as repository:
+        repository.store_image(args.vdi_path, args.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+"""
+For a given base VDI and an ordered chain of increments this script will
+construct a VDI which contains all the changes up to the last increment.
+Each increment is the bitmap and changed blocks files written by one run of
+cbt_export_changes.py, and they should be given oldest first. Unlike running
+cbt_write_changed_blocks_to_base_VDI.py once per increment, every block of
+the output VDI is read exactly once, from the latest increment that changed
+it or otherwise from the base.
+
+example: python cbt_restore_chain.py -v <base VDI path>
+-i <bitmap path> <changed blocks path> -i <bitmap path> <changed blocks path>
+... -o <output VDI path>
+
+Script will output a VDI to the output path specified, or with --in-place
+write the changes over the base VDI instead. All-zero blocks are left as
+holes unless --no-sparse is given, which only applies to -o.
+
+Increments stored in a deduplicating repository by cbt_export_changes.py -r
+are restored by giving the repository and their manifests, oldest first,
+instead:
+
+example: python cbt_restore_chain.py -r <repository path>
+[-v <base VDI path>] -m <manifest> -m <manifest> ... -o <output VDI path>
+
+where the base VDI is only needed if the first manifest is not a full one.
+"""
+
+import argparse
+import cbt_metrics
+from cbt_chain import IncrementChain
+from cbt_repository import Repository
+
+
+def restore_chain(vdi_path, increments, output_path, sparse=True):
+    chain = IncrementChain(vdi_path, increments)
+    chain.write_to(output_path, sparse)
+
+
+def restore_chain_in_place(vdi_path, increments):
+    chain = IncrementChain(vdi_path, increments)
+    chain.write_in_place()
+
+
+def restore_from_repository(repository_path, manifests, output_path,
+                            vdi_path=None):
+    with Repository(repository_path) as repository:
+        repository.restore(manifests, output_path, vdi_path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--vdi-base', dest='vdi_base')
+    parser.add_argument('-i', '--increment', dest='increments',
+                        action='append', nargs=2, default=[],
+                        metavar=('BITMAP', 'CHANGED_BLOCKS'),
+                        help='Bitmap and changed blocks of an increment, '
+                             'repeated oldest first')
+    parser.add_argument('-r', '--repository', dest='repository')
+    parser.add_argument('-m', '--manifest', dest='manifests',
+                        action='append', default=[],
+                        help='Manifest of an increment in the repository, '
+                             'repeated oldest first')
+    parser.add_argument('-o', '--output', dest='output')
+    parser.add_argument('--in-place', dest='in_place', action='store_const',
+                        const=True, default=False,
+                        help='Write the changes over the base VDI')
+    parser.add_argument('--no-sparse', dest='sparse', action='store_const',
+                        const=False, default=True,
+                        help='Write all-zero blocks out instead of leaving '
+                             'holes')
+    cbt_metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if args.repository:
+        if not args.manifests:
+            parser.error("-r needs at least one -m")
+        if args.increments:
+            parser.error("-i cannot be used with -r, give -m instead")
+    else:
+        if args.vdi_base is None or not args.increments:
+            parser.error("-v and at least one -i are needed")
+        if args.manifests:
+            parser.error("-m needs -r")
+    if args.in_place and args.vdi_base is None:
+        parser.error("--in-place needs -v")
+    if args.output is None and not args.in_place:
+        parser.error("-o is needed unless writing --in-place")
+    if not args.sparse and (args.repository or args.in_place):
+        parser.error("--no-sparse can only be used when writing the "
+                     "increments given by -i to -o")
+    cbt_metrics.configure_from_args(args)
+
+    with cbt_metrics.phase('merge'):
+        if args.repository:
+            output = args.vdi_base if args.in_place else args.output
+            restore_from_repository(args.repository, args.manifests, output,
+                                    args.vdi_base)
+        elif args.in_place:
+            restore_chain_in_place(args.vdi_base, args.increments)
+        else:
+            restore_chain(args.vdi_base, args.increments, args.output,
+                          args.sparse)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+"""
+Serves the VDI as of any increment of a chain as a read-only NBD export,
+without writing the restored VDI anywhere first, so a single file can be
+copied out of a backup, or the backup booted, within seconds however long
+the chain is.
+
+example: python cbt_serve_chain.py -v <base VDI path>
+-i <bitmap path> <changed blocks path> -i <bitmap path> <changed blocks path>
+...
+
+serves the VDI as of the last increment given on port 10809 until
+interrupted, for example for
+
+    qemu-nbd -c /dev/nbd0 nbd://127.0.0.1:10809 && mount -o ro /dev/nbd0p1 /mnt
+
+Every read is resolved through the pieces of an IncrementChain, an index
+built once from the increments' extent indexes which gives the file holding
+the latest contents of every block, so it costs the same however many
+increments there are. The most recently read blocks are kept in an LRU cache
+of --cache-size MiB, and so are the last few compressed extents read (see
+cbt_compress.py), which would otherwise be decompressed again for each of
+their blocks. Runs of zeros are reported as holes to NBD_CMD_BLOCK_STATUS.
+
+With --cert and --key the export requires TLS.
+"""
+
+import argparse
+import bisect
+import collections
+import os
+import threading
+
+import nbd_server
+from cbt_chain import IncrementChain
+from nbd_client import new_nbd_client
+
+# Size of the cache of recently read blocks
+default_cache_size = 256 * 1024 * 1024
+# Number of decompressed extents kept
+decompressed_extents = 4
+
+
+class lru_cache(object):
+    """Keeps the capacity most recently used values"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+
+class chain_backend(object):
+    """
+    An nbd_server backend presenting an IncrementChain as the VDI as of its
+    last increment
+    """
+
+    read_only = True
+
+    def __init__(self, chain, cache_size=default_cache_size):
+        if chain.paths[0] is None:
+            raise ValueError("a base VDI is needed to serve a chain")
+        self.chain = chain
+        self.block_size = chain.block_size
+        self._offsets = [piece.offset for piece in chain.pieces]
+        self._sources = [os.open(path, os.O_RDONLY) for path in chain.paths]
+        self.blocks = lru_cache(cache_size // self.block_size)
+        self._extents = lru_cache(decompressed_extents)
+
+    def close(self):
+        for fd in self._sources:
+            os.close(fd)
+        self._sources = []
+
+    def size(self):
+        return self.chain.vdi_size
+
+    def _pieces(self, offset, end):
+        # The pieces overlapping offset to end, in order
+        i = max(bisect.bisect_right(self._offsets, offset) - 1, 0)
+        for piece in self.chain.pieces[i:]:
+            if piece.offset >= end:
+                return
+            if piece.offset + piece.length > offset:
+                yield piece
+
+    def _decompressed(self, piece):
+        key = (piece.source, piece.extent)
+        data = self._extents.get(key)
+        if data is None:
+            data = self.chain.codecs[piece.source].decompress(
+                os.pread(self._sources[piece.source],
+                         piece.extent.data_length, piece.extent.data_offset),
+                piece.extent.length)
+            self._extents.put(key, data)
+        return data
+
+    def _read_block(self, block):
+        offset = block * self.block_size
+        end = min(offset + self.block_size, self.chain.vdi_size)
+        data = bytearray(end - offset)
+        for piece in self._pieces(offset, end):
+            start = max(offset, piece.offset)
+            stop = min(end, piece.offset + piece.length)
+            if piece.source is None:
+                continue
+            if piece.extent is not None:
+                extent_start = start - piece.extent.offset
+                data[start - offset:stop - offset] = memoryview(
+                    self._decompressed(piece))[extent_start:
+                                               extent_start + stop - start]
+                continue
+            # the base VDI may be shorter than the VDI has grown to, in
+            # which case the rest of the block stays zeros
+            chunk = os.pread(self._sources[piece.source], stop - start,
+                             piece.source_offset + start - piece.offset)
+            data[start - offset:start - offset + len(chunk)] = chunk
+        return bytes(data)
+
+    def block(self, block):
+        """Return the contents of a block of the VDI"""
+        data = self.blocks.get(block)
+        if data is None:
+            data = self._read_block(block)
+            self.blocks.put(block, data)
+        return data
+
+    def pread(self, offset, length):
+        end = offset + length
+        chunks = []
+        for block in range(offset // self.block_size,
+                           -(-end // self.block_size)):
+            block_offset = block * self.block_size
+            data = self.block(block)
+            chunks.append(data[max(offset - block_offset, 0):
+                               end - block_offset])
+        return b''.join(chunks)
+
+    def block_status(self, offset, length):
+        zero = new_nbd_client.STATE_HOLE | new_nbd_client.STATE_ZERO
+        runs = []
+        end = offset + length
+        for piece in self._pieces(offset, end):
+            run_length = min(end, piece.offset + piece.length) - \
+                max(offset, piece.offset)
+            flags = zero if piece.source is None else 0
+            if runs and runs[-1][1] == flags:
+                runs[-1] = (runs[-1][0] + run_length, flags)
+            else:
+                runs.append((run_length, flags))
+        return runs
+
+
+def serve_chain(base_path, increments, address=('127.0.0.1', 10809),
+                export_name='', cache_size=default_cache_size,
+                ssl_context=None):
+    """
+    Serve the VDI at base_path with the (bitmap path, changed blocks path)
+    pairs of increments, oldest first, applied as export_name on address
+    until interrupted
+    """
+    backend = chain_backend(IncrementChain(base_path, increments),
+                            cache_size)
+    server = nbd_server.nbd_server({export_name: backend}, address,
+                                   ssl_context)
+    print("serving %d byte VDI on %s:%d"
+          % (backend.size(), server.address[0], server.address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        backend.close()
+        print("block cache: %d hits, %d misses"
+              % (backend.blocks.hits, backend.blocks.misses))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--vdi-base', dest='vdi_base')
+    parser.add_argument('-i', '--increment', dest='increments',
+                        action='append', nargs=2, default=[],
+                        metavar=('BITMAP', 'CHANGED_BLOCKS'),
+                        help='Bitmap and changed blocks of an increment, '
+                             'repeated oldest first up to the restore point '
+                             'to serve')
+    parser.add_argument('-n', '--export-name', dest='export_name', default='')
+    parser.add_argument('-a', '--address', dest='address',
+                        default='127.0.0.1')
+    parser.add_argument('--port', dest='port', type=int, default=10809)
+    parser.add_argument('--cache-size', dest='cache_size', type=int,
+                        default=default_cache_size // (1024 * 1024),
+                        help='Size of the cache of recently read blocks, '
+                             'in MiB')
+    parser.add_argument('--cert', dest='cert',
+                        help='Certificate to require TLS with, PEM')
+    parser.add_argument('--key', dest='key',
+                        help='Private key of the certificate, PEM')
+    args = parser.parse_args()
+
+    ssl_context = None
+    if args.cert:
+        ssl_context = nbd_server.server_ssl_context(args.cert, args.key)
+    serve_chain(args.vdi_base, args.increments, (args.address, args.port),
+                args.export_name, args.cache_size * 1024 * 1024, ssl_context)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+"""
+Helpers for copying extents of a VDI over several NBD connections at once.
+
+The extents are split into batches which a pool of worker threads, each with
+its own NBD connection, take from a shared queue. Every extent carries the
+position it has in the output file, so the workers write their data straight
+there with positional writes and the result does not depend on which worker
+fetched which batch.
+"""
+
+import os
+import queue
+import sys
+import threading
+import time
+
+import cbt_compress
+import cbt_io
+from cbt_bitmap import Extent, EXTENT_ZERO, changed_block_size
+from nbd_client import buffer_pool, new_nbd_client
+
+# Extents are handed out to the workers in batches of roughly this many bytes
+default_batch_size = 64 * 1024 * 1024
+# Progress is printed at most this often, in seconds
+default_progress_interval = 10
+
+
+def layout_extents(extents):
+    """
+    Lay out (offset, length) extents back to back, as in a changed blocks
+    file, and return them as a list of Extents.
+    """
+    data_offset = 0
+    result = []
+    for (offset, length) in extents:
+        result.append(Extent(offset, length, data_offset, length, 0))
+        data_offset += length
+    return result
+
+
+def whole_vdi_extents(vdi_size, max_length):
+    """
+    Return Extents covering a whole VDI of vdi_size bytes in pieces of at
+    most max_length bytes, each at its own offset in the output file
+    """
+    return [Extent(offset, min(max_length, vdi_size - offset), offset,
+                   min(max_length, vdi_size - offset), 0)
+            for offset in range(0, vdi_size, max_length)]
+
+
+class progress_reporter(object):
+    """
+    Prints how much of total bytes has been copied, at most every interval
+    seconds and at the end, as the workers finish extents. Like the
+    throughput, it goes to stderr, leaving stdout to the scripts' results.
+    """
+
+    def __init__(self, total, interval=default_progress_interval):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._next_report = self._start + interval
+
+    def add(self, length):
+        with self._lock:
+            self.done += length
+            now = time.monotonic()
+            if now < self._next_report and self.done < self.total:
+                return
+            self._next_report = now + self.interval
+            elapsed = now - self._start
+            print("%d of %d bytes done (%d%%) in %.0fs, %.1f MiB/s"
+                  % (self.done, self.total,
+                     self.done * 100 // self.total if self.total else 100,
+                     elapsed,
+                     self.done / elapsed / (1024 * 1024) if elapsed else 0),
+                  file=sys.stderr)
+
+
+def split_zero_extents(extent, data, block_size=changed_block_size):
+    """
+    Split an extent read as data into runs of blocks that are all zeros and
+    runs that are not, and return them as a list of (Extent, data) pairs.
+    The all-zero runs are flagged with EXTENT_ZERO and come with no data.
+    """
+    view = memoryview(data)
+    result = []
+    for (start, end, zero) in cbt_io.zero_runs(view, block_size):
+        if zero:
+            result.append((Extent(extent.offset + start, end - start,
+                                  extent.data_offset + start, 0,
+                                  extent.flags | EXTENT_ZERO), None))
+        else:
+            result.append((Extent(extent.offset + start, end - start,
+                                  extent.data_offset + start, end - start,
+                                  extent.flags), view[start:end]))
+    return result
+
+
+def zero_ranges(runs, block_size=changed_block_size):
+    """
+    Turn (offset, length, flags) runs of block status into (start, end)
+    ranges of whole blocks which read as zeros, so split extents stay block
+    aligned.
+    """
+    for (offset, length, flags) in runs:
+        if not flags & new_nbd_client.STATE_ZERO:
+            continue
+        zero_start = -(-offset // block_size) * block_size
+        zero_end = (offset + length) // block_size * block_size
+        if zero_start < zero_end:
+            yield (zero_start, zero_end)
+
+
+def split_zero_ranges(extents, ranges):
+    """
+    Split the parts of extents, a list of Extents in offset order, that fall
+    in ranges, a list of (start, end) pairs in offset order, off as
+    EXTENT_ZERO extents which need not be read at all.
+    """
+    result = []
+    i = 0
+    for extent in extents:
+        offset = extent.offset
+        extent_end = extent.offset + extent.length
+        while i < len(ranges) and ranges[i][1] <= offset:
+            i += 1
+        j = i
+        while offset < extent_end:
+            if j < len(ranges) and ranges[j][0] < extent_end:
+                (zero_start, zero_end) = ranges[j]
+            else:
+                (zero_start, zero_end) = (extent_end, extent_end)
+            zero_start = max(zero_start, offset)
+            zero_end = min(zero_end, extent_end)
+            data_offset = extent.data_offset + offset - extent.offset
+            if offset < zero_start:
+                result.append(Extent(offset, zero_start - offset, data_offset,
+                                     zero_start - offset, extent.flags))
+                data_offset += zero_start - offset
+            if zero_start < zero_end:
+                result.append(Extent(zero_start, zero_end - zero_start,
+                                     data_offset, 0,
+                                     extent.flags | EXTENT_ZERO))
+            offset = zero_end
+            j += 1
+    return result
+
+
+def split_unallocated_extents(client, extents, block_size=changed_block_size):
+    """
+    Ask the NBD server which parts of extents, a list of Extents in offset
+    order, read as zeros, and split those parts off as EXTENT_ZERO extents
+    which need not be read at all. Returns the extents unchanged if the
+    server does not support NBD_CMD_BLOCK_STATUS.
+    """
+    if not extents or not client.can_block_status():
+        return extents
+    start = extents[0].offset
+    end = extents[-1].offset + extents[-1].length
+    runs = client.block_status_extents(start, end - start)
+    return split_zero_ranges(extents, list(zero_ranges(runs, block_size)))
+
+
+def _batches(extents, batch_size):
+    batch = []
+    batch_bytes = 0
+    for extent in extents:
+        batch.append(extent)
+        batch_bytes += extent.length
+        if batch_bytes >= batch_size:
+            yield batch
+            batch = []
+            batch_bytes = 0
+    if batch:
+        yield batch
+
+
+def _read_pieces(client, extents, pool, detect_zeros):
+    by_offset = {extent.offset: extent for extent in extents}
+    requests = [(extent.offset, extent.length) for extent in extents]
+    for (offset, data) in client.read_pipelined(requests, pool=pool):
+        extent = by_offset[offset]
+        if detect_zeros:
+            for piece in split_zero_extents(extent, data):
+                yield piece
+        else:
+            yield (extent, data)
+
+
+def _worker(connect, index, work, fd, errors, results, detect_zeros,
+            journal, codec, executor, writer, progress, hasher):
+    try:
+        client = connect(index)
+        # Every reply is written out before the next one is received, so
+        # the worker can keep reusing the same few read buffers
+        pool = buffer_pool()
+        try:
+            while not errors:
+                try:
+                    batch = work.get_nowait()
+                except queue.Empty:
+                    return
+                if detect_zeros:
+                    batch = split_unallocated_extents(client, batch)
+                reads = []
+                for extent in batch:
+                    if extent.flags & EXTENT_ZERO:
+                        results.append(extent)
+                        if journal is not None:
+                            journal.add([extent])
+                        if progress is not None:
+                            progress.add(extent.length)
+                        if hasher is not None:
+                            hasher.add_zeros(extent.offset, extent.length)
+                    else:
+                        reads.append(extent)
+                pieces = _read_pieces(client, reads, pool, detect_zeros)
+                if hasher is not None:
+                    pieces = hasher.hash_pieces(pieces)
+                if codec is not None:
+                    # compressed in the pool while the next replies arrive
+                    pieces = cbt_compress.compress_pieces(pieces, codec,
+                                                          executor)
+                for (piece, piece_data) in pieces:
+                    if writer is not None and piece_data is not None:
+                        piece = writer.write(piece, piece_data)
+                    elif piece_data is not None:
+                        os.pwrite(fd, piece_data, piece.data_offset)
+                    results.append(piece)
+                    if journal is not None:
+                        journal.add([piece])
+                    if progress is not None:
+                        progress.add(piece.length)
+        finally:
+            client.close()
+    except Exception as e:
+        errors.append(e)
+
+
+def download_extents(connect, extents, output_path, connections=1,
+                     batch_size=default_batch_size, detect_zeros=False,
+                     journal=None, size=None, codec=None, progress=None,
+                     hasher=None):
+    """
+    Read extents, a list of Extents, over `connections` NBD clients created
+    by calling connect(worker_index), and write each extent at its
+    data_offset in output_path. With detect_zeros set, all-zero blocks are
+    left as holes in the output and split into extents of their own flagged
+    with EXTENT_ZERO, and if the server supports NBD_CMD_BLOCK_STATUS the
+    blocks it reports as zeros are not read in the first place. Returns the
+    list of extents written, in offset order.
+
+    Every extent written is recorded in journal, a cbt_journal.ExportJournal,
+    if one is given. If it already holds extents the export is being resumed:
+    output_path is kept rather than truncated, and size should be given as
+    the size of the whole output.
+
+    With a cbt_compress codec, the data of each extent is compressed in a
+    thread pool before it is written, and the data is packed back to back
+    in output_path, at the data_offsets of the extents returned, rather
+    than laid out as it is in extents; size is then ignored. The length of every extent written is
+    added to progress, a progress_reporter, if one is given, and the blocks
+    written are hashed as they arrive with hasher, a cbt_checksum.block_hasher,
+    if one is given.
+    """
+    work = queue.Queue()
+    for batch in _batches(extents, batch_size):
+        work.put(batch)
+    if size is None:
+        size = max([extent.data_offset + extent.length
+                    for extent in extents] or [0])
+
+    flags = os.O_WRONLY | os.O_CREAT
+    if journal is None or not journal.extents:
+        flags |= os.O_TRUNC
+    fd = os.open(output_path, flags, 0o644)
+    try:
+        writer = None
+        if codec is not None:
+            writer = cbt_compress.packed_writer(fd, cbt_compress.packed_end(
+                journal.extents if journal is not None else []))
+            size = writer.end
+        os.ftruncate(fd, size)
+        if journal is not None:
+            journal.data_fd = fd
+        errors = []
+        results = []
+        executor = cbt_compress.new_executor() if codec is not None else None
+        workers = [threading.Thread(target=_worker,
+                                    args=(connect, i, work, fd, errors,
+                                          results, detect_zeros, journal,
+                                          codec, executor, writer, progress,
+                                          hasher))
+                   for i in range(connections)]
+        start = time.monotonic()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if executor is not None:
+            executor.shutdown()
+        if errors:
+            raise errors[0]
+        if writer is not None:
+            os.ftruncate(fd, writer.end)
+        os.fsync(fd)
+    finally:
+        if journal is not None:
+            journal.checkpoint()
+            journal.data_fd = None
+        os.close(fd)
+
+    transferred = sum(extent.length for extent in extents)
+    report_throughput(transferred, time.monotonic() - start, connections)
+    return sorted(results)
+
+
+def report_throughput(transferred, elapsed, connections=1):
+    rate = transferred / elapsed / (1024 * 1024) if elapsed else 0
+    print("transferred %d bytes in %.2fs over %d connection(s): %.1f MiB/s"
+          % (transferred, elapsed, connections, rate), file=sys.stderr)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""
+Checks backups against the checksums saved with them by
+cbt_enable_and_snapshot.py and cbt_export_changes.py, without needing a
+second copy to compare them with.
+
+example: python cbt_verify.py -i <bitmap path> <changed blocks path>
+-i <bitmap path> <changed blocks path> ...
+
+checks every block of each increment given, and
+
+example: python cbt_verify.py -v <base VDI path>
+-i <bitmap path> <changed blocks path> -i <bitmap path> <changed blocks path>
+...
+
+checks every block of the VDI the base and increments, oldest first,
+restore to, without writing it anywhere. The blocks are read and hashed
+in parallel, and the numbers of any which do not match are printed, with
+the script exiting with status 1.
+
+With --spot-check N and the host details, N blocks chosen at random are
+also compared with the snapshot given by -s, read over NBD, which must not
+have had its data destroyed yet: blocks of the last increment given, or of
+the whole restored VDI if the base is given too.
+
+example: python cbt_verify.py -v <base VDI path> -i <bitmap path>
+<changed blocks path> --spot-check 100 -ip <host address> -u <host username>
+-p <host password> -s <snapshot uuid>
+"""
+
+import argparse
+import sys
+
+import XenAPI
+
+import cbt_checksum
+import cbt_compress
+import cbt_nbd_pool
+from cbt_chain import IncrementChain
+from cbt_serve_chain import chain_backend
+
+# Blocks are verified in batches of this many per task
+verify_batch_blocks = 256
+
+
+def verify_chain(base_path, increments, executor):
+    """
+    Check every block of the VDI the base VDI and (bitmap path, changed
+    blocks path) pairs of increments restore to against their checksums,
+    in parallel in executor. Without checksums of the base VDI only the
+    blocks of the increments can be checked. Returns the numbers of the
+    blocks which do not match.
+    """
+    expected = cbt_checksum.chain_checksums(base_path, increments)
+    backend = chain_backend(IncrementChain(base_path, increments), 0)
+    try:
+        blocks = sorted(expected)
+
+        def verify_blocks(start):
+            return [block for block in blocks[start:start +
+                                              verify_batch_blocks]
+                    if cbt_checksum.block_hash(backend.block(block))
+                    != expected[block]]
+
+        bad = []
+        for result in executor.map(verify_blocks,
+                                   range(0, len(blocks),
+                                         verify_batch_blocks)):
+            bad.extend(result)
+        return bad
+    finally:
+        backend.close()
+
+
+def verify(base_path, increments, threads=None):
+    """
+    Check the chain of the base VDI and increments, or each of the
+    increments if there is no base, and return the numbers of the blocks
+    which do not match their checksums
+    """
+    with cbt_compress.new_executor(threads) as executor:
+        if base_path is not None:
+            return verify_chain(base_path, increments, executor)
+        bad = []
+        for (bitmap_path, changed_blocks_path) in increments:
+            blocks = cbt_checksum.verify_increment(bitmap_path,
+                                                   changed_blocks_path,
+                                                   executor)
+            if blocks:
+                print("%s: %d blocks do not match"
+                      % (changed_blocks_path, len(blocks)))
+            bad.extend(blocks)
+        return bad
+
+
+def spot_check_snapshot(session, snapshot_uuid, base_path, increments,
+                        count):
+    """
+    Compare count blocks of the backup, chosen at random, with the snapshot
+    and return the numbers of those which differ
+    """
+    snapshot_ref = session.xenapi.VDI.get_by_uuid(snapshot_uuid)
+    nbd_info = session.xenapi.VDI.get_nbd_info(snapshot_ref)[0]
+    if base_path is not None:
+        source = chain_backend(IncrementChain(base_path, increments), 0)
+        (read_block, blocks) = (source.block, range(
+            -(-source.size() // source.block_size)))
+    else:
+        source = cbt_checksum.increment_reader(*increments[-1])
+        (read_block, blocks) = (source.read_block, source.blocks())
+    try:
+        client = cbt_nbd_pool.get().connect(nbd_info)
+        try:
+            return cbt_checksum.spot_check(client, read_block, blocks,
+                                           count, source.block_size)
+        finally:
+            client.close()
+    finally:
+        source.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-v', '--vdi-base', dest='vdi_base',
+                        help='Base VDI of the increments, to check the VDI '
+                             'they restore to')
+    parser.add_argument('-i', '--increment', dest='increments',
+                        action='append', nargs=2, default=[],
+                        metavar=('BITMAP', 'CHANGED_BLOCKS'),
+                        help='Bitmap and changed blocks of an increment, '
+                             'repeated oldest first')
+    parser.add_argument('-t', '--threads', dest='threads', type=int,
+                        help='Number of threads to read and hash blocks '
+                             'with, by default one per CPU')
+    parser.add_argument('--spot-check', dest='spot_check', type=int,
+                        default=0, metavar='N',
+                        help='Compare N blocks, chosen at random, with the '
+                             'snapshot given by -s')
+    parser.add_argument('-ip', '--host-ip', dest='host')
+    parser.add_argument('-u', '--username', dest='username')
+    parser.add_argument('-p', '--password', dest='password')
+    parser.add_argument('-s', '--snapshot-uuid', dest='snapshot_uuid')
+    args = parser.parse_args()
+    if args.vdi_base is None and not args.increments:
+        parser.error("give a base VDI, increments or both to verify")
+    if args.spot_check and not (args.host and args.snapshot_uuid):
+        parser.error("--spot-check needs -ip, -u, -p and -s")
+
+    bad = verify(args.vdi_base, args.increments, args.threads)
+    if bad:
+        print("%d blocks do not match their checksums: %s"
+              % (len(bad), " ".join(str(block) for block in bad[:20])))
+    else:
+        print("all blocks match their checksums")
+
+    if args.spot_check:
+        session = XenAPI.Session("https://" + args.host, ignore_ssl=True)
+        session.login_with_password(args.username, args.password, "0.1",
+                                    "CBT example")
+        try:
+            differ = spot_check_snapshot(session, args.snapshot_uuid,
+                                         args.vdi_base, args.increments,
+                                         args.spot_check)
+        finally:
+            session.xenapi.session.logout(session)
+        if differ:
+            print("%d blocks differ from the snapshot: %s"
+                  % (len(differ),
+                     " ".join(str(block) for block in differ[:20])))
+            bad.extend(differ)
+        else:
+            print("spot check of %d blocks against the snapshot passed"
+                  % args.spot_check)
+
+    if bad:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,17 +6,50 @@ snapshot data.
 
 example: python cbt_vm_metadata_export.py -ip <host address> -u <host username>
 -p <host password> -v <vm uuid> -o <metadata output path>
+
+With -d <metadata directory> instead of -o, the metadata of any number of
+VMs, given by repeating -v, is exported concurrently over a pool of HTTPS
+connections and kept in the directory as versions:
+
+    index.json          the versions of each VM's metadata, oldest first:
+                        version number, SHA-256 of the metadata, file and
+                        the time it was exported
+    <vm uuid>/<version> the metadata of each version
+
+A new version is only stored when the metadata differs from the VM's
+latest version, so running the export with every backup costs nothing
+for VMs whose configuration has not changed. cbt_vm_metadata_import.py -d
+picks the version to import from the index.
+
+Exports into the same directory from several processes take turns: each
+holds an flock on index.lock from reading the index to writing it back, so
+no versions are lost. Metadata left as a plain <vm uuid> file by earlier
+versions of these scripts becomes version 1 of the VM the next time it is
+exported.
 """
 
 
 import XenAPI
+import concurrent.futures
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
 import shutil
+import threading
+import time
 import urllib3
 import requests
 import argparse
 import re
 import sys
 
+index_file_name = "index.json"
+lock_file_name = "index.lock"
+# Number of VMs whose metadata is exported at once
+default_workers = 8
+
 
 def export_vm(host, session_id, vm_uuid, export_path):
     # export_snapshots option determines whether vm snapshot data is included
@@ -35,23 +68,228 @@ def export_vm(host, session_id, vm_uuid, export_path):
 
     print("Metadata saved to: %s" % export_path)
 
+
+class metadata_store(object):
+    """
+    The versions of the metadata of many VMs kept in directory, as
+    described above. Safe to use from several threads; versions must only
+    be added while the store is locked.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _index_path(self):
+        return os.path.join(self.directory, index_file_name)
+
+    def _load(self):
+        try:
+            with open(self._index_path()) as index_file:
+                self.index = json.load(index_file)
+        except FileNotFoundError:
+            self.index = {}
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        A context manager holding the lock on the directory, shared with
+        other processes, which reloads the index on entry and saves it on
+        exit
+        """
+        with open(os.path.join(self.directory, lock_file_name),
+                  'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                self._load()
+                try:
+                    yield self
+                finally:
+                    self.save()
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def save(self):
+        """Write the index, under a temporary name renamed into place"""
+        with self._lock:
+            temporary_path = self._index_path() + ".tmp"
+            with open(temporary_path, 'w') as index_file:
+                json.dump(self.index, index_file, indent=2, sort_keys=True)
+                index_file.flush()
+                os.fsync(index_file.fileno())
+            os.replace(temporary_path, self._index_path())
+
+    def latest(self, vm_uuid):
+        versions = self.index.get(vm_uuid)
+        return versions[-1] if versions else None
+
+    def _legacy_path(self, vm_uuid):
+        path = os.path.join(self.directory, vm_uuid)
+        return path if os.path.isfile(path) else None
+
+    def _migrate(self, vm_uuid):
+        """
+        Move metadata left as a plain file named after the VM into the VM's
+        directory, as its version 1
+        """
+        legacy_path = self._legacy_path(vm_uuid)
+        if legacy_path is None:
+            return
+        with open(legacy_path, 'rb') as metadata:
+            digest = hashlib.sha256(metadata.read()).hexdigest()
+        exported = os.stat(legacy_path).st_mtime
+        temporary_path = legacy_path + ".migrating"
+        os.replace(legacy_path, temporary_path)
+        os.makedirs(legacy_path)
+        path = os.path.join(vm_uuid, "1")
+        os.replace(temporary_path, os.path.join(self.directory, path))
+        with self._lock:
+            self.index[vm_uuid] = [{'version': 1, 'sha256': digest,
+                                    'path': path, 'exported': exported}]
+
+    def add(self, vm_uuid, data, exported=None):
+        """
+        Store data as the next version of the metadata of the VM, unless it
+        is the same as the latest version. Returns the version number and
+        whether a new version was stored.
+        """
+        self._migrate(vm_uuid)
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            latest = self.latest(vm_uuid)
+            if latest is not None and latest['sha256'] == digest:
+                return (latest['version'], False)
+            version = latest['version'] + 1 if latest is not None else 1
+            path = os.path.join(vm_uuid, "%d" % version)
+        os.makedirs(os.path.join(self.directory, vm_uuid), exist_ok=True)
+        # the data is on disk before the index refers to it
+        with open(os.path.join(self.directory, path), 'wb') as metadata:
+            metadata.write(data)
+            metadata.flush()
+            os.fsync(metadata.fileno())
+        with self._lock:
+            self.index.setdefault(vm_uuid, []).append(
+                {'version': version, 'sha256': digest, 'path': path,
+                 'exported': exported if exported is not None
+                 else time.time()})
+        return (version, True)
+
+    def resolve(self, vm_uuid, version=None, before=None):
+        """
+        Return the path of the given version of the VM's metadata, or of
+        the latest version exported at or before the time before, in
+        seconds since the epoch, or of its latest version
+        """
+        versions = self.index.get(vm_uuid)
+        legacy_path = self._legacy_path(vm_uuid)
+        if not versions and legacy_path is not None:
+            # not exported since the directory held plain files
+            versions = [{'version': 1, 'path': vm_uuid,
+                         'exported': os.stat(legacy_path).st_mtime}]
+        if not versions:
+            raise KeyError("no metadata of VM %s in %s"
+                           % (vm_uuid, self.directory))
+        if version is not None:
+            versions = [entry for entry in versions
+                        if entry['version'] == version]
+        if before is not None:
+            versions = [entry for entry in versions
+                        if entry['exported'] <= before]
+        if not versions:
+            raise KeyError("no matching version of the metadata of VM %s"
+                           % vm_uuid)
+        return os.path.join(self.directory, versions[-1]['path'])
+
+
+def _fetch_metadata(http_session, host, session_id, vm_uuid):
+    url = ("https://%s/export_metadata?session_id=%s&uuid=%s"
+           "&export_snapshots=false"
+           % (host, session_id, vm_uuid))
+    request = http_session.get(url, verify=False)
+    request.raise_for_status()
+    return request.content
+
+
+def export_vms(host, session_id, vm_uuids, directory,
+               workers=default_workers):
+    """
+    Export the metadata of every VM in vm_uuids concurrently, over at most
+    workers HTTPS connections, into the metadata_store in directory.
+    Returns a dict from VM uuid to (version, whether it was new), or to the
+    exception its export failed with.
+    """
+    store = metadata_store(directory)
+    results = {}
+    # ToDo: Security - We need to verify the SSL certificate here.
+    # Depends on CP-23051.
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    with store.locked(), requests.Session() as http_session:
+        # one kept-alive connection per worker, reused from VM to VM
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=workers)
+        http_session.mount("https://", adapter)
+
+        def export(vm_uuid):
+            return store.add(vm_uuid, _fetch_metadata(http_session, host,
+                                                      session_id, vm_uuid))
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = dict((vm_uuid, executor.submit(export, vm_uuid))
+                           for vm_uuid in vm_uuids)
+            for (vm_uuid, future) in futures.items():
+                try:
+                    results[vm_uuid] = future.result()
+                except Exception as e:
+                    results[vm_uuid] = e
+    return results
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-ip', '--host-ip', dest='host')
     parser.add_argument('-u', '--username', dest='username')
     parser.add_argument('-p', '--password', dest='password')
-    parser.add_argument('-v', '--vm-uuid', dest='vm_uuid')
+    parser.add_argument('-v', '--vm-uuid', dest='vm_uuids', action='append',
+                        default=[], help='VM to export, can be repeated with '
+                                         '-d')
     parser.add_argument('-o', '--output-path', dest='output_path')
+    parser.add_argument('-d', '--directory', dest='directory',
+                        help='Keep the metadata of every VM given as '
+                             'versions in this directory')
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+                        default=default_workers,
+                        help='Number of VMs to export at once with -d')
     args = parser.parse_args()
+    if args.directory is None and len(args.vm_uuids) != 1:
+        parser.error("-o exports a single VM, use -d for several")
     session = XenAPI.Session("https://" + args.host, ignore_ssl=True)
     session.login_with_password(args.username, args.password, "0.1",
                                 "CBT example")
 
+    failed = False
     try:
-        export_vm(args.host, session._session, args.vm_uuid, args.output_path)
+        if args.directory is None:
+            export_vm(args.host, session._session, args.vm_uuids[0],
+                      args.output_path)
+        else:
+            results = export_vms(args.host, session._session, args.vm_uuids,
+                                 args.directory, args.workers)
+            for (vm_uuid, result) in sorted(results.items()):
+                if isinstance(result, Exception):
+                    failed = True
+                    print("%s failed: %s" % (vm_uuid, result))
+                else:
+                    (version, new) = result
+                    print("%s version %d%s" % (vm_uuid, version,
+                                                "" if new else
+                                                " (unchanged)"))
 
     finally:
         session.xenapi.session.logout()
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
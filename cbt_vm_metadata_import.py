@@ -9,10 +9,22 @@ be created before this script is run.
 example: python cbt_vm_metadata_import.py -ip <host address>
 -u <host username> -p <host password> -v <vm uuid> -i <metadata output path>
 <old vdi uuid> <new vdi uuid> ...
+
+Metadata kept as versions by cbt_vm_metadata_export.py -d is imported by
+giving the directory instead of -i, along with --version to pick a version
+or --before to pick the latest version exported at or before a time, such
+as that of the backup being restored:
+
+example: python cbt_vm_metadata_import.py -ip <host address>
+-u <host username> -p <host password> -v <vm uuid> -d <metadata directory>
+--before 2026-10-18T02:00:00 <old vdi uuid> <new vdi uuid> ...
+
+Without either the VM's latest version is imported.
 """
 
 
 import XenAPI
+import datetime
 import shutil
 import urllib3
 import requests
@@ -20,6 +32,8 @@ import argparse
 import re
 import sys
 
+from cbt_vm_metadata_export import metadata_store
+
 
 def import_vm(host, session, import_path, vdis=None):
 
@@ -51,6 +65,14 @@ def import_vm(host, session, import_path, vdis=None):
     return vm_ref
 
 
+def resolve_metadata(directory, vm_uuid, version=None, before=None):
+    """
+    Return the path of the version of the VM's metadata to import from the
+    metadata directory written by cbt_vm_metadata_export.export_vms
+    """
+    return metadata_store(directory).resolve(vm_uuid, version, before)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-ip', '--host-ip', dest='host')
@@ -58,8 +80,23 @@ def main():
     parser.add_argument('-p', '--password', dest='password')
     parser.add_argument('-v', '--vm-uuid', dest='vm_uuid')
     parser.add_argument('-i', '--input-path', dest='input_path')
+    parser.add_argument('-d', '--directory', dest='directory',
+                        help='Import a version of the VM\'s metadata from '
+                             'this directory instead of -i')
+    parser.add_argument('--version', dest='version', type=int,
+                        help='Version of the metadata to import with -d')
+    parser.add_argument('--before', dest='before',
+                        type=datetime.datetime.fromisoformat,
+                        help='Import the latest version exported at or '
+                             'before this local time, such as '
+                             '2026-10-18T02:00:00, with -d')
     parser.add_argument('vars', nargs='*')
     args = parser.parse_args()
+    if args.directory:
+        before = args.before.timestamp() if args.before else None
+        args.input_path = resolve_metadata(args.directory, args.vm_uuid,
+                                           args.version, before)
+        print("importing %s" % args.input_path)
     session = XenAPI.Session("https://" + args.host, ignore_ssl=True)
     session.login_with_password(args.username, args.password, "0.1",
                                 "CBT example")
@@ -6,15 +6,35 @@ new VDI which contains the changed blocks. This script will be run before
 restoring the host VDI to create a VDI which includes all the blocks up to the
 point in time you wish to restore to. As this script only applies one set
 changed blocks at a time it may need to be run multiple times if you have had
-a number of snapshots.
+a number of snapshots; cbt_restore_chain.py applies a whole chain of them in
+a single pass.
 
 example: python cbt_write_changed_blocks_to_base_VDI.py -v <base VDI path>
 -b <bitmap path> -c <changed blocks path> -o <output VDI path>
 
 Script will output a VDI to the output path specified.
+
+With --in-place the changed blocks are written straight over the base VDI
+and no output path is needed. With --reflink the base VDI is first cloned to
+the output path, sharing its blocks where the filesystem supports reflinks,
+and the clone is then patched in place. In both modes only the changed
+blocks are written, so the time taken depends on the size of the changes
+rather than the size of the VDI.
+
+Blocks that are all zeros are left as holes in the output VDI, or punched
+out of it when patching in place, rather than written, unless --no-sparse
+is given.
+
+Changed blocks files exported with --compress are decompressed as they are
+applied.
 """
 
 import argparse
+import os
+import cbt_bitmap
+import cbt_compress
+import cbt_io
+import cbt_metrics
 
 # CBT tracks 64KB blocks. Therefore each bit in the bitmap corresponds to a
 # 64KB block on the VDI.
@@ -22,48 +42,112 @@ changed_block_size = 64 * 1024
 
 
 def write_changed_blocks_to_base_VDI(vdi_path, changed_block_path, bitmap_path,
-                                     output_path):
-    bitmap = open(bitmap_path, 'r')
+                                     output_path, sparse=True):
+    bitmap = cbt_bitmap.read_bitmap_file(bitmap_path)
+    codec = cbt_compress.bitmap_codec(bitmap)
     vdi = open(vdi_path, 'r+b')
     blocks = open(changed_block_path, 'r+b')
     combined_vdi = open(output_path, 'wb')
 
     try:
-        bitmap_r = bitmap.read()
-        cb_offset = 0
-        for x in range(0, len(bitmap_r)):
-            offset = x * changed_block_size
-            if bitmap_r[x] == "1":
-                blocks.seek(cb_offset)
-                blocks_r = blocks.read(changed_block_size)
-                combined_vdi.write(blocks_r)
-                cb_offset += changed_block_size
-            else:
-                vdi.seek(offset)
-                vdi_r = vdi.read(changed_block_size)
-                combined_vdi.write(vdi_r)
+        vdi_fd = vdi.fileno()
+        blocks_fd = blocks.fileno()
+        combined_fd = combined_vdi.fileno()
+        # Anything not written below reads back as zeros
+        os.ftruncate(combined_fd, bitmap.vdi_size)
+        offset = 0
+        for extent in bitmap.extents:
+            # Everything up to this extent is unchanged, take it from the base
+            cbt_io.copy_range(vdi_fd, offset, combined_fd, offset,
+                              extent.offset - offset, sparse)
+            if not (sparse and extent.flags & cbt_bitmap.EXTENT_ZERO):
+                cbt_compress.copy_extent(blocks_fd, extent, codec,
+                                         combined_fd)
+            offset = extent.offset + extent.length
+        cbt_io.copy_range(vdi_fd, offset, combined_fd, offset,
+                          bitmap.vdi_size - offset, sparse)
     finally:
-        bitmap.close()
         vdi.close()
         blocks.close()
         combined_vdi.close()
 
 
+def write_changed_blocks_in_place(vdi_path, changed_block_path, bitmap_path,
+                                  sparse=True):
+    bitmap = cbt_bitmap.read_bitmap_file(bitmap_path)
+    codec = cbt_compress.bitmap_codec(bitmap)
+    vdi = open(vdi_path, 'r+b')
+    blocks = open(changed_block_path, 'rb')
+
+    try:
+        vdi_fd = vdi.fileno()
+        # The VDI may have grown since the base was taken
+        if os.fstat(vdi_fd).st_size < bitmap.vdi_size:
+            os.ftruncate(vdi_fd, bitmap.vdi_size)
+        for extent in bitmap.extents:
+            if sparse and extent.flags & cbt_bitmap.EXTENT_ZERO:
+                cbt_io.punch_hole(vdi_fd, extent.offset, extent.length)
+            else:
+                cbt_compress.copy_extent(blocks.fileno(), extent, codec,
+                                         vdi_fd)
+        os.fsync(vdi_fd)
+    finally:
+        vdi.close()
+        blocks.close()
+
+
+def write_changed_blocks_to_reflinked_VDI(vdi_path, changed_block_path,
+                                          bitmap_path, output_path,
+                                          sparse=True):
+    if not cbt_io.clone_file(vdi_path, output_path):
+        print("Filesystem does not support reflinks, copied the base VDI")
+    write_changed_blocks_in_place(output_path, changed_block_path,
+                                  bitmap_path, sparse)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--vdi-base', dest='vdi_base')
     parser.add_argument('-b', '--bitmap', dest='bitmap')
     parser.add_argument('-c', '--changed-blocks', dest='changed_blocks')
     parser.add_argument('-o', '--output', dest='output')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--in-place', dest='in_place', action='store_const',
+                      const=True, default=False,
+                      help='Write the changed blocks over the base VDI')
+    mode.add_argument('--reflink', dest='reflink', action='store_const',
+                      const=True, default=False,
+                      help='Clone the base VDI to the output path and write '
+                           'the changed blocks over the clone')
+    parser.add_argument('--no-sparse', dest='sparse', action='store_const',
+                        const=False, default=True,
+                        help='Write all-zero blocks out instead of leaving '
+                             'holes')
+    cbt_metrics.add_arguments(parser)
     args = parser.parse_args()
+    if args.output is None and not args.in_place:
+        parser.error("-o is needed unless writing --in-place")
+    cbt_metrics.configure_from_args(args)
 
     base_vdi_path = args.vdi_base
     changed_blocks_path = args.changed_blocks
     bitmap_path = args.bitmap
     output_path = args.output
 
-    write_changed_blocks_to_base_VDI(args.vdi_base, args.changed_blocks,
-                                     args.bitmap, args.output)
+    with cbt_metrics.phase('merge'):
+        if args.in_place:
+            write_changed_blocks_in_place(args.vdi_base, args.changed_blocks,
+                                          args.bitmap, args.sparse)
+        elif args.reflink:
+            write_changed_blocks_to_reflinked_VDI(args.vdi_base,
+                                                  args.changed_blocks,
+                                                  args.bitmap, args.output,
+                                                  args.sparse)
+        else:
+            write_changed_blocks_to_base_VDI(args.vdi_base,
+                                             args.changed_blocks,
+                                             args.bitmap, args.output,
+                                             args.sparse)
 
 
 if __name__ == "__main__":
@@ -12,7 +12,6 @@ VM=$5
 BASE_VDI_PATH="./testvdi.raw"
 BITMAP_PATH="./bitmap"
 CHANGED_BLOCK_PATH="./testblocks.raw"
-COMBINED_VDI_PATH="./testcombined.raw"
 METADATA_PATH="./metadata"
 CONNECTION="-ip $HOST -u $USERNAME -p $PASSWORD"
 
@@ -27,11 +26,8 @@ echo "Taking new snapshot and exporting changed blocks"
 OUTPUT=$(python3 cbt_export_changes.py $CONNECTION -v $VDI -s $BASE_SNAPSHOT_UUID -co $CHANGED_BLOCK_PATH -bo $BITMAP_PATH)
 echo ${OUTPUT##* } 
 
-echo "Writing changed blocks to base VDI"
-python3 cbt_write_changed_blocks_to_base_VDI.py -v $BASE_VDI_PATH -b $BITMAP_PATH -c $CHANGED_BLOCK_PATH -o $COMBINED_VDI_PATH
-
-echo "Importing new VDI back to host"
-NEW_VDI=$(python3 cbt_import_whole_vdi.py $CONNECTION -v $VDI -f $COMBINED_VDI_PATH --as-new-vdi)
+echo "Importing base VDI with the changed blocks applied back to host"
+NEW_VDI=$(python3 cbt_import_whole_vdi.py $CONNECTION -v $VDI -f $BASE_VDI_PATH -i $BITMAP_PATH $CHANGED_BLOCK_PATH --as-new-vdi)
 echo $NEW_VDI
 
 echo "Importing metadata to host"
@@ -15,67 +15,246 @@
 # https://github.com/cloudius-systems/osv/blob/master/scripts/nbd_client.py ,
 # added support for (non-fixed) newstyle negotation.
 
+import collections
+import select
 import socket
 import struct
 import ssl
+import time
+
+
+def tls_context(ca_cert=None, ca_data=None):
+    """
+    Return an SSLContext trusting the CA certificate in the PEM file ca_cert
+    or the PEM text ca_data. One context can be shared by any number of
+    connections, and TLS sessions can only be resumed within the context
+    they were made in.
+    """
+    # Forcing the client to use TLSv1_2
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS)
+    context.options &= ~ssl.OP_NO_TLSv1
+    context.options &= ~ssl.OP_NO_TLSv1_1
+    context.options &= ~ssl.OP_NO_SSLv2
+    context.options &= ~ssl.OP_NO_SSLv3
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.check_hostname = True
+    context.load_verify_locations(cafile=ca_cert, cadata=ca_data)
+    return context
+
+
+class _pending_request(object):
+    """A request sent to the server which is still waiting for its reply"""
+
+    def __init__(self, request_type, offset, length, data, zeroed=False):
+        self.request_type = request_type
+        self.offset = offset
+        self.length = length
+        # for reads, the buffer the reply is received straight into
+        self.data = data
+        # whether data is known to start out as zeros
+        self.zeroed = zeroed
+        self.errno = 0
+        # when the request was sent, if metrics are being recorded
+        self.sent = None
+
+
+class buffer_pool(object):
+    """
+    Read buffers which are handed back after use and reused for later
+    requests instead of allocating a new one for every reply. At most
+    max_buffers free buffers of each size are kept.
+    """
+
+    def __init__(self, max_buffers=64):
+        self.max_buffers = max_buffers
+        self._free = collections.defaultdict(list)
+
+    def get(self, length):
+        free = self._free[length]
+        if free:
+            return free.pop()
+        return bytearray(length)
+
+    def put(self, buf):
+        free = self._free[len(buf)]
+        if len(free) < self.max_buffers:
+            free.append(buf)
 
 
 class new_nbd_client(object):
+    """
+    The CA certificate to require TLS with can be given as the path of a
+    PEM file with ca_cert, as PEM text with ca_data, or as a ready made
+    ssl_context from tls_context. tls_session is a TLS session of an
+    earlier connection made with the same ssl_context, which is resumed
+    instead of doing a full handshake if the server still has it.
+    """
 
     READ = 0
     WRITE = 1
     DISCONNECT = 2
     FLUSH = 3
+    WRITE_ZEROES = 6
+    BLOCK_STATUS = 7
 
     FLAG_HAS_FLAGS = (1 << 0)
     FLAG_SEND_FLUSH = (1 << 2)
+    FLAG_SEND_WRITE_ZEROES = (1 << 6)
 
     NBD_OPT_EXPORT_NAME = 1
     NBD_OPT_STARTTLS = 5
+    NBD_OPT_INFO = 6
+    NBD_OPT_GO = 7
+    NBD_OPT_STRUCTURED_REPLY = 8
+    NBD_OPT_SET_META_CONTEXT = 10
     NBD_REP_ACK = (1)
+    NBD_REP_INFO = 3
+    NBD_REP_META_CONTEXT = 4
+    NBD_REP_ERR_UNSUP = (1 << 31) + 1
+    NBD_INFO_EXPORT = 0
     # Cflags contains the NBD_FLAG_C_FIXED_NEWSTYLE flag
     cflags = (1 << 0)
 
     NBD_REQUEST_MAGIC = 0x25609513
     NBD_REPLY_MAGIC = 0x67446698
+    NBD_OPTION_REPLY_MAGIC = 0x3e889045565a9
+    NBD_STRUCTURED_REPLY_MAGIC = 0x668e33ef
+
+    NBD_REPLY_FLAG_DONE = (1 << 0)
+    NBD_REPLY_TYPE_NONE = 0
+    NBD_REPLY_TYPE_OFFSET_DATA = 1
+    NBD_REPLY_TYPE_OFFSET_HOLE = 2
+    NBD_REPLY_TYPE_BLOCK_STATUS = 5
+    NBD_REPLY_TYPE_ERROR_BIT = (1 << 15)
+
+    # The only metadata context we ask for, and its status flags
+    BASE_ALLOCATION = b'base:allocation'
+    STATE_HOLE = (1 << 0)
+    STATE_ZERO = (1 << 1)
+    # Largest range block_status_extents asks about in one request
+    MAX_BLOCK_STATUS_LENGTH = 1 << 30
+
+    # Number of requests read_pipelined and write_pipelined keep in flight
+    # unless told otherwise
+    DEFAULT_QUEUE_DEPTH = 16
+    # Write payloads smaller than this are sent in one piece with the header
+    SMALL_WRITE_SIZE = 64 * 1024
+
+    # Request types as they are labelled in metrics
+    REQUEST_NAMES = {READ: 'read', WRITE: 'write', FLUSH: 'flush',
+                     WRITE_ZEROES: 'write_zeroes',
+                     BLOCK_STATUS: 'block_status'}
 
     def __init__(self, hostname, export_name="", ca_cert=None,
-                 tls_hostname=None, port=10809):
+                 tls_hostname=None, port=10809,
+                 queue_depth=DEFAULT_QUEUE_DEPTH, rate_limit=None,
+                 metrics=None, ca_data=None, ssl_context=None,
+                 tls_session=None):
         self._flushed = True
         self._closed = True
         self._handle = 0
+        self._transmission_flags = 0
+        self._structured_replies = False
+        self._meta_context_id = None
+        # handle -> _pending_request of requests awaiting a reply
+        self._in_flight = {}
+        # handle -> (data, errno) of replies received out of order
+        self._replies = {}
+        self.queue_depth = queue_depth
+        # anything with a consume(length) method, such as a
+        # cbt_rate_limit.limiter, which waits until a request of length
+        # bytes may be sent
+        self.rate_limit = rate_limit
+        # a cbt_metrics.metrics recording request latencies, queue depths
+        # and handshake times, or None
+        self.metrics = metrics
         self.ca_cert = ca_cert
+        self.ca_data = ca_data
+        self.ssl_context = ssl_context
+        self.tls_session = tls_session
+        # whether tls_session was resumed
+        self.tls_resumed = False
         self.tls_hostname = tls_hostname
         if not self.tls_hostname:
             self.tls_hostname = hostname
+        start = time.monotonic()
         self._s = socket.create_connection((hostname, port))
         self._closed = False
         self._fixed_new_style_handshake(export_name)
+        if self.metrics is not None:
+            self.metrics.observe('nbd_connect_seconds',
+                                 time.monotonic() - start)
 
     def __del__(self):
         self.close()
 
     def close(self):
+        if not self._closed:
+            # drain replies of requests left behind by an abandoned pipeline
+            while self._in_flight:
+                self._parse_reply()
+            self._replies.clear()
         if not self._flushed:
             self.flush()
         if not self._closed:
             self._disconnect()
             self._closed = True
 
+    def is_connected(self):
+        """
+        Return whether the server still has the connection open, without
+        blocking. Only for a connection with no requests in flight, such as
+        one kept idle for reuse; one found to be gone is closed.
+        """
+        if self._closed:
+            return False
+        if not select.select([self._s], [], [], 0)[0]:
+            return True
+        timeout = self._s.gettimeout()
+        self._s.settimeout(0)
+        try:
+            # No reply is due, so unless all that arrived was TLS records
+            # such as session tickets, the server has closed the connection
+            # or it is out of step
+            self._s.recv(1)
+        except (ssl.SSLWantReadError, BlockingIOError):
+            return True
+        except OSError:
+            pass
+        finally:
+            self._s.settimeout(timeout)
+        self._s.close()
+        self._flushed = True
+        self._closed = True
+        return False
+
     def _upgrade_socket_to_TLS(self):
         thesocket = self._s
-        # Forcing the client to use TLSv1_2
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS)
-        context.options &= ~ssl.OP_NO_TLSv1
-        context.options &= ~ssl.OP_NO_TLSv1_1
-        context.options &= ~ssl.OP_NO_SSLv2
-        context.options &= ~ssl.OP_NO_SSLv3
-        context.verify_mode = ssl.CERT_REQUIRED
-        context.check_hostname = True
-        context.load_verify_locations(cafile=self.ca_cert)
+        context = self.ssl_context
+        if context is None:
+            context = tls_context(self.ca_cert, self.ca_data)
+        start = time.monotonic()
         self._s = context.wrap_socket(thesocket, server_side=False,
                                       do_handshake_on_connect=True,
-                                      server_hostname=self.tls_hostname)
+                                      server_hostname=self.tls_hostname,
+                                      session=self.tls_session)
+        self.tls_resumed = self._s.session_reused
+        if self.metrics is not None:
+            self.metrics.observe('nbd_tls_handshake_seconds',
+                                 time.monotonic() - start)
+            if self.tls_resumed:
+                self.metrics.add('nbd_tls_sessions_resumed', 1)
+
+    def get_tls_session(self):
+        """
+        Return the TLS session of the connection, for the next connection
+        to the same server to resume, or None if it does not use TLS
+        """
+        if isinstance(self._s, ssl.SSLSocket):
+            # with TLS 1.3 this is only known once the server's session
+            # tickets have been received, after the handshake
+            return self._s.session
+        return None
 
     def _initiate_TLS_upgrade(self):
         # start TLS negotiation
@@ -111,12 +290,78 @@ class new_nbd_client(object):
         client_flags = struct.pack('>L', self.cflags)
         self._s.sendall(client_flags)
 
-        if self.ca_cert:
+        if self.ca_cert or self.ca_data or self.ssl_context:
             # start TLS negotiation
             self._initiate_TLS_upgrade()
             # upgrade socket to TLS
             self._upgrade_socket_to_TLS()
 
+        self._structured_replies = self._negotiate_structured_replies()
+        if self._structured_replies:
+            self._meta_context_id = self._set_meta_context(export_name)
+        if not self._request_export_info(self.NBD_OPT_GO, export_name):
+            # older servers only know the original way of choosing an export
+            self._request_export_by_name(export_name)
+
+    def _send_option(self, option, data=b''):
+        self._s.sendall(b'IHAVEOPT' + struct.pack('>LL', option, len(data)) +
+                        data)
+
+    def _receive_option_reply(self, option):
+        (magic, reply_option, reply_type, length) = \
+            struct.unpack('>QLLL', self._recv(8 + 4 + 4 + 4))
+        assert(magic == self.NBD_OPTION_REPLY_MAGIC)
+        assert(reply_option == option)
+        return (reply_type, self._recv(length))
+
+    def _negotiate_structured_replies(self):
+        self._send_option(self.NBD_OPT_STRUCTURED_REPLY)
+        (reply_type, _) = self._receive_option_reply(
+            self.NBD_OPT_STRUCTURED_REPLY)
+        return reply_type == self.NBD_REP_ACK
+
+    def _set_meta_context(self, export_name):
+        name = str.encode(export_name)
+        query = self.BASE_ALLOCATION
+        self._send_option(self.NBD_OPT_SET_META_CONTEXT,
+                          struct.pack('>L', len(name)) + name +
+                          struct.pack('>LL', 1, len(query)) + query)
+        context_id = None
+        while True:
+            (reply_type, data) = self._receive_option_reply(
+                self.NBD_OPT_SET_META_CONTEXT)
+            if reply_type != self.NBD_REP_META_CONTEXT:
+                # NBD_REP_ACK, or an error if the server has no such context
+                return context_id
+            if data[4:] == query:
+                context_id = struct.unpack('>L', data[:4])[0]
+
+    def _request_export_info(self, option, export_name):
+        """
+        Ask for export_name with NBD_OPT_GO, or just about it with
+        NBD_OPT_INFO, and record its size and transmission flags. Returns
+        False if the server does not support the option.
+        """
+        name = str.encode(export_name)
+        # no information requests: NBD_INFO_EXPORT is always sent
+        self._send_option(option, struct.pack('>L', len(name)) + name +
+                          struct.pack('>H', 0))
+        while True:
+            (reply_type, data) = self._receive_option_reply(option)
+            if reply_type == self.NBD_REP_INFO:
+                info_type = struct.unpack('>H', data[:2])[0]
+                if info_type == self.NBD_INFO_EXPORT:
+                    (self._size, self._transmission_flags) = \
+                        struct.unpack('>QH', data[2:12])
+            elif reply_type == self.NBD_REP_ACK:
+                return True
+            elif reply_type == self.NBD_REP_ERR_UNSUP:
+                return False
+            else:
+                raise IOError("NBD server refused export '%s' (reply %x)"
+                              % (export_name, reply_type))
+
+    def _request_export_by_name(self, export_name):
         # request export
         self._s.sendall(b'IHAVEOPT')
         option = struct.pack('>L', self.NBD_OPT_EXPORT_NAME)
@@ -127,33 +372,139 @@ class new_nbd_client(object):
 
         # fixed newstyle negotiation: we get this if the server is willing
         # to allow the export
-        buf = self._s.recv(8)
-        self._size = struct.unpack(">Q", buf)[0]
-        # ignore the transmission flags (& zeroes)
-        self._s.recv(2 + 124)
+        buf = self._recv(8 + 2)
+        (self._size, self._transmission_flags) = struct.unpack(">QH", buf)
+        # ignore the zeroes
+        self._recv(124)
 
-    def _build_header(self, request_type, offset, length):
-        print("NBD request offset=%d length=%d" % (offset, length))
+    def _build_header(self, request_type, handle, offset, length):
         command_flags = 0
         header = struct.pack('>LHHQQL', self.NBD_REQUEST_MAGIC, command_flags,
-                             request_type, self._handle, offset, length)
+                             request_type, handle, offset, length)
         return header
 
-    def _parse_reply(self, data_length=0):
-        print("NBD parsing response, data_length=%d" % data_length)
-        reply = self._s.recv(4 + 4 + 8)
-        (magic, errno, handle) = struct.unpack(">LLQ", reply)
-        print("NBD response magic='%x' errno='%d' handle='%d'" % (magic, errno,
-                                                                  handle))
-        assert(magic == self.NBD_REPLY_MAGIC)
-        assert(handle == self._handle)
+    def _send_request(self, request_type, offset, length, data=b'',
+                      buffer=None):
+        if self.rate_limit is not None:
+            if request_type in (self.READ, self.WRITE):
+                self.rate_limit.consume(length)
+            elif request_type == self.WRITE_ZEROES:
+                # no data goes over the network
+                self.rate_limit.consume(0)
+        handle = self._handle
         self._handle += 1
-        data = bytes()
-        while len(data) < data_length:
-            data = data + self._s.recv(data_length - len(data))
-        assert(len(data) == data_length)
-        print("NBD response received data_length=%d bytes" % data_length)
-        return (data, errno)
+        header = self._build_header(request_type, handle, offset, length)
+        if len(data) < self.SMALL_WRITE_SIZE:
+            self._s.sendall(header + data)
+        else:
+            # avoid copying large payloads just to put the header in front
+            self._s.sendall(header)
+            self._s.sendall(data)
+        zeroed = False
+        if request_type == self.READ:
+            # the reply is received straight into the caller's buffer, if
+            # there is one
+            zeroed = buffer is None
+            reply_data = bytearray(length) if buffer is None else buffer
+        elif request_type == self.BLOCK_STATUS:
+            reply_data = []
+        else:
+            reply_data = bytes()
+        if request_type != self.DISCONNECT:
+            request = _pending_request(request_type, offset, length,
+                                       reply_data, zeroed)
+            self._in_flight[handle] = request
+            if self.metrics is not None:
+                request.sent = time.monotonic()
+                self.metrics.observe('nbd_queue_depth',
+                                     len(self._in_flight))
+        return handle
+
+    def _record_reply(self, request):
+        name = self.REQUEST_NAMES.get(request.request_type)
+        self.metrics.observe('nbd_request_seconds',
+                             time.monotonic() - request.sent,
+                             {'type': name})
+        if request.request_type in (self.READ, self.WRITE):
+            self.metrics.add('nbd_bytes_total', request.length,
+                             {'type': name})
+
+    def _recv_into(self, buf):
+        view = memoryview(buf)
+        received = 0
+        while received < len(view):
+            count = self._s.recv_into(view[received:], len(view) - received)
+            if not count:
+                raise EOFError("NBD server closed the connection")
+            received += count
+
+    def _recv(self, length):
+        data = bytearray(length)
+        self._recv_into(data)
+        return data
+
+    def _parse_reply(self):
+        # Structured replies come in chunks; keep reading until one of the
+        # requests has all of its reply
+        while True:
+            magic = struct.unpack(">L", self._recv(4))[0]
+            if magic == self.NBD_STRUCTURED_REPLY_MAGIC:
+                reply = self._parse_structured_reply_chunk()
+                if reply is not None:
+                    return reply
+                continue
+            assert(magic == self.NBD_REPLY_MAGIC)
+            return self._parse_simple_reply()
+
+    def _parse_simple_reply(self):
+        (errno, handle) = struct.unpack(">LQ", self._recv(4 + 8))
+        assert(handle in self._in_flight)
+        request = self._in_flight.pop(handle)
+        if request.request_type == self.READ:
+            self._recv_into(request.data)
+        if request.sent is not None:
+            self._record_reply(request)
+        return (handle, request.data, errno)
+
+    def _parse_structured_reply_chunk(self):
+        (flags, reply_type, handle, length) = \
+            struct.unpack(">HHQL", self._recv(2 + 2 + 8 + 4))
+        assert(handle in self._in_flight)
+        request = self._in_flight[handle]
+        if reply_type == self.NBD_REPLY_TYPE_OFFSET_DATA:
+            offset = struct.unpack(">Q", self._recv(8))[0] - request.offset
+            self._recv_into(
+                memoryview(request.data)[offset:offset + length - 8])
+        elif reply_type == self.NBD_REPLY_TYPE_OFFSET_HOLE:
+            (offset, hole_length) = struct.unpack(">QL", self._recv(length))
+            if not request.zeroed:
+                offset -= request.offset
+                memoryview(request.data)[offset:offset + hole_length] = \
+                    bytes(hole_length)
+        elif reply_type == self.NBD_REPLY_TYPE_BLOCK_STATUS:
+            payload = self._recv(length)
+            if struct.unpack(">L", payload[:4])[0] == self._meta_context_id:
+                request.data.extend(struct.iter_unpack(">LL", payload[4:]))
+        elif reply_type & self.NBD_REPLY_TYPE_ERROR_BIT:
+            payload = self._recv(length)
+            request.errno = struct.unpack(">L", payload[:4])[0]
+        else:
+            # NBD_REPLY_TYPE_NONE
+            self._recv(length)
+        if not flags & self.NBD_REPLY_FLAG_DONE:
+            return None
+        del self._in_flight[handle]
+        if request.sent is not None:
+            self._record_reply(request)
+        return (handle, request.data, request.errno)
+
+    def _wait_for_reply(self, handle):
+        # Replies may arrive in any order, so keep the ones for other
+        # requests until their owner asks for them.
+        while handle not in self._replies:
+            (reply_handle, data, errno) = self._parse_reply()
+            self._replies[reply_handle] = (data, errno)
+        return self._replies.pop(handle)
 
     def _check_value(self, name, value):
         if not value % 512:
@@ -161,48 +512,171 @@ class new_nbd_client(object):
         raise ValueError("%s=%i is not a multiple of 512" % (name, value))
 
     def write(self, data, offset):
-        print("NBD_CMD_WRITE")
         self._check_value("offset", offset)
         self._check_value("size", len(data))
         self._flushed = False
-        header = self._build_header(self.WRITE, offset, len(data))
-        self._s.sendall(header + data)
-        (_, errno) = self._parse_reply()
+        handle = self._send_request(self.WRITE, offset, len(data), data)
+        (_, errno) = self._wait_for_reply(handle)
         assert(errno == 0)
         return len(data)
 
     def read(self, offset, length):
-        print("NBD_CMD_READ")
         self._check_value("offset", offset)
         self._check_value("length", length)
-        header = self._build_header(self.READ, offset, length)
-        self._s.sendall(header)
-        (data, errno) = self._parse_reply(length)
+        handle = self._send_request(self.READ, offset, length)
+        (data, errno) = self._wait_for_reply(handle)
         assert(errno == 0)
         return data
 
+    def readinto(self, offset, buf):
+        """
+        Read len(buf) bytes from offset straight into buf, a writable
+        bytes-like object such as a bytearray or a memoryview of one.
+        Returns the number of bytes read.
+        """
+        length = memoryview(buf).nbytes
+        self._check_value("offset", offset)
+        self._check_value("length", length)
+        handle = self._send_request(self.READ, offset, length, buffer=buf)
+        (_, errno) = self._wait_for_reply(handle)
+        assert(errno == 0)
+        return length
+
+    def read_pipelined(self, extents, queue_depth=None, pool=None):
+        """
+        Read every (offset, length) pair of extents, keeping up to
+        queue_depth requests in flight, and yield (offset, data) pairs in
+        the order the extents were given. Replies that overtake an earlier
+        request wait in a reorder buffer, which together with the requests
+        in flight never holds more than queue_depth entries.
+
+        If a buffer_pool is given the replies are received into its buffers,
+        and each one goes back to the pool when the next pair is asked for,
+        so data must not be used after that.
+        """
+        if queue_depth is None:
+            queue_depth = self.queue_depth
+        extents = iter(extents)
+        pending = collections.deque()
+        while True:
+            while len(pending) < queue_depth:
+                extent = next(extents, None)
+                if extent is None:
+                    break
+                (offset, length) = extent
+                self._check_value("offset", offset)
+                self._check_value("length", length)
+                buffer = pool.get(length) if pool is not None else None
+                handle = self._send_request(self.READ, offset, length,
+                                            buffer=buffer)
+                pending.append((handle, offset))
+            if not pending:
+                return
+            (handle, offset) = pending.popleft()
+            (data, errno) = self._wait_for_reply(handle)
+            assert(errno == 0)
+            yield (offset, data)
+            if pool is not None:
+                pool.put(data)
+
+    def can_write_zeroes(self):
+        return self._transmission_flags & self.FLAG_SEND_WRITE_ZEROES != 0
+
+    def write_zeroes(self, offset, length):
+        self._check_value("offset", offset)
+        self._check_value("length", length)
+        self._flushed = False
+        handle = self._send_zeroes(offset, length)
+        (_, errno) = self._wait_for_reply(handle)
+        assert(errno == 0)
+        return length
+
+    def _send_zeroes(self, offset, length):
+        # Servers without NBD_CMD_WRITE_ZEROES are sent the zeros themselves
+        if self.can_write_zeroes():
+            return self._send_request(self.WRITE_ZEROES, offset, length)
+        return self._send_request(self.WRITE, offset, length, bytes(length))
+
+    def write_pipelined(self, blocks, queue_depth=None):
+        """
+        Write every (offset, data) pair of blocks, keeping up to queue_depth
+        requests in flight. data may instead be the length of a run of
+        zeros to write. Returns the number of bytes written.
+        """
+        if queue_depth is None:
+            queue_depth = self.queue_depth
+        pending = collections.deque()
+        written = 0
+        for (offset, data) in blocks:
+            if len(pending) >= queue_depth:
+                (_, errno) = self._wait_for_reply(pending.popleft())
+                assert(errno == 0)
+            self._check_value("offset", offset)
+            self._flushed = False
+            if isinstance(data, int):
+                self._check_value("length", data)
+                pending.append(self._send_zeroes(offset, data))
+                written += data
+                continue
+            self._check_value("size", len(data))
+            pending.append(self._send_request(self.WRITE, offset, len(data),
+                                              data))
+            written += len(data)
+        while pending:
+            (_, errno) = self._wait_for_reply(pending.popleft())
+            assert(errno == 0)
+        return written
+
+    def can_block_status(self):
+        return self._meta_context_id is not None
+
+    def block_status(self, offset, length):
+        """
+        Return the base:allocation status of the export starting at offset as
+        a list of (length, flags) descriptors. The server may describe less
+        than length bytes, or run past it in the last descriptor.
+        """
+        assert(self.can_block_status())
+        handle = self._send_request(self.BLOCK_STATUS, offset, length)
+        (descriptors, errno) = self._wait_for_reply(handle)
+        assert(errno == 0)
+        return descriptors
+
+    def block_status_extents(self, offset, length):
+        """
+        Yield (offset, length, flags) for consecutive runs of the export
+        that together cover exactly offset to offset + length.
+        """
+        end = offset + length
+        while offset < end:
+            descriptors = self.block_status(
+                offset, min(end - offset, self.MAX_BLOCK_STATUS_LENGTH))
+            assert(descriptors)
+            for (run_length, flags) in descriptors:
+                run_length = min(run_length, end - offset)
+                yield (offset, run_length, flags)
+                offset += run_length
+                if offset >= end:
+                    break
+
     def need_flush(self):
-        if self._flags & self.FLAG_SEND_FLUSH != 0:
+        if self._transmission_flags & self.FLAG_SEND_FLUSH != 0:
             return True
         else:
             return False
 
     def flush(self):
-        print("NBD_CMD_FLUSH")
         if self.need_flush() is False:
             self._flushed = True
             return True
-        header = self._build_header(self.FLUSH, 0, 0)
-        self._s.sendall(header)
-        (_, errno) = self._parse_reply()
+        handle = self._send_request(self.FLUSH, 0, 0)
+        (_, errno) = self._wait_for_reply(handle)
         if not errno:
             self._flushed = True
         return errno == 0
 
     def _disconnect(self):
-        print("NBD_CMD_DISC")
-        header = self._build_header(self.DISCONNECT, 0, 0)
-        self._s.sendall(header)
+        self._send_request(self.DISCONNECT, 0, 0)
 
     def size(self):
         return self._size
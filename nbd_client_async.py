@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+
+"""
+An asyncio counterpart to nbd_client.new_nbd_client, so a single process can
+keep many NBD exports going at once.
+
+The handshake is the same fixed newstyle negotiation: STARTTLS when a CA
+certificate is given, structured replies and base:allocation when the server
+offers them, and NBD_OPT_GO with a fallback to NBD_OPT_EXPORT_NAME. Once it
+is done a background task reads replies and hands each one to the coroutine
+waiting for it, so any number of coroutines can share a connection, with at
+most queue_depth requests in flight on it.
+
+TLS needs Python 3.11 or later, for asyncio.StreamWriter.start_tls.
+"""
+
+import asyncio
+import ssl
+import struct
+import sys
+import time
+
+from nbd_client import new_nbd_client, tls_context
+
+_nbd = new_nbd_client
+
+
+class _pending_request(object):
+    """A request sent to the server which is still waiting for its reply"""
+
+    def __init__(self, request_type, offset, length, data, future):
+        self.request_type = request_type
+        self.offset = offset
+        self.length = length
+        self.data = data
+        self.future = future
+        self.errno = 0
+        # when the request was sent, if metrics are being recorded
+        self.sent = None
+
+
+class async_nbd_client(object):
+    """
+    Create one and then await connect(), or use open_nbd_client. The CA
+    certificate can be given as the path of a PEM file with ca_cert or as
+    PEM text with ca_data, which saves writing it out when many exports
+    with different certificates are open at once, or as a ready made
+    ssl_context from nbd_client.tls_context, which saves loading it again
+    for every connection. metrics is an optional cbt_metrics.metrics,
+    recorded as by new_nbd_client.
+    """
+
+    def __init__(self, hostname, export_name="", ca_cert=None,
+                 tls_hostname=None, port=10809,
+                 queue_depth=_nbd.DEFAULT_QUEUE_DEPTH, ca_data=None,
+                 metrics=None, ssl_context=None):
+        self.hostname = hostname
+        self.port = port
+        self.export_name = export_name
+        self.ca_cert = ca_cert
+        self.ca_data = ca_data
+        self.ssl_context = ssl_context
+        self.tls_hostname = tls_hostname or hostname
+        self.queue_depth = queue_depth
+        self.metrics = metrics
+        self._flushed = True
+        self._closed = True
+        self._handle = 0
+        self._size = None
+        self._transmission_flags = 0
+        self._structured_replies = False
+        self._meta_context_id = None
+        # handle -> _pending_request of requests awaiting a reply
+        self._in_flight = {}
+        self._slots = None
+        self._receiver = None
+        self._error = None
+        self._reader = None
+        self._writer = None
+
+    async def connect(self):
+        start = time.monotonic()
+        (self._reader, self._writer) = await asyncio.open_connection(
+            self.hostname, self.port)
+        self._closed = False
+        await self._fixed_new_style_handshake(self.export_name)
+        self._slots = asyncio.Semaphore(self.queue_depth)
+        self._receiver = asyncio.ensure_future(self._receive_replies())
+        if self.metrics is not None:
+            self.metrics.observe('nbd_connect_seconds',
+                                 time.monotonic() - start)
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._closed:
+            return
+        try:
+            if self._error is None:
+                if not self._flushed:
+                    await self.flush()
+                self._writer.write(self._build_header(_nbd.DISCONNECT,
+                                                      self._next_handle(),
+                                                      0, 0))
+                await self._writer.drain()
+        finally:
+            self._closed = True
+            if self._receiver is not None:
+                self._receiver.cancel()
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+
+    def _tls_context(self):
+        if self.ssl_context is not None:
+            return self.ssl_context
+        return tls_context(self.ca_cert, self.ca_data)
+
+    async def _upgrade_to_TLS(self):
+        if sys.version_info < (3, 11):
+            raise RuntimeError("NBD over TLS with asyncio needs Python 3.11 "
+                               "or later, this is %d.%d"
+                               % sys.version_info[:2])
+        self._send_option(_nbd.NBD_OPT_STARTTLS)
+        (reply_type, _) = await self._receive_option_reply(
+            _nbd.NBD_OPT_STARTTLS)
+        assert(reply_type == _nbd.NBD_REP_ACK)
+        start = time.monotonic()
+        await self._writer.start_tls(self._tls_context(),
+                                     server_hostname=self.tls_hostname)
+        if self.metrics is not None:
+            self.metrics.observe('nbd_tls_handshake_seconds',
+                                 time.monotonic() - start)
+
+    async def _fixed_new_style_handshake(self, export_name):
+        nbd_magic = await self._reader.readexactly(len("NBDMAGIC"))
+        assert(nbd_magic == b'NBDMAGIC')
+        nbd_magic = await self._reader.readexactly(len("IHAVEOPT"))
+        assert(nbd_magic == b'IHAVEOPT')
+        self._flags = struct.unpack(">H",
+                                    await self._reader.readexactly(2))[0]
+        assert(self._flags & _nbd.FLAG_HAS_FLAGS != 0)
+        # send fixed new style flags
+        self._writer.write(struct.pack('>L', _nbd.cflags))
+
+        if self.ca_cert or self.ca_data or self.ssl_context:
+            await self._upgrade_to_TLS()
+
+        self._structured_replies = await self._negotiate_structured_replies()
+        if self._structured_replies:
+            self._meta_context_id = await self._set_meta_context(export_name)
+        if not await self._request_export_info(_nbd.NBD_OPT_GO, export_name):
+            # older servers only know the original way of choosing an export
+            await self._request_export_by_name(export_name)
+
+    def _send_option(self, option, data=b''):
+        self._writer.write(b'IHAVEOPT' + struct.pack('>LL', option, len(data))
+                           + data)
+
+    async def _receive_option_reply(self, option):
+        await self._writer.drain()
+        (magic, reply_option, reply_type, length) = struct.unpack(
+            '>QLLL', await self._reader.readexactly(8 + 4 + 4 + 4))
+        assert(magic == _nbd.NBD_OPTION_REPLY_MAGIC)
+        assert(reply_option == option)
+        return (reply_type, await self._reader.readexactly(length))
+
+    async def _negotiate_structured_replies(self):
+        self._send_option(_nbd.NBD_OPT_STRUCTURED_REPLY)
+        (reply_type, _) = await self._receive_option_reply(
+            _nbd.NBD_OPT_STRUCTURED_REPLY)
+        return reply_type == _nbd.NBD_REP_ACK
+
+    async def _set_meta_context(self, export_name):
+        name = str.encode(export_name)
+        query = _nbd.BASE_ALLOCATION
+        self._send_option(_nbd.NBD_OPT_SET_META_CONTEXT,
+                          struct.pack('>L', len(name)) + name +
+                          struct.pack('>LL', 1, len(query)) + query)
+        context_id = None
+        while True:
+            (reply_type, data) = await self._receive_option_reply(
+                _nbd.NBD_OPT_SET_META_CONTEXT)
+            if reply_type != _nbd.NBD_REP_META_CONTEXT:
+                return context_id
+            if data[4:] == query:
+                context_id = struct.unpack('>L', data[:4])[0]
+
+    async def _request_export_info(self, option, export_name):
+        name = str.encode(export_name)
+        self._send_option(option, struct.pack('>L', len(name)) + name +
+                          struct.pack('>H', 0))
+        while True:
+            (reply_type, data) = await self._receive_option_reply(option)
+            if reply_type == _nbd.NBD_REP_INFO:
+                info_type = struct.unpack('>H', data[:2])[0]
+                if info_type == _nbd.NBD_INFO_EXPORT:
+                    (self._size, self._transmission_flags) = \
+                        struct.unpack('>QH', data[2:12])
+            elif reply_type == _nbd.NBD_REP_ACK:
+                return True
+            elif reply_type == _nbd.NBD_REP_ERR_UNSUP:
+                return False
+            else:
+                raise IOError("NBD server refused export '%s' (reply %x)"
+                              % (export_name, reply_type))
+
+    async def _request_export_by_name(self, export_name):
+        name = str.encode(export_name)
+        self._writer.write(b'IHAVEOPT' +
+                           struct.pack('>LL', _nbd.NBD_OPT_EXPORT_NAME,
+                                       len(name)) + name)
+        await self._writer.drain()
+        (self._size, self._transmission_flags) = struct.unpack(
+            ">QH", await self._reader.readexactly(8 + 2))
+        # ignore the zeroes
+        await self._reader.readexactly(124)
+
+    def _next_handle(self):
+        handle = self._handle
+        self._handle += 1
+        return handle
+
+    def _build_header(self, request_type, handle, offset, length):
+        return struct.pack('>LHHQQL', _nbd.NBD_REQUEST_MAGIC, 0,
+                           request_type, handle, offset, length)
+
+    async def _request(self, request_type, offset, length, data=b''):
+        async with self._slots:
+            if self._error is not None:
+                raise self._error
+            handle = self._next_handle()
+            if request_type == _nbd.READ and self._structured_replies:
+                # chunks fill this in; holes are left as zeros
+                reply_data = bytearray(length)
+            elif request_type == _nbd.BLOCK_STATUS:
+                reply_data = []
+            else:
+                reply_data = bytes()
+            request = _pending_request(request_type, offset, length,
+                                       reply_data,
+                                       asyncio.get_running_loop()
+                                       .create_future())
+            self._in_flight[handle] = request
+            if self.metrics is not None:
+                request.sent = time.monotonic()
+                self.metrics.observe('nbd_queue_depth', len(self._in_flight))
+            self._writer.write(self._build_header(request_type, handle,
+                                                  offset, length))
+            if data:
+                self._writer.write(data)
+            await self._writer.drain()
+            return await request.future
+
+    async def _receive_replies(self):
+        try:
+            while True:
+                await self._receive_reply()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # fail everything waiting now, and every later request
+            if isinstance(e, asyncio.IncompleteReadError):
+                e = EOFError("NBD server closed the connection")
+            self._error = e
+            for request in self._in_flight.values():
+                if not request.future.done():
+                    request.future.set_exception(e)
+            self._in_flight.clear()
+
+    async def _receive_reply(self):
+        reader = self._reader
+        magic = struct.unpack(">L", await reader.readexactly(4))[0]
+        if magic == _nbd.NBD_STRUCTURED_REPLY_MAGIC:
+            await self._receive_structured_reply_chunk()
+            return
+        assert(magic == _nbd.NBD_REPLY_MAGIC)
+        (errno, handle) = struct.unpack(">LQ",
+                                        await reader.readexactly(4 + 8))
+        request = self._in_flight.pop(handle)
+        data = request.data
+        if request.request_type == _nbd.READ:
+            data = await reader.readexactly(request.length)
+        self._complete(request, data, errno)
+
+    async def _receive_structured_reply_chunk(self):
+        reader = self._reader
+        (flags, reply_type, handle, length) = struct.unpack(
+            ">HHQL", await reader.readexactly(2 + 2 + 8 + 4))
+        request = self._in_flight[handle]
+        if reply_type == _nbd.NBD_REPLY_TYPE_OFFSET_DATA:
+            offset = struct.unpack(">Q", await reader.readexactly(8))[0] - \
+                request.offset
+            request.data[offset:offset + length - 8] = \
+                await reader.readexactly(length - 8)
+        elif reply_type == _nbd.NBD_REPLY_TYPE_BLOCK_STATUS:
+            payload = await reader.readexactly(length)
+            if struct.unpack(">L", payload[:4])[0] == self._meta_context_id:
+                request.data.extend(struct.iter_unpack(">LL", payload[4:]))
+        elif reply_type & _nbd.NBD_REPLY_TYPE_ERROR_BIT:
+            payload = await reader.readexactly(length)
+            request.errno = struct.unpack(">L", payload[:4])[0]
+        else:
+            # NBD_REPLY_TYPE_NONE, or NBD_REPLY_TYPE_OFFSET_HOLE which needs
+            # nothing doing as the read buffer starts out as zeros
+            await reader.readexactly(length)
+        if flags & _nbd.NBD_REPLY_FLAG_DONE:
+            del self._in_flight[handle]
+            self._complete(request, request.data, request.errno)
+
+    def _complete(self, request, data, errno):
+        if request.sent is not None:
+            name = _nbd.REQUEST_NAMES.get(request.request_type)
+            self.metrics.observe('nbd_request_seconds',
+                                 time.monotonic() - request.sent,
+                                 {'type': name})
+            if request.request_type in (_nbd.READ, _nbd.WRITE):
+                self.metrics.add('nbd_bytes_total', request.length,
+                                 {'type': name})
+        if not request.future.done():
+            request.future.set_result((data, errno))
+
+    def _check_value(self, name, value):
+        if not value % 512:
+            return
+        raise ValueError("%s=%i is not a multiple of 512" % (name, value))
+
+    async def write(self, data, offset):
+        self._check_value("offset", offset)
+        self._check_value("size", len(data))
+        self._flushed = False
+        (_, errno) = await self._request(_nbd.WRITE, offset, len(data), data)
+        assert(errno == 0)
+        return len(data)
+
+    async def read(self, offset, length):
+        self._check_value("offset", offset)
+        self._check_value("length", length)
+        (data, errno) = await self._request(_nbd.READ, offset, length)
+        assert(errno == 0)
+        return data
+
+    def can_block_status(self):
+        return self._meta_context_id is not None
+
+    async def block_status(self, offset, length):
+        """
+        Return the base:allocation status of the export starting at offset as
+        a list of (length, flags) descriptors, as new_nbd_client.block_status
+        does.
+        """
+        assert(self.can_block_status())
+        (descriptors, errno) = await self._request(_nbd.BLOCK_STATUS, offset,
+                                                   length)
+        assert(errno == 0)
+        return descriptors
+
+    async def block_status_extents(self, offset, length):
+        """
+        Return a list of (offset, length, flags) for consecutive runs of the
+        export that together cover exactly offset to offset + length.
+        """
+        end = offset + length
+        result = []
+        while offset < end:
+            descriptors = await self.block_status(
+                offset, min(end - offset, _nbd.MAX_BLOCK_STATUS_LENGTH))
+            assert(descriptors)
+            for (run_length, flags) in descriptors:
+                run_length = min(run_length, end - offset)
+                result.append((offset, run_length, flags))
+                offset += run_length
+                if offset >= end:
+                    break
+        return result
+
+    def need_flush(self):
+        return self._transmission_flags & _nbd.FLAG_SEND_FLUSH != 0
+
+    async def flush(self):
+        if not self.need_flush():
+            self._flushed = True
+            return True
+        (_, errno) = await self._request(_nbd.FLUSH, 0, 0)
+        if not errno:
+            self._flushed = True
+        return errno == 0
+
+    def size(self):
+        return self._size
+
+
+async def open_nbd_client(*args, **kwargs):
+    """Create an async_nbd_client and connect it"""
+    return await async_nbd_client(*args, **kwargs).connect()
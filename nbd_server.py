@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+
+"""
+A small NBD server, used to serve disk images locally without a XenServer
+host: for benchmarking the clients in this repository and for presenting a
+restore point as a virtual disk.
+
+It speaks fixed newstyle negotiation with optional STARTTLS, NBD_OPT_GO,
+NBD_OPT_INFO and the original NBD_OPT_EXPORT_NAME, structured replies and
+the base:allocation metadata context for NBD_CMD_BLOCK_STATUS. Each
+connection is handled by its own thread and its requests are answered in
+order.
+
+A backend is any object with size(), pread(offset, length) and, unless the
+export is read only, pwrite(data, offset) and flush() methods. If it has a
+block_status(offset, length) method returning (length, flags) pairs it is
+used to answer NBD_CMD_BLOCK_STATUS, otherwise the whole export is reported
+as allocated data.
+
+example: python nbd_server.py -f <VDI path> -n <export name>
+
+serves a raw VDI image on port 10809 until interrupted.
+"""
+
+import argparse
+import os
+import socket
+import ssl
+import struct
+import threading
+
+NBD_FLAG_FIXED_NEWSTYLE = (1 << 0)
+NBD_FLAG_NO_ZEROES = (1 << 1)
+NBD_FLAG_C_FIXED_NEWSTYLE = (1 << 0)
+NBD_FLAG_C_NO_ZEROES = (1 << 1)
+
+NBD_FLAG_HAS_FLAGS = (1 << 0)
+NBD_FLAG_READ_ONLY = (1 << 1)
+NBD_FLAG_SEND_FLUSH = (1 << 2)
+NBD_FLAG_SEND_WRITE_ZEROES = (1 << 6)
+
+NBD_OPT_EXPORT_NAME = 1
+NBD_OPT_ABORT = 2
+NBD_OPT_STARTTLS = 5
+NBD_OPT_INFO = 6
+NBD_OPT_GO = 7
+NBD_OPT_STRUCTURED_REPLY = 8
+NBD_OPT_SET_META_CONTEXT = 10
+
+NBD_REP_ACK = 1
+NBD_REP_INFO = 3
+NBD_REP_META_CONTEXT = 4
+NBD_REP_ERR_UNSUP = (1 << 31) + 1
+NBD_REP_ERR_POLICY = (1 << 31) + 2
+NBD_REP_ERR_INVALID = (1 << 31) + 3
+NBD_REP_ERR_TLS_REQD = (1 << 31) + 5
+NBD_REP_ERR_UNKNOWN = (1 << 31) + 6
+NBD_INFO_EXPORT = 0
+
+NBD_CMD_READ = 0
+NBD_CMD_WRITE = 1
+NBD_CMD_DISC = 2
+NBD_CMD_FLUSH = 3
+NBD_CMD_WRITE_ZEROES = 6
+NBD_CMD_BLOCK_STATUS = 7
+
+NBD_REQUEST_MAGIC = 0x25609513
+NBD_SIMPLE_REPLY_MAGIC = 0x67446698
+NBD_OPTION_REPLY_MAGIC = 0x3e889045565a9
+NBD_STRUCTURED_REPLY_MAGIC = 0x668e33ef
+
+NBD_REPLY_FLAG_DONE = (1 << 0)
+NBD_REPLY_TYPE_NONE = 0
+NBD_REPLY_TYPE_OFFSET_DATA = 1
+NBD_REPLY_TYPE_OFFSET_HOLE = 2
+NBD_REPLY_TYPE_BLOCK_STATUS = 5
+NBD_REPLY_TYPE_ERROR = (1 << 15) + 1
+
+BASE_ALLOCATION = b'base:allocation'
+BASE_ALLOCATION_ID = 1
+
+EINVAL = 22
+EPERM = 1
+
+
+class file_backend(object):
+    """Serve a file, such as a raw VDI image"""
+
+    def __init__(self, path, read_only=False):
+        self.read_only = read_only
+        self._fd = os.open(path, os.O_RDONLY if read_only else os.O_RDWR)
+
+    def size(self):
+        return os.fstat(self._fd).st_size
+
+    def pread(self, offset, length):
+        data = os.pread(self._fd, length, offset)
+        return data + bytes(length - len(data))
+
+    def pwrite(self, data, offset):
+        os.pwrite(self._fd, data, offset)
+
+    def flush(self):
+        os.fsync(self._fd)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class memory_backend(object):
+    """Serve a bytearray"""
+
+    def __init__(self, data, read_only=False):
+        self.read_only = read_only
+        self.data = data
+
+    def size(self):
+        return len(self.data)
+
+    def pread(self, offset, length):
+        return bytes(self.data[offset:offset + length])
+
+    def pwrite(self, data, offset):
+        self.data[offset:offset + len(data)] = data
+
+    def flush(self):
+        pass
+
+
+class _connection(object):
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.structured_replies = False
+        self.meta_context = False
+        self.backend = None
+        self.send_lock = threading.Lock()
+
+    def recv(self, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                raise EOFError("NBD client closed the connection")
+            data += chunk
+        return bytes(data)
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def send_option_reply(self, option, reply_type, data=b''):
+        self.send(struct.pack('>QLLL', NBD_OPTION_REPLY_MAGIC, option,
+                              reply_type, len(data)) + data)
+
+    def transmission_flags(self, backend):
+        flags = NBD_FLAG_HAS_FLAGS | NBD_FLAG_SEND_FLUSH
+        if self.server.write_zeroes:
+            flags |= NBD_FLAG_SEND_WRITE_ZEROES
+        if getattr(backend, 'read_only', False):
+            flags |= NBD_FLAG_READ_ONLY
+        return flags
+
+    def negotiate(self):
+        self.send(b'NBDMAGIC' + b'IHAVEOPT' +
+                  struct.pack('>H', NBD_FLAG_FIXED_NEWSTYLE |
+                              NBD_FLAG_NO_ZEROES))
+        client_flags = struct.unpack('>L', self.recv(4))[0]
+        no_zeroes = client_flags & NBD_FLAG_C_NO_ZEROES
+        tls = False
+        while True:
+            (magic, option, length) = struct.unpack('>8sLL', self.recv(16))
+            if magic != b'IHAVEOPT':
+                return False
+            data = self.recv(length)
+            if self.server.ssl_context is not None and not tls and \
+                    option not in (NBD_OPT_STARTTLS, NBD_OPT_ABORT):
+                if option == NBD_OPT_EXPORT_NAME:
+                    return False
+                self.send_option_reply(option, NBD_REP_ERR_TLS_REQD)
+                continue
+            if option == NBD_OPT_STARTTLS:
+                if self.server.ssl_context is None or tls:
+                    self.send_option_reply(option, NBD_REP_ERR_POLICY)
+                    continue
+                self.send_option_reply(option, NBD_REP_ACK)
+                self.sock = self.server.ssl_context.wrap_socket(
+                    self.sock, server_side=True)
+                tls = True
+            elif option == NBD_OPT_EXPORT_NAME:
+                backend = self.server.exports.get(data.decode())
+                if backend is None:
+                    return False
+                self.backend = backend
+                self.send(struct.pack('>QH', backend.size(),
+                                      self.transmission_flags(backend)) +
+                          (b'' if no_zeroes else bytes(124)))
+                return True
+            elif option in (NBD_OPT_INFO, NBD_OPT_GO):
+                name_length = struct.unpack('>L', data[:4])[0]
+                name = data[4:4 + name_length].decode()
+                backend = self.server.exports.get(name)
+                if backend is None:
+                    self.send_option_reply(option, NBD_REP_ERR_UNKNOWN)
+                    continue
+                self.send_option_reply(
+                    option, NBD_REP_INFO,
+                    struct.pack('>HQH', NBD_INFO_EXPORT, backend.size(),
+                                self.transmission_flags(backend)))
+                self.send_option_reply(option, NBD_REP_ACK)
+                if option == NBD_OPT_GO:
+                    self.backend = backend
+                    return True
+            elif option == NBD_OPT_STRUCTURED_REPLY:
+                self.structured_replies = True
+                self.send_option_reply(option, NBD_REP_ACK)
+            elif option == NBD_OPT_SET_META_CONTEXT:
+                if not self.structured_replies:
+                    self.send_option_reply(option, NBD_REP_ERR_INVALID)
+                    continue
+                name_length = struct.unpack('>L', data[:4])[0]
+                position = 4 + name_length
+                query_count = struct.unpack('>L',
+                                            data[position:position + 4])[0]
+                position += 4
+                self.meta_context = False
+                for _ in range(query_count):
+                    query_length = struct.unpack(
+                        '>L', data[position:position + 4])[0]
+                    query = data[position + 4:position + 4 + query_length]
+                    position += 4 + query_length
+                    if query == BASE_ALLOCATION:
+                        self.meta_context = True
+                        self.send_option_reply(
+                            option, NBD_REP_META_CONTEXT,
+                            struct.pack('>L', BASE_ALLOCATION_ID) + query)
+                self.send_option_reply(option, NBD_REP_ACK)
+            elif option == NBD_OPT_ABORT:
+                self.send_option_reply(option, NBD_REP_ACK)
+                return False
+            else:
+                self.send_option_reply(option, NBD_REP_ERR_UNSUP)
+
+    def send_simple_reply(self, handle, errno, data=b''):
+        self.send(struct.pack('>LLQ', NBD_SIMPLE_REPLY_MAGIC, errno, handle) +
+                  data)
+
+    def send_chunk(self, handle, reply_type, payload, done):
+        flags = NBD_REPLY_FLAG_DONE if done else 0
+        self.send(struct.pack('>LHHQL', NBD_STRUCTURED_REPLY_MAGIC, flags,
+                              reply_type, handle, len(payload)) + payload)
+
+    def send_error(self, handle, errno):
+        if self.structured_replies:
+            self.send_chunk(handle, NBD_REPLY_TYPE_ERROR,
+                            struct.pack('>LH', errno, 0), True)
+        else:
+            self.send_simple_reply(handle, errno)
+
+    def read(self, handle, offset, length):
+        data = self.backend.pread(offset, length)
+        if not self.structured_replies:
+            self.send_simple_reply(handle, 0, data)
+            return
+        if not any(data):
+            self.send_chunk(handle, NBD_REPLY_TYPE_OFFSET_HOLE,
+                            struct.pack('>QL', offset, length), True)
+        else:
+            self.send_chunk(handle, NBD_REPLY_TYPE_OFFSET_DATA,
+                            struct.pack('>Q', offset) + data, True)
+
+    def block_status(self, handle, offset, length):
+        if not self.meta_context:
+            self.send_error(handle, EINVAL)
+            return
+        if hasattr(self.backend, 'block_status'):
+            descriptors = self.backend.block_status(offset, length)
+        else:
+            descriptors = [(length, 0)]
+        payload = struct.pack('>L', BASE_ALLOCATION_ID) + b''.join(
+            struct.pack('>LL', run_length, flags)
+            for (run_length, flags) in descriptors)
+        self.send_chunk(handle, NBD_REPLY_TYPE_BLOCK_STATUS, payload, True)
+
+    def serve(self):
+        try:
+            if not self.negotiate():
+                return
+            while True:
+                (magic, _, request_type, handle, offset, length) = \
+                    struct.unpack('>LHHQQL', self.recv(28))
+                if magic != NBD_REQUEST_MAGIC:
+                    return
+                if request_type == NBD_CMD_DISC:
+                    return
+                elif request_type == NBD_CMD_WRITE:
+                    data = self.recv(length)
+                    if getattr(self.backend, 'read_only', False):
+                        self.send_error(handle, EPERM)
+                        continue
+                    self.backend.pwrite(data, offset)
+                    self.send_simple_reply(handle, 0)
+                elif offset + length > self.backend.size():
+                    self.send_error(handle, EINVAL)
+                elif request_type == NBD_CMD_READ:
+                    self.read(handle, offset, length)
+                elif request_type == NBD_CMD_FLUSH:
+                    if hasattr(self.backend, 'flush'):
+                        self.backend.flush()
+                    self.send_simple_reply(handle, 0)
+                elif request_type == NBD_CMD_WRITE_ZEROES:
+                    if getattr(self.backend, 'read_only', False):
+                        self.send_error(handle, EPERM)
+                        continue
+                    self.backend.pwrite(bytes(length), offset)
+                    self.send_simple_reply(handle, 0)
+                elif request_type == NBD_CMD_BLOCK_STATUS:
+                    self.block_status(handle, offset, length)
+                else:
+                    self.send_error(handle, EINVAL)
+        except (EOFError, ConnectionError):
+            pass
+        finally:
+            self.sock.close()
+
+
+class nbd_server(object):
+    """
+    Serve the backends in exports, a dict from export name to backend, on
+    address. Give an ssl.SSLContext to require STARTTLS. Clear
+    write_zeroes to stop offering NBD_CMD_WRITE_ZEROES to new connections.
+    """
+
+    def __init__(self, exports, address=('127.0.0.1', 0), ssl_context=None):
+        self.exports = exports
+        self.ssl_context = ssl_context
+        self.write_zeroes = True
+        self._socket = socket.create_server(address)
+        self.address = self._socket.getsockname()
+        self._thread = None
+
+    def serve_forever(self):
+        while True:
+            try:
+                (sock, _) = self._socket.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=_connection(self, sock).serve,
+                             daemon=True).start()
+
+    def start(self):
+        """Serve from a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        try:
+            # wakes up the accept of serve_forever, which close alone does not
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def server_ssl_context(cert_path, key_path):
+    """Return an ssl.SSLContext serving the certificate cert_path"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    return context
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--filename', dest='path')
+    parser.add_argument('-n', '--export-name', dest='export_name', default='')
+    parser.add_argument('-a', '--address', dest='address',
+                        default='127.0.0.1')
+    parser.add_argument('--port', dest='port', type=int, default=10809)
+    parser.add_argument('--read-only', dest='read_only',
+                        action='store_const', const=True, default=False)
+    parser.add_argument('--cert', dest='cert',
+                        help='Certificate to require TLS with, PEM')
+    parser.add_argument('--key', dest='key',
+                        help='Private key of the certificate, PEM')
+    args = parser.parse_args()
+
+    ssl_context = None
+    if args.cert:
+        ssl_context = server_ssl_context(args.cert, args.key)
+    backend = file_backend(args.path, args.read_only)
+    server = nbd_server({args.export_name: backend},
+                        (args.address, args.port), ssl_context)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        backend.close()
+
+
+if __name__ == "__main__":
+    main()